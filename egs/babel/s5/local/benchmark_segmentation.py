@@ -0,0 +1,313 @@
+#! /usr/bin/python
+
+# Benchmark for segmentation_joint.py (or the scripts with analysis, which
+# take the same options). Synthetic .pred files are generated for each
+# recording duration, for a single channel and for a pair of channels, and
+# the segmentation script is run on each of them in a child process. The
+# wall time of each stage is read from its --timing-report, the peak memory
+# is the maximum resident set size of the child, and the segments are
+# hashed. The results can be stored as a baseline with --write-baseline,
+# and compared against it with --baseline: a case whose segments differ from
+# the baseline is an error, and the times and memory are shown relative to
+# it.
+#
+# e.g. local/benchmark_segmentation.py --durations 1m,1h --write-baseline base.json bench
+#      local/benchmark_segmentation.py --durations 1m,1h --baseline base.json \
+#        --segmentation-opts "--engine python" bench
+
+import os, argparse, sys, re, time, json, hashlib, subprocess, shlex
+from argparse import ArgumentParser
+
+import numpy as np
+
+def parse_duration(s):
+  # Returns the number of seconds in a duration such as 90, 90s, 10m or 20h
+  m = re.match(r"^(\d+(\.\d*)?)([smh]?)$", s)
+  if m == None:
+    sys.stderr.write("%s: Error: Invalid duration %s. Must be e.g. 90s, 10m or 20h.\n" \
+        % (sys.argv[0], s))
+    sys.exit(1)
+  return float(m.group(1)) * { "": 1, "s": 1, "m": 60, "h": 3600 }[m.group(3)]
+
+def duration_name(seconds):
+  for unit, size in (("h", 3600), ("m", 60)):
+    if seconds >= size and seconds % size == 0:
+      return "%d%s" % (seconds // size, unit)
+  return "%gs" % seconds
+
+def sample_frames(rng, mean, size = None):
+  # Lengths in frames of runs with a log-normal distribution with this mean
+  # (in frames), which is how the lengths of speech and pauses in
+  # conversations are usually modelled. The lengths are at least 1.
+  sigma = 0.8
+  return np.maximum(1, np.round(rng.lognormal(np.log(mean) - sigma * sigma / 2, \
+      sigma, size))).astype(np.int64)
+
+def conversation(rng, num_frames, frame_shift):
+  # Generates the predictions of the two channels of a conversation, as
+  # arrays of 0 (silence), 1 (noise) or 2 (speech). The speakers take turns
+  # of a few seconds. The speaker in the turn speaks in runs separated by
+  # short pauses, and the turns overlap slightly or are separated by a
+  # pause. The other speaker mostly listens, with occasional backchannels
+  # ("uh-huh") and noises. Finally a small proportion of the frames are
+  # misclassified, which gives the short runs that the resegmentation has
+  # to smooth over.
+  sec = 1.0 / frame_shift
+  channels = [ np.zeros(num_frames, dtype=np.int8), np.zeros(num_frames, dtype=np.int8) ]
+  speaker = 0
+  n = int(sample_frames(rng, 2 * sec))
+  while n < num_frames:
+    turn_end = min(num_frames, n + int(sample_frames(rng, 6 * sec)))
+    talker = channels[speaker]
+    listener = channels[1 - speaker]
+    # The speech of the turn, with pauses in between
+    t = n
+    while t < turn_end:
+      run_end = min(turn_end, t + int(sample_frames(rng, 1.5 * sec)))
+      talker[t:run_end] = 2
+      t = run_end + int(sample_frames(rng, 0.3 * sec))
+    # Noises of the talker (breaths, lip smacks) in the pauses
+    for t in rng.randint(n, turn_end, size = rng.poisson(0.3 * (turn_end - n) / sec)):
+      run_end = min(turn_end, t + int(sample_frames(rng, 0.2 * sec)))
+      talker[t:run_end][talker[t:run_end] == 0] = 1
+    # Backchannels and noises of the listener
+    for t in rng.randint(n, turn_end, size = rng.poisson(0.1 * (turn_end - n) / sec)):
+      run_end = min(num_frames, t + int(sample_frames(rng, 0.4 * sec)))
+      listener[t:run_end] = rng.choice([1, 2], p = [0.4, 0.6])
+    speaker = 1 - speaker
+    if rng.random_sample() < 0.3:
+      # The next speaker starts before the end of the turn
+      n = max(n + 1, turn_end - int(sample_frames(rng, 0.3 * sec)))
+    else:
+      n = turn_end + int(sample_frames(rng, 0.5 * sec))
+
+  for A in channels:
+    errors = np.flatnonzero(rng.random_sample(num_frames) < 0.02)
+    A[errors] = rng.randint(0, 3, size = len(errors))
+  return channels
+
+def write_pred_file(file_name, file_id, A):
+  f = open(file_name, 'w')
+  f.write(file_id + " " + " ".join(A.astype(str).tolist()) + "\n")
+  f.close()
+
+def generate_case(case_dir, seconds, paired, options, seed):
+  # Writes the .pred files of a case into case_dir, unless they were already
+  # generated with the same parameters
+  parameters = { "seconds": seconds, "paired": paired, "seed": seed, \
+      "frame_shift": options.frame_shift }
+  parameters_file = os.path.join(case_dir, "parameters.json")
+  if os.path.exists(parameters_file) \
+      and json.load(open(parameters_file)) == parameters:
+    return
+  if not os.path.isdir(case_dir):
+    os.makedirs(case_dir)
+  for f in os.listdir(case_dir):
+    os.remove(os.path.join(case_dir, f))
+
+  rng = np.random.RandomState(seed)
+  num_frames = int(round(seconds / options.frame_shift))
+  A1, A2 = conversation(rng, num_frames, options.frame_shift)
+  file_id = "bench_" + duration_name(seconds)
+  write_pred_file(os.path.join(case_dir, file_id + "_inLine.pred"), \
+      file_id + "_inLine", A1)
+  if paired:
+    # The channels of a recording usually differ in length by a few frames
+    A2 = A2[0:num_frames - rng.randint(0, 20)]
+    write_pred_file(os.path.join(case_dir, file_id + "_outLine.pred"), \
+        file_id + "_outLine", A2)
+  json.dump(parameters, open(parameters_file, 'w'), sort_keys = True)
+
+def max_rss_mb(rusage):
+  # ru_maxrss is in kilobytes on Linux but in bytes on Mac OS X
+  if sys.platform == "darwin":
+    return rusage.ru_maxrss / (1024.0 * 1024.0)
+  return rusage.ru_maxrss / 1024.0
+
+def run_case(case_dir, options):
+  # Runs the segmentation script on a case and returns the wall time, the
+  # wall time of each stage, the peak memory and the hash and number of
+  # lines of the segments
+  timing_report = os.path.join(case_dir, "timing.json")
+  segments_file = os.path.join(case_dir, "segments")
+  command = [ sys.executable, options.script ] \
+      + shlex.split(options.segmentation_opts) \
+      + [ "--frame-shift", str(options.frame_shift), \
+      "--timing-report", timing_report, case_dir ]
+  start = time.time()
+  process = subprocess.Popen(command, stdout = open(segments_file, 'w'), \
+      stderr = open(os.path.join(case_dir, "log"), 'w'))
+  pid, status, rusage = os.wait4(process.pid, 0)
+  wall = time.time() - start
+  if status != 0:
+    sys.stderr.write("%s: Error: %s failed, see %s\n" \
+        % (sys.argv[0], " ".join(command), os.path.join(case_dir, "log")))
+    sys.exit(1)
+
+  stages = {}
+  for line in open(timing_report):
+    record = json.loads(line)
+    if "summary" in record:
+      for s in record["summary"]["stages"]:
+        stages[s["stage"]] = s["wall"]
+  segments = open(segments_file, 'rb').read()
+  return { "wall": wall, "stages": stages, "max_rss_mb": max_rss_mb(rusage), \
+      "segments_md5": hashlib.md5(segments).hexdigest(), \
+      "num_segments": segments.count(b"\n") }
+
+def benchmark_case(case_dir, options):
+  # The best of --repeat runs: the minimum of the wall time of the whole run
+  # and of each stage, which are the least affected by other load on the
+  # machine
+  result = None
+  for i in range(options.repeat):
+    r = run_case(case_dir, options)
+    if result == None:
+      result = r
+      continue
+    if r["segments_md5"] != result["segments_md5"]:
+      sys.stderr.write("%s: Error: segments of %s differ between runs\n" \
+          % (sys.argv[0], case_dir))
+      sys.exit(1)
+    result["wall"] = min(result["wall"], r["wall"])
+    result["max_rss_mb"] = max(result["max_rss_mb"], r["max_rss_mb"])
+    for stage, wall in r["stages"].items():
+      result["stages"][stage] = min(result["stages"].get(stage, wall), wall)
+  return result
+
+def ratio(value, baseline_value):
+  if baseline_value <= 0:
+    return "-"
+  return "%.2fx" % (float(value) / baseline_value)
+
+def print_case(case, result, baseline):
+  # One line for the case and one for each stage, with the baseline values
+  # and value / baseline if there is a baseline for the case
+  if baseline == None:
+    sys.stdout.write("%-14s %10.3f %10.1f %10d\n" % (case, result["wall"], \
+        result["max_rss_mb"], result["num_segments"]))
+    for stage in sorted(result["stages"], key = lambda s: -result["stages"][s]):
+      sys.stdout.write("  %-24s %10.3f\n" % (stage, result["stages"][stage]))
+    return
+  if baseline["segments_md5"] == result["segments_md5"]:
+    check = "same"
+  else:
+    check = "DIFFERENT"
+  sys.stdout.write("%-14s %10.3f %10s %10.1f %10s %10d %s\n" % (case, \
+      result["wall"], ratio(result["wall"], baseline["wall"]), \
+      result["max_rss_mb"], ratio(result["max_rss_mb"], baseline["max_rss_mb"]), \
+      result["num_segments"], check))
+  for stage in sorted(result["stages"], key = lambda s: -result["stages"][s]):
+    wall = result["stages"][stage]
+    if stage in baseline["stages"]:
+      sys.stdout.write("  %-24s %10.3f %10s\n" % (stage, wall, \
+          ratio(wall, baseline["stages"][stage])))
+    else:
+      sys.stdout.write("  %-24s %10.3f %10s\n" % (stage, wall, "-"))
+
+def main():
+  parser = ArgumentParser(description='Benchmark the segmentation on synthetic predictions')
+  parser.add_argument('--script', type=str, \
+      dest='script', \
+      default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "segmentation_joint.py"), \
+      help="Segmentation script to benchmark")
+  parser.add_argument('--segmentation-opts', type=str, \
+      dest='segmentation_opts', default="", \
+      help="Options for the segmentation script, e.g. \"--engine python\"")
+  parser.add_argument('--durations', type=str, \
+      dest='durations', default="1m,10m,1h,4h,20h", \
+      help="Comma-separated list of the durations of the recordings, " \
+      + "e.g. 90s, 10m or 20h")
+  parser.add_argument('--channels', type=str, \
+      dest='channels', default="single,paired", \
+      help="Comma-separated list of single (one channel) and paired " \
+      + "(two channels, resegmented jointly)")
+  parser.add_argument('--frame-shift', type=float, \
+      dest='frame_shift', default=0.01, \
+      help="Time difference between adjacent frames")
+  parser.add_argument('--seed', type=int, \
+      dest='seed', default=0, \
+      help="Seed for generating the predictions")
+  parser.add_argument('--repeat', type=int, \
+      dest='repeat', default=1, \
+      help="Number of runs of each case, of which the fastest times are reported")
+  parser.add_argument('--baseline', type=str, \
+      dest='baseline', default=None, \
+      help="Compare the segments, times and memory with this baseline " \
+      + "written by --write-baseline")
+  parser.add_argument('--write-baseline', type=str, \
+      dest='write_baseline', default=None, \
+      help="Write the results to this file as JSON, for --baseline")
+  parser.add_argument('--max-slowdown', type=float, \
+      dest='max_slowdown', default=None, \
+      help="Fail if the wall time of a case is more than this times the " \
+      + "baseline, e.g. 1.2")
+  parser.add_argument('args', nargs=1, help='<work_dir>, where the predictions are generated and the segmentation is run')
+  options = parser.parse_args()
+
+  if options.repeat < 1:
+    sys.stderr.write("%s: Error: Invalid value for repeat %d. Must be at least 1.\n" \
+        % (sys.argv[0], options.repeat))
+    sys.exit(1)
+
+  channels = options.channels.split(",")
+  for c in channels:
+    if not ( c == "single" or c == "paired" ):
+      sys.stderr.write("%s: Error: Invalid value for channels %s. Must be single or paired.\n" \
+          % (sys.argv[0], c))
+      sys.exit(1)
+
+  if options.baseline != None:
+    try:
+      baseline = json.load(open(options.baseline))
+    except (IOError, ValueError):
+      sys.stderr.write("%s: Error: Unable to read baseline %s\n" \
+          % (sys.argv[0], options.baseline))
+      sys.exit(1)
+  else:
+    baseline = None
+
+  work_dir = options.args[0]
+  results = {}
+  status = 0
+  if baseline == None:
+    sys.stdout.write("%-14s %10s %10s %10s\n" % ("case", "wall", "max_rss_mb", "segments"))
+  else:
+    sys.stdout.write("%-14s %10s %10s %10s %10s %10s\n" % ("case", "wall", \
+        "vs base", "max_rss_mb", "vs base", "segments"))
+  for seconds in [ parse_duration(d) for d in options.durations.split(",") ]:
+    for c in channels:
+      case = "%s_%s" % (c, duration_name(seconds))
+      case_dir = os.path.join(work_dir, case)
+      generate_case(case_dir, seconds, c == "paired", options, options.seed)
+      result = benchmark_case(case_dir, options)
+      results[case] = result
+
+      if baseline != None and case in baseline["cases"]:
+        case_baseline = baseline["cases"][case]
+        print_case(case, result, case_baseline)
+        if result["segments_md5"] != case_baseline["segments_md5"]:
+          sys.stderr.write("%s: Error: segments of %s differ from the baseline\n" \
+              % (sys.argv[0], case))
+          status = 1
+        if options.max_slowdown != None \
+            and result["wall"] > options.max_slowdown * case_baseline["wall"]:
+          sys.stderr.write("%s: Error: %s is more than %.2f times slower than the baseline\n" \
+              % (sys.argv[0], case, options.max_slowdown))
+          status = 1
+      else:
+        print_case(case, result, None)
+      sys.stdout.flush()
+
+  if options.write_baseline != None:
+    f = open(options.write_baseline, 'w')
+    json.dump({ "script": options.script, \
+        "segmentation_opts": options.segmentation_opts, \
+        "seed": options.seed, "cases": results }, f, indent = 1, sort_keys = True)
+    f.write("\n")
+    f.close()
+
+  sys.exit(status)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,419 @@
+#! /usr/bin/python
+
+# Randomized differential test of the engines of segmentation_joint.py. The
+# reference engine (python, the frame-at-a-time implementation) and the
+# engine under test (by default numpy) are run in this process on the same
+# random predictions and options, covering --min-inter-utt-silence-length,
+# --remove-noise-only-segments, --chunk-length, single and paired
+# recordings, joint and isolated resegmentation and channels that differ in
+# length. They must give the same segments, statistics, warnings and exit
+# status. With --chunk-length, the engine under test must also give the same
+# output, including a failure, as without it.
+# A failing case is shrunk to a minimal one, by removing options, the second
+# channel and frames, and by changing labels to silence, while it still
+# fails, and is printed with the predictions as label strings.
+#
+# As the engines are only compared with each other, both are first checked
+# against the golden cases of --golden-file: random cases (without
+# --chunk-length) with the segments, statistics and exit status of the
+# original segmentation_joint.py. These are written with --write-golden from
+# a copy of the original script, given by --baseline-script, e.g.
+# git show 376b804:egs/babel/s5/local/segmentation_joint.py > baseline.py
+# local/compare_segmentation_engines.py --write-golden 300 --baseline-script \
+#   baseline.py --baseline-python python2.7
+#
+# e.g. local/compare_segmentation_engines.py --num-cases 2000 --seed 1
+
+import os, argparse, sys, random, json, re, shutil, subprocess, tempfile
+from argparse import ArgumentParser
+try:
+  from StringIO import StringIO
+except ImportError:
+  from io import StringIO
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import segmentation_joint
+
+def random_labels(rng, num_frames):
+  # Predictions (a string of 0, 1 and 2) made of runs of a mixture of short
+  # and long lengths, with more silence and speech than noise
+  labels = []
+  n = 0
+  while n < num_frames:
+    l = int(rng.expovariate(1.0 / rng.choice([2, 8, 30, 150]))) + 1
+    labels.append(rng.choice("0001222") * l)
+    n += l
+  return "".join(labels)[0:num_frames]
+
+def random_case(rng, max_frames):
+  # Returns a case (A1, A2, args): the predictions of channel 1, those of
+  # channel 2 or None for a single recording, and the options as a list of
+  # (option, value) pairs where value is None for a flag. The lengths are
+  # mostly short, so that boundary conditions are hit often.
+  num_frames = rng.randint(1, rng.choice([20, 200, max_frames]))
+  A1 = random_labels(rng, num_frames)
+  A2 = None
+  if rng.random() < 0.7:
+    # The second channel is mostly of the same length, but sometimes differs
+    # by more than --max-length-diff
+    diff = rng.choice([0, 0, rng.randint(-10, 10), rng.randint(-300, 300)])
+    A2 = random_labels(rng, max(1, num_frames + diff))
+  args = []
+  if rng.random() < 0.7:
+    args.append(("--silence-proportion", "%.2f" % rng.uniform(0.02, 0.9)))
+  if rng.random() < 0.5:
+    args.append(("--max-segment-length", str(rng.choice([0.05, 0.2, 0.5, 1, 3, 10]))))
+  if rng.random() < 0.5:
+    args.append(("--hard-max-segment-length", str(rng.choice([0.05, 0.2, 0.5, 1, 3, 10]))))
+  if rng.random() < 0.5:
+    args.append(("--min-inter-utt-silence-length", str(rng.choice([0.01, 0.05, 0.2, 1.0]))))
+  if rng.random() < 0.5:
+    args.append(("--remove-noise-only-segments", rng.choice(["true", "false"])))
+  if A2 != None and rng.random() < 0.3:
+    args.append(("--isolated-resegmentation", None))
+  if A2 != None and rng.random() < 0.3:
+    args.append(("--max-length-diff", str(rng.choice([0.0, 0.05, 3.0]))))
+  if rng.random() < 0.2:
+    args.append(("--chunk-length", str(rng.choice([0.05, 0.5, 3]))))
+  return A1, A2, args
+
+def command_line(args):
+  options = []
+  for option, value in args:
+    options.append(option)
+    if value != None:
+      options.append(value)
+  return options
+
+def run_engine(case, engine):
+  # Resegments the case with the engine and returns the segments, the
+  # statistics, the exit status and what was written to stderr, or the
+  # exception if the engine failed
+  A1, A2, args = case
+  options = segmentation_joint.get_parser().parse_args(command_line(args) \
+      + [ "--engine", engine, "-" ])
+  f1 = "case_" + options.channel1_file
+  f2 = "case_" + options.channel2_file
+  if A2 == None:
+    jobs = [ (options, None, f1, list(A1), None, None) ]
+  elif options.isolated_resegmentation:
+    jobs = [ (options, None, f1, list(A1), None, None), \
+        (options, None, f2, list(A2), None, None) ]
+  else:
+    jobs = [ (options, None, f1, list(A1), f2, list(A2)) ]
+
+  stderr = sys.stderr
+  sys.stderr = StringIO()
+  try:
+    result = []
+    for job in jobs:
+      segments, stats, status = segmentation_joint.resegment_recordings(job)
+      result.append((segments, stats.get_counts(), status))
+    result.append(sys.stderr.getvalue())
+  except Exception as e:
+    result = "%s: %s" % (type(e).__name__, e)
+  finally:
+    sys.stderr = stderr
+  return result
+
+def chunk_error(case, options):
+  # For a case with --chunk-length, returns how the output of the test
+  # engine differs from its output without --chunk-length, or None if it
+  # does not
+  A1, A2, args = case
+  if "--chunk-length" not in [ a[0] for a in args ]:
+    return None
+  whole_case = (A1, A2, [ a for a in args if a[0] != "--chunk-length" ])
+  chunked = run_engine(case, options.test_engine)
+  whole = run_engine(whole_case, options.test_engine)
+  if chunked != whole:
+    return "the output differs from that of the whole recordings: %r instead of %r" \
+        % (chunked, whole)
+  return None
+
+def case_error(case, options):
+  # Returns why the case fails, or None if it does not
+  if run_engine(case, options.reference_engine) \
+      != run_engine(case, options.test_engine):
+    return "the %s and %s engines differ" \
+        % (options.reference_engine, options.test_engine)
+  error = chunk_error(case, options)
+  if error != None:
+    return "with --chunk-length, " + error
+  return None
+
+def case_fails(case, options):
+  return case_error(case, options) != None
+
+def shrink(case, options):
+  # Returns a smaller case that still fails (see case_error()), by trying in
+  # turn to remove each option, the second channel, blocks of frames (of
+  # both channels, from half of the frames down to single frames) and to
+  # change each label to silence, until none of these helps
+  A1, A2, args = case
+  changed = True
+  while changed:
+    changed = False
+    candidates = []
+    for i in range(len(args)):
+      candidates.append((A1, A2, args[0:i] + args[i+1:]))
+    if A2 != None:
+      candidates.append((A1, None, [ a for a in args if a[0] != "--isolated-resegmentation" ]))
+      candidates.append((A2, None, [ a for a in args if a[0] != "--isolated-resegmentation" ]))
+    for candidate in candidates:
+      if case_fails(candidate, options):
+        A1, A2, args = candidate
+        changed = True
+        break
+    if changed:
+      continue
+
+    size = max(len(A1), len(A2 or "")) // 2
+    while size > 0 and not changed:
+      start = 0
+      while start < max(len(A1), len(A2 or "")):
+        B1 = A1[0:start] + A1[start+size:]
+        B2 = None
+        if A2 != None:
+          B2 = A2[0:start] + A2[start+size:]
+        if len(B1) > 0 and (B2 == None or len(B2) > 0) \
+            and case_fails((B1, B2, args), options):
+          A1, A2 = B1, B2
+          changed = True
+        else:
+          start += size
+      size = size // 2
+    if changed:
+      continue
+
+    for channel in (1, 2):
+      labels = (A1, A2)[channel - 1]
+      if labels == None:
+        continue
+      for n in range(len(labels)):
+        if labels[n] == "0":
+          continue
+        candidate = labels[0:n] + "0" + labels[n+1:]
+        if channel == 1:
+          candidate = (candidate, A2, args)
+        else:
+          candidate = (A1, candidate, args)
+        if case_fails(candidate, options):
+          A1, A2, args = candidate
+          labels = (A1, A2)[channel - 1]
+          changed = True
+  return A1, A2, args
+
+def print_case(case, options):
+  A1, A2, args = case
+  sys.stdout.write("options: %s\n" % " ".join(command_line(args)))
+  sys.stdout.write("channel 1: %s\n" % A1)
+  if A2 != None:
+    sys.stdout.write("channel 2: %s\n" % A2)
+  sys.stdout.write("error: %s\n" % case_error(case, options))
+  for engine in (options.reference_engine, options.test_engine):
+    sys.stdout.write("%s engine: %r\n" % (engine, run_engine(case, engine)))
+
+def run_length_encode(labels):
+  # Labels as a string of runs "<label>x<length>", e.g. "0x3 2x10" for
+  # "0002222222222", to keep the golden cases short
+  return " ".join([ "%sx%d" % (m.group(0)[0], len(m.group(0))) \
+      for m in re.finditer(r"0+|1+|2+", labels) ])
+
+def run_length_decode(runs):
+  return "".join([ run.split("x")[0] * int(run.split("x")[1]) \
+      for run in runs.split() ])
+
+# The statistics written by segmentation_joint.py with --verbose 1, as named
+# by Stats.get_counts()
+STATS_LINES = { "Inter-utt silence": "inter_utt_silence", \
+    "Merge silence segment": "merge_silence_segment", \
+    "Merge segment": "merge_segments", \
+    "Split segments": "split_segments", \
+    "Noise only": "noise_only", \
+    "Silence only": "silence_only" }
+
+def run_baseline(case, options):
+  # Resegments the case with --baseline-script and returns the sorted lines
+  # of the segments, the statistics as a dict and the exit status
+  A1, A2, args = case
+  temp_dir = tempfile.mkdtemp()
+  try:
+    prediction_dir = os.path.join(temp_dir, "predictions")
+    os.mkdir(prediction_dir)
+    parser = segmentation_joint.get_parser()
+    case_options = parser.parse_args(command_line(args) + [ "-" ])
+    for f, A in ((case_options.channel1_file, A1), (case_options.channel2_file, A2)):
+      if A != None:
+        open(os.path.join(prediction_dir, "case_%s.pred" % f), 'w').write( \
+            "case_%s %s\n" % (f, " ".join(A)))
+    process = subprocess.Popen([ options.baseline_python, options.baseline_script, \
+        "--verbose", "1" ] + command_line(args) + [ prediction_dir ], \
+        stdout = subprocess.PIPE, stderr = subprocess.PIPE, \
+        universal_newlines = True)
+    out, err = process.communicate()
+  finally:
+    shutil.rmtree(temp_dir)
+
+  counts = {}
+  for line in err.splitlines():
+    name = line.split(":")[0]
+    if name in STATS_LINES:
+      counts[STATS_LINES[name]] = int(line.split(":")[1])
+  return sorted(out.splitlines()), counts, process.returncode
+
+def write_golden(options):
+  # Writes --write-golden random cases, without the options that the
+  # original script does not have, with its output to --golden-file
+  if options.baseline_script == None:
+    sys.stderr.write("%s: Error: --write-golden needs --baseline-script\n" % sys.argv[0])
+    sys.exit(1)
+  rng = random.Random(options.seed)
+  golden_file = open(options.golden_file, 'w')
+  for i in range(options.write_golden):
+    A1, A2, args = random_case(rng, options.max_frames)
+    args = [ a for a in args if a[0] != "--chunk-length" ]
+    segments, counts, status = run_baseline((A1, A2, args), options)
+    golden_file.write(json.dumps({ "options": args, \
+        "channel1": run_length_encode(A1), \
+        "channel2": A2 != None and run_length_encode(A2) or None, \
+        "segments": segments, "counts": counts, "status": status }, \
+        sort_keys = True) + "\n")
+  golden_file.close()
+  sys.stdout.write("Wrote %d golden cases to %s\n" \
+      % (options.write_golden, options.golden_file))
+
+def golden_error(golden, engine):
+  # Returns how the output of the engine differs from that of the original
+  # script on the golden case, or None if it does not
+  case = (run_length_decode(golden["channel1"]), \
+      golden["channel2"] != None and run_length_decode(golden["channel2"]) or None, \
+      [ (option, value) for option, value in golden["options"] ])
+  result = run_engine(case, engine)
+  # The original script exits at the first recording without segments,
+  # having written those of the recordings before it in an arbitrary order,
+  # so only the failure is checked
+  if golden["status"] != 0:
+    if isinstance(result, str) or max([ r[2] for r in result[0:-1] ]) != 0:
+      return None
+    return "the original script failed but the %s engine did not" % engine
+  if isinstance(result, str):
+    return "the %s engine failed: %s" % (engine, result)
+  segments = []
+  counts = dict([ (name, 0) for name in golden["counts"] ])
+  for job_segments, job_counts, status in result[0:-1]:
+    if status != 0:
+      return "the %s engine exited with status %d" % (engine, status)
+    for f in job_segments:
+      segments.extend(job_segments[f].splitlines())
+    for name in counts:
+      counts[name] += job_counts[name]
+  if sorted(segments) != golden["segments"]:
+    return "the segments of the %s engine differ from those of the original script" \
+        % engine
+  if counts != golden["counts"]:
+    return "the statistics of the %s engine are %r instead of %r" \
+        % (engine, counts, golden["counts"])
+  return None
+
+# Cases that failed before, which are checked before the random cases, as
+# (channel 1, channel 2, options) with the predictions as runs (see
+# run_length_encode())
+REGRESSION_CASES = [ \
+    # A segment at the start of a chunk that is split although it has
+    # silence in it, which fails as when the recording is resegmented at once
+    ("2x10 0x300 1x7 0x23 2x1 0x19", None, [ ("--hard-max-segment-length", "0.2"), \
+        ("--min-inter-utt-silence-length", "0.2"), ("--chunk-length", "3") ]) ]
+
+def check_regressions(options):
+  # Checks the cases of REGRESSION_CASES, and exits with the first that fails
+  for i, (runs1, runs2, args) in enumerate(REGRESSION_CASES):
+    case = (run_length_decode(runs1), runs2 != None and run_length_decode(runs2) or None, args)
+    error = case_error(case, options)
+    if error != None:
+      sys.stdout.write("Regression case %d: %s\n" % (i, error))
+      print_case(case, options)
+      sys.exit(1)
+  sys.stdout.write("The %s and %s engines agree on %d regression cases\n" \
+      % (options.reference_engine, options.test_engine, len(REGRESSION_CASES)))
+
+def check_golden(options):
+  # Checks both engines on the golden cases of --golden-file, and exits
+  # with the first case that fails
+  num_cases = 0
+  for line in open(options.golden_file):
+    golden = json.loads(line)
+    for engine in (options.reference_engine, options.test_engine):
+      error = golden_error(golden, engine)
+      if error != None:
+        sys.stdout.write("Golden case %d of %s: %s\n" \
+            % (num_cases, options.golden_file, error))
+        sys.stdout.write("options: %s\n" % " ".join(command_line(golden["options"])))
+        sys.stdout.write("channel 1: %s\n" % golden["channel1"])
+        if golden["channel2"] != None:
+          sys.stdout.write("channel 2: %s\n" % golden["channel2"])
+        sys.stdout.write("original script: %r\n" % golden)
+        sys.exit(1)
+    num_cases += 1
+  sys.stdout.write("The %s and %s engines agree with the original script on %d golden cases\n" \
+      % (options.reference_engine, options.test_engine, num_cases))
+
+def main():
+  parser = ArgumentParser(description='Compare the engines of segmentation_joint.py on random cases')
+  parser.add_argument('--num-cases', type=int, \
+      dest='num_cases', default=1000, \
+      help="Number of random cases")
+  parser.add_argument('--seed', type=int, \
+      dest='seed', default=0, \
+      help="Seed for generating the cases")
+  parser.add_argument('--max-frames', type=int, \
+      dest='max_frames', default=3000, \
+      help="Maximum number of frames of the recordings")
+  parser.add_argument('--reference-engine', type=str, \
+      dest='reference_engine', default="python", \
+      help="Engine that gives the reference output")
+  parser.add_argument('--test-engine', type=str, \
+      dest='test_engine', default="numpy", \
+      help="Engine that is compared with the reference engine")
+  parser.add_argument('--no-shrink', dest='shrink', \
+      action='store_false', help="Print failing cases without shrinking them")
+  parser.add_argument('--golden-file', type=str, \
+      dest='golden_file', default=os.path.join(os.path.dirname( \
+      os.path.abspath(__file__)), "segmentation_joint_golden.json"), \
+      help="Golden cases with the output of the original segmentation_joint.py, " \
+      + "one JSON object per line. An empty string skips them.")
+  parser.add_argument('--write-golden', type=int, \
+      dest='write_golden', default=0, \
+      help="Write this many random cases of --seed with the output of " \
+      + "--baseline-script to --golden-file instead of comparing the engines")
+  parser.add_argument('--baseline-script', type=str, \
+      dest='baseline_script', default=None, \
+      help="The original segmentation_joint.py, for --write-golden")
+  parser.add_argument('--baseline-python', type=str, \
+      dest='baseline_python', default="python2.7", \
+      help="Python interpreter of --baseline-script, which needs Python 2")
+  options = parser.parse_args()
+
+  if options.write_golden > 0:
+    write_golden(options)
+    return
+  if options.golden_file != "":
+    check_golden(options)
+  check_regressions(options)
+
+  rng = random.Random(options.seed)
+  for i in range(options.num_cases):
+    case = random_case(rng, options.max_frames)
+    error = case_error(case, options)
+    if error != None:
+      sys.stdout.write("Case %d of seed %d: %s\n" % (i, options.seed, error))
+      if options.shrink:
+        case = shrink(case, options)
+        sys.stdout.write("Shrunk to:\n")
+      print_case(case, options)
+      sys.exit(1)
+  sys.stdout.write("The %s and %s engines agree on %d cases\n" \
+      % (options.reference_engine, options.test_engine, options.num_cases))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,947 @@
+# Code shared by segmentation_joint.py, segmentation_joint_with_analysis.py
+# and segmentation_nonoise_with_analysis.py, which import it from the
+# directory of the scripts.
+
+import os, glob, sys, re, time, struct, math, json, hashlib, heapq, \
+    collections, multiprocessing
+
+import numpy as np
+
+def create_pool(num_jobs):
+  # Returns a process pool of num_jobs processes for run_jobs(), or None to
+  # run the jobs in this process
+  if num_jobs > 1:
+    return multiprocessing.Pool(num_jobs)
+  return None
+
+def run_jobs(jobs, pool, num_jobs, resegment):
+  # Generates the results of the function resegment for the jobs, in order.
+  # With a process pool, at most 2 * num_jobs jobs are queued at a time, so
+  # that an archive of predictions is streamed rather than read at once.
+  if pool == None:
+    for job in jobs:
+      yield resegment(job)
+    return
+  queue = collections.deque()
+  for job in jobs:
+    queue.append(pool.apply_async(resegment, (job,)))
+    if len(queue) >= 2 * num_jobs:
+      yield queue.popleft().get()
+  while len(queue) > 0:
+    yield queue.popleft().get()
+
+def close_pool(pool, status):
+  # Waits for the processes of the pool to exit, after terminating them if a
+  # job failed (status is non-zero)
+  if pool == None:
+    return
+  if status != 0:
+    pool.terminate()
+  else:
+    pool.close()
+  pool.join()
+
+def split_rspecifier(rspecifier):
+  # Returns (type, filename) of a Kaldi rspecifier such as "ark:pred.ark",
+  # "ark,t:-" or "scp:pred.scp", or None if it is not an rspecifier
+  m = re.match(r"^(ark|scp)(,\w+)*:(.*)$", rspecifier)
+  if m == None:
+    return None
+  return m.group(1), m.group(3)
+
+def to_str(s):
+  if not isinstance(s, str):
+    s = s.decode()
+  return s
+
+def read_token(f):
+  # Reads a token terminated by whitespace, e.g. the key of an archive entry.
+  # Returns None at the end of the file.
+  c = f.read(1)
+  while c.isspace():
+    c = f.read(1)
+  token = []
+  while c != b"" and not c.isspace():
+    token.append(c)
+    c = f.read(1)
+  if len(token) == 0:
+    return None
+  return to_str(b"".join(token))
+
+def read_int_vector(f):
+  # Reads a Kaldi int32 vector in binary form (starting with "\0B"), which is
+  # returned as an array, or in text form (the rest of the line), which is
+  # returned as a list of strings
+  c = f.read(1)
+  if c == b"\0":
+    if f.read(1) != b"B":
+      sys.stderr.write("%s: Error: Invalid binary header in archive\n" % sys.argv[0])
+      sys.exit(1)
+    # The size and each of the elements are written as one byte giving the
+    # size of the type (4 for int32) followed by the value
+    header = f.read(5)
+    if len(header) != 5 or header[0:1] != b"\x04":
+      sys.stderr.write("%s: Error: Expected an int32 vector in archive\n" % sys.argv[0])
+      sys.exit(1)
+    size = struct.unpack("<i", header[1:5])[0]
+    data = f.read(5 * size)
+    if len(data) != 5 * size:
+      sys.stderr.write("%s: Error: Unexpected end of archive\n" % sys.argv[0])
+      sys.exit(1)
+    return np.frombuffer(data, dtype = [("size", "i1"), ("value", "<i4")])["value"]
+  if c == b"\n" or c == b"":
+    return []
+  return to_str(c + f.readline()).split()
+
+def read_archive(rspecifier, read_value = None):
+  # Generates the (key, labels) entries of a Kaldi table of int32 vectors,
+  # one entry at a time, from "ark:<archive>" ("ark:-" for the standard
+  # input) or "scp:<scp-file>" where the scp file has lines
+  # <key> <archive>[:<offset>]. Text and binary entries are told apart by
+  # the binary header, so options such as "ark,t:" are not needed. A table
+  # of other types is read with the function read_value, e.g. read_matrix() of
+  # segmentation_joint.py.
+  if read_value == None:
+    read_value = read_int_vector
+  rspecifier_type, filename = split_rspecifier(rspecifier)
+  if rspecifier_type == "ark":
+    if filename == "-":
+      f = getattr(sys.stdin, "buffer", sys.stdin)
+    else:
+      f = open(filename, "rb")
+    while True:
+      key = read_token(f)
+      if key == None:
+        break
+      yield key, read_value(f)
+  else:
+    archives = {}
+    for line in open(filename):
+      fields = line.split()
+      if len(fields) == 0:
+        continue
+      if len(fields) != 2:
+        sys.stderr.write("%s: Error: Invalid line in scp file %s: %s" \
+            % (sys.argv[0], filename, line))
+        sys.exit(1)
+      key, rxfilename = fields
+      m = re.match(r"^(.*):(\d+)$", rxfilename)
+      if m != None:
+        archive, offset = m.group(1), int(m.group(2))
+      else:
+        archive, offset = rxfilename, 0
+      if archive not in archives:
+        archives[archive] = open(archive, "rb")
+      archives[archive].seek(offset)
+      yield key, read_value(archives[archive])
+
+class ArchiveStream:
+  # A file-like reader of a file descriptor for --online, which returns
+  # whatever data has arrived on a pipe instead of waiting for a whole line
+  # or the end of the file. read() is enough for read_token() and
+  # read_int_vector(); read_text_pieces() reads a text vector in pieces.
+  def __init__(self, fd):
+    self.fd = fd
+    self.buffer = b""
+    self.position = 0
+
+  def fill(self):
+    # Waits for more data and returns False at the end of the file
+    data = os.read(self.fd, 65536)
+    if len(data) == 0:
+      return False
+    self.buffer = self.buffer[self.position:] + data
+    self.position = 0
+    return True
+
+  def read(self, n):
+    while len(self.buffer) - self.position < n and self.fill():
+      pass
+    data = self.buffer[self.position:self.position+n]
+    self.position += len(data)
+    return data
+
+  def read_text_pieces(self):
+    # Generates the elements of a text vector (the rest of the line) as lists
+    # of strings, as soon as they are read. An element that may continue in
+    # data that has not arrived yet is kept for the next piece.
+    while True:
+      end = self.buffer.find(b"\n", self.position)
+      if end >= 0:
+        piece = self.buffer[self.position:end]
+        self.position = end + 1
+        yield to_str(piece).split()
+        return
+      end = max(self.buffer.rfind(b" ", self.position), self.position)
+      piece = self.buffer[self.position:end]
+      self.position = end
+      if len(piece) > 0:
+        yield to_str(piece).split()
+      if not self.fill():
+        piece = self.buffer[self.position:]
+        self.position = len(self.buffer)
+        yield to_str(piece).split()
+        return
+
+def read_archive_online(rspecifier):
+  # Generates the entries of a Kaldi archive of int32 vectors for --online,
+  # as (key, labels) for each piece of the labels of an entry as soon as it
+  # is read, and (key, None) at the end of the entry. Text entries are read
+  # in pieces as they arrive, binary entries at once.
+  rspecifier_type, filename = split_rspecifier(rspecifier)
+  if filename == "-":
+    fd = sys.stdin.fileno()
+  else:
+    fd = os.open(filename, os.O_RDONLY)
+  f = ArchiveStream(fd)
+  while True:
+    key = read_token(f)
+    if key == None:
+      break
+    c = f.read(1)
+    f.position -= len(c)
+    if c == b"\0":
+      yield key, read_int_vector(f)
+    else:
+      for labels in f.read_text_pieces():
+        yield key, labels
+    yield key, None
+
+# Whether each byte is whitespace, for parse_labels()
+WHITESPACE = np.zeros(256, dtype=bool)
+WHITESPACE[[ord(c) for c in " \t\n\r\v\f"]] = True
+
+def parse_labels(line):
+  # Returns the labels in a line of a .pred file (without the recording id).
+  # Labels that are single digits, as they always are, are converted straight
+  # from the bytes of the line, since a list of strings would take far more
+  # memory than the array for a long recording.
+  chars = np.frombuffer(line, dtype=np.uint8)
+  space = WHITESPACE[chars]
+  if np.any(~space[1:] & ~space[:-1]):
+    return to_str(line).split()
+  return np.subtract(chars[~space], ord("0"), dtype=np.int32)
+
+def read_predictions(predictions, f):
+  # Returns the predictions of recording f as an array of 0 (silence),
+  # 1 (noise) or 2 (speech). predictions are either the predictions read
+  # from an archive or the path of a .pred file, which is then read in the
+  # worker process.
+  if isinstance(predictions, str):
+    fields = open(predictions, 'rb').readline().split(None, 1)
+    if len(fields) > 1:
+      predictions = parse_labels(fields[1])
+    else:
+      predictions = []
+  A = np.asarray(predictions).astype(np.int32, copy = False)
+  if len(A) > 0 and (A.min() < 0 or A.max() > 2):
+    sys.stderr.write("%s: Error: Invalid prediction for recording %s. Must be 0, 1 or 2.\n" \
+        % (sys.argv[0], f))
+    sys.exit(1)
+  return A
+
+class QuantileSketch:
+  # A mergeable sketch of a distribution of non-negative values, e.g. of
+  # segment lengths, which gives its quantiles with a relative error of at
+  # most relative_accuracy. The values are counted in buckets whose bounds
+  # grow by a factor gamma (and 0 in a bucket of its own), so the memory
+  # does not grow with the number of values, and the sketches of
+  # recordings or worker processes are merged by adding the bucket counts.
+  def __init__(self, relative_accuracy = 0.01):
+    self.gamma = (1.0 + relative_accuracy) / (1.0 - relative_accuracy)
+    self.log_gamma = math.log(self.gamma)
+    self.buckets = {}
+    self.zeros = 0
+    self.count = 0
+    self.sum = 0
+    self.min = None
+    self.max = None
+
+  def add_values(self, values):
+    values = np.asarray(values, dtype=float)
+    if len(values) == 0:
+      return
+    assert ((values >= 0).all())
+    positive = values[values > 0]
+    indices, counts = np.unique(np.ceil(np.log(positive) / self.log_gamma).astype(int), \
+        return_counts = True)
+    for i, c in zip(indices.tolist(), counts.tolist()):
+      self.buckets[i] = self.buckets.get(i, 0) + c
+    self.zeros += len(values) - len(positive)
+    self.count += len(values)
+    self.sum += float(values.sum())
+    if self.min == None or values.min() < self.min:
+      self.min = float(values.min())
+    if self.max == None or values.max() > self.max:
+      self.max = float(values.max())
+
+  def add(self, other):
+    # Merges the sketch other, which must have the same relative accuracy
+    assert (self.gamma == other.gamma)
+    for i, c in other.buckets.items():
+      self.buckets[i] = self.buckets.get(i, 0) + c
+    self.zeros += other.zeros
+    self.count += other.count
+    self.sum += other.sum
+    if other.count > 0:
+      if self.min == None or other.min < self.min:
+        self.min = other.min
+      if self.max == None or other.max > self.max:
+        self.max = other.max
+
+  def quantile(self, q):
+    if self.count == 0:
+      return 0
+    rank = q * (self.count - 1)
+    if rank < self.zeros:
+      return 0
+    n = self.zeros
+    for i in sorted(self.buckets):
+      n += self.buckets[i]
+      if n > rank:
+        # The middle of the bucket (gamma^(i-1), gamma^i]
+        value = 2.0 * self.gamma ** i / (self.gamma + 1.0)
+        return min(max(value, self.min), self.max)
+    return self.max
+
+  def histogram(self):
+    # Returns the counts of the non-empty buckets as [lower, upper, count]
+    # lists, in increasing order of the values
+    buckets = []
+    if self.zeros > 0:
+      buckets.append([0, 0, self.zeros])
+    for i in sorted(self.buckets):
+      buckets.append([self.gamma ** (i - 1), self.gamma ** i, self.buckets[i]])
+    return buckets
+
+  def summary(self):
+    if self.count == 0:
+      return { "count": 0 }
+    return { "count": self.count, "min": self.min, "max": self.max, \
+        "mean": self.sum / self.count, \
+        "percentile25": self.quantile(0.25), \
+        "percentile50": self.quantile(0.5), \
+        "percentile75": self.quantile(0.75), \
+        "percentile95": self.quantile(0.95) }
+
+# The classes of the frames of the hypothesis, as numbered by the
+# hypothesis_classes() of the resegmenters
+CLASS_NAMES = ("silence", "noise", "speech")
+
+def class_run_lengths(classes):
+  # Returns the lengths of the runs of each class in the array classes (see
+  # CLASS_NAMES) as a list of a list of lengths for each class
+  classes = np.asarray(classes)
+  if len(classes) == 0:
+    return [ [] for name in CLASS_NAMES ]
+  ends = np.append(np.flatnonzero(classes[1:] != classes[:-1]) + 1, len(classes))
+  lengths = np.diff(np.append(0, ends))
+  run_classes = classes[ends - 1]
+  return [ lengths[run_classes == k].tolist() for k in range(0, len(CLASS_NAMES)) ]
+
+class Metrics:
+  # Segmentation metrics for --metrics-file, which is written as JSON lines:
+  # one line for each recording as it is resegmented, and a summary of the
+  # corpus at the end. The segment lengths, the lengths of the runs of each
+  # class of the hypothesis and the Analysis statistics are accumulated in
+  # QuantileSketches across the recordings, and add() merges the Metrics of
+  # a worker process. The per-recording lines are kept in records until they
+  # are written out by write_records().
+  def __init__(self):
+    self.records = []
+    self.num_recordings = 0
+    self.num_frames = 0
+    self.num_segments = 0
+    self.segment_lengths = QuantileSketch()
+    self.class_lengths = [ QuantileSketch() for name in CLASS_NAMES ]
+    # The Analysis results for each prefix: the confusion counts, and sketches
+    # of the lengths and of the reference class counts of each confusion type
+    self.analyses = {}
+
+  def add_recording(self, file_id, num_frames, segments, class_lengths, \
+      analyses = []):
+    # class_lengths are the lengths of the runs of each class of the
+    # hypothesis (see class_run_lengths())
+    lengths = [ end - start for start, end in segments ]
+    recording_lengths = QuantileSketch()
+    recording_lengths.add_values(lengths)
+    recording_class_lengths = [ QuantileSketch() for name in CLASS_NAMES ]
+    for k in range(0, len(CLASS_NAMES)):
+      recording_class_lengths[k].add_values(class_lengths[k])
+      self.class_lengths[k].add(recording_class_lengths[k])
+    record = { "recording": file_id, "num_frames": num_frames, \
+        "num_segments": len(segments), \
+        "segment_length": recording_lengths.summary(), \
+        "class_length": dict(zip(CLASS_NAMES, \
+            [ s.summary() for s in recording_class_lengths ])) }
+    if len(analyses) > 0:
+      record["analysis"] = dict([ (a.prefix, a.confusion_matrix) for a in analyses ])
+    for a in analyses:
+      self.add_analysis(a)
+    self.records.append(record)
+    self.num_recordings += 1
+    self.num_frames += num_frames
+    self.num_segments += len(segments)
+    self.segment_lengths.add(recording_lengths)
+
+  def add_analysis(self, a):
+    if a.prefix not in self.analyses:
+      self.analyses[a.prefix] = { "confusion": [0] * 9, \
+          "length": [ QuantileSketch() for i in range(0,9) ], \
+          "type_stats": [ [ QuantileSketch() for i in range(0,9) ] \
+              for j in range(0,3) ] }
+    analysis = self.analyses[a.prefix]
+    for i in range(0,9):
+      analysis["confusion"][i] += a.confusion_matrix[i]
+      analysis["length"][i].add_values(a.get_lengths(i))
+      for j in range(0,3):
+        analysis["type_stats"][j][i].add_values(a.type_counts[j][i])
+
+  def add(self, other):
+    self.num_recordings += other.num_recordings
+    self.num_frames += other.num_frames
+    self.num_segments += other.num_segments
+    self.segment_lengths.add(other.segment_lengths)
+    for k in range(0, len(CLASS_NAMES)):
+      self.class_lengths[k].add(other.class_lengths[k])
+    for prefix, other_analysis in other.analyses.items():
+      if prefix not in self.analyses:
+        self.analyses[prefix] = other_analysis
+        continue
+      analysis = self.analyses[prefix]
+      for i in range(0,9):
+        analysis["confusion"][i] += other_analysis["confusion"][i]
+        analysis["length"][i].add(other_analysis["length"][i])
+        for j in range(0,3):
+          analysis["type_stats"][j][i].add(other_analysis["type_stats"][j][i])
+
+  def write_records(self, file_handle):
+    for record in self.records:
+      file_handle.write(json.dumps(record, sort_keys = True) + "\n")
+    self.records = []
+
+  def write_summary(self, file_handle, stats, frame_shift):
+    summary = { "num_recordings": self.num_recordings, \
+        "num_frames": self.num_frames, \
+        "num_segments": self.num_segments, \
+        "frame_shift": frame_shift, \
+        "segment_length": self.segment_lengths.summary(), \
+        "class_length": dict(zip(CLASS_NAMES, \
+            [ s.summary() for s in self.class_lengths ])), \
+        "stats": stats.get_counts() }
+    summary["analysis"] = {}
+    for prefix, analysis in self.analyses.items():
+      summary["analysis"][prefix] = { "confusion": analysis["confusion"], \
+          "length": [ s.summary() for s in analysis["length"] ], \
+          "type_stats": [ [ s.summary() for s in row ] \
+              for row in analysis["type_stats"] ] }
+    file_handle.write(json.dumps({ "corpus": summary }, sort_keys = True) + "\n")
+
+def cpu_time():
+  # The user and system CPU time of this process
+  t = os.times()
+  return t[0] + t[1]
+
+class Timer:
+  # Measures the wall time (interval) and the CPU time (cpu_interval) of a
+  # with block
+  def __enter__(self):
+    self.start = time.time()
+    self.cpu_start = cpu_time()
+    return self
+
+  def __exit__(self, *args):
+    self.end = time.time()
+    self.interval = self.end - self.start
+    self.cpu_interval = cpu_time() - self.cpu_start
+
+class Timing:
+  # Stage timing for --timing-report, which is written as JSON lines like
+  # the Metrics: one line for each recording with the wall and CPU time,
+  # the frames per second and the number of segments before and after each
+  # stage (see JointResegmenter.run_stage()), and a summary at the end. The
+  # summary has the total times of each stage, and histograms of the wall
+  # time and frames per second across the recordings, which are accumulated
+  # in QuantileSketches so that add() can merge the Timing of a worker
+  # process.
+  def __init__(self):
+    self.records = []
+    self.stages = {}
+    self.stage_order = []
+
+  def add_recording(self, file_id, num_frames, stage_times):
+    self.records.append({ "recording": file_id, "num_frames": num_frames, \
+        "stages": stage_times })
+    for s in stage_times:
+      if s["stage"] not in self.stages:
+        self.stages[s["stage"]] = { "count": 0, "wall": 0.0, "cpu": 0.0, \
+            "frames": 0, "wall_histogram": QuantileSketch(0.1), \
+            "frames_per_sec_histogram": QuantileSketch(0.1) }
+        self.stage_order.append(s["stage"])
+      stage = self.stages[s["stage"]]
+      stage["count"] += 1
+      stage["wall"] += s["wall"]
+      stage["cpu"] += s["cpu"]
+      stage["frames"] += num_frames
+      stage["wall_histogram"].add_values([s["wall"]])
+      stage["frames_per_sec_histogram"].add_values([s["frames_per_sec"]])
+
+  def add(self, other):
+    for name in other.stage_order:
+      other_stage = other.stages[name]
+      if name not in self.stages:
+        self.stages[name] = other_stage
+        self.stage_order.append(name)
+        continue
+      stage = self.stages[name]
+      for key in ("count", "wall", "cpu", "frames"):
+        stage[key] += other_stage[key]
+      stage["wall_histogram"].add(other_stage["wall_histogram"])
+      stage["frames_per_sec_histogram"].add(other_stage["frames_per_sec_histogram"])
+
+  def write_records(self, file_handle):
+    for record in self.records:
+      file_handle.write(json.dumps(record, sort_keys = True) + "\n")
+    self.records = []
+
+  def write_summary(self, file_handle, wall):
+    summary = { "wall": wall, "stages": [] }
+    for name in self.stage_order:
+      stage = self.stages[name]
+      summary["stages"].append({ "stage": name, "count": stage["count"], \
+          "wall": stage["wall"], "cpu": stage["cpu"], "frames": stage["frames"], \
+          "frames_per_sec": stage["frames"] / max(stage["wall"], 1e-9), \
+          "wall_histogram": stage["wall_histogram"].histogram(), \
+          "wall_quantiles": stage["wall_histogram"].summary(), \
+          "frames_per_sec_histogram": stage["frames_per_sec_histogram"].histogram() })
+    file_handle.write(json.dumps({ "summary": summary }, sort_keys = True) + "\n")
+
+# The frame label of a channel given the predictions of this channel (rows)
+# and of the other channel (columns), where the predictions are 0 (silence),
+# 1 (noise) or 2 (speech). A channel resegmented on its own uses the labels
+# on the diagonal, 0, 4 and 8.
+JOINT_LABELS = np.array([ [0, 1, 2], \
+    [3, 4, 5], \
+    [6, 7, 8] ], dtype=np.int8)
+
+def fuse_channels(A1, A2 = None):
+  # Returns the frame labels for the predictions A1 of a channel resegmented
+  # on its own, or (B1, B2) for the predictions A1 and A2 of two channels
+  # resegmented jointly, where A1 is at least as long as A2. Beyond the end
+  # of A2, the second channel is taken to be silence.
+  if A2 is None:
+    return JOINT_LABELS[A1, A1]
+  n = len(A2)
+  B1 = JOINT_LABELS[A1, 0]
+  B2 = JOINT_LABELS[0, A1]
+  B1[0:n] = JOINT_LABELS[A1[0:n], A2]
+  B2[0:n] = JOINT_LABELS[A2, A1[0:n]]
+  return B1, B2
+
+def read_rttm_file(rttm_file, frame_shift):
+  # Reads the reference RTTM in a single pass into an RttmReference
+  reference = RttmReference()
+  for line in open(rttm_file):
+    splits = line.strip().split()
+    if len(splits) == 0:
+      continue
+    type1 = splits[0]
+    if type1 == "SPEAKER":
+      continue
+    file_id = splits[1]
+    category = splits[6]
+    start_time = int(float(splits[3])/frame_shift + 0.5)
+    duration = int(float(splits[4])/frame_shift + 0.5)
+    c = None
+    if type1 == "NON-LEX":
+      if category == "other":
+        # <no-speech> is taken as Silence
+        c = "0"
+      else:
+        c = "1"
+    if type1 == "LEXEME":
+      c = "2"
+    if type1 == "NON-SPEECH":
+      c = "1"
+    reference.add(file_id, start_time, duration, c)
+  return reference
+
+class RttmReference:
+  # The reference RTTM as a list of (start, end, class) intervals of frames
+  # for each file id, where the class is "0" (silence), "1" (noise) or "2"
+  # (speech). Frames that are not covered by any interval are silence. The
+  # per-frame classes of a file are only produced on demand by get_frames().
+  def __init__(self):
+    self.intervals = {}
+    self.num_frames = {}
+
+  def __contains__(self, file_id):
+    return file_id in self.num_frames
+
+  def add(self, file_id, start, duration, c):
+    # Adds an RTTM entry of class c, or of no class if c is None. The
+    # entries of a file are laid end to end: an entry that starts before
+    # the end of the previous one is moved to start where that one ends.
+    n = self.num_frames.get(file_id, 0)
+    start = max(start, n)
+    if c != None and duration > 0:
+      self.intervals.setdefault(file_id, []).append((start, start + duration, c))
+      start += duration
+    self.num_frames[file_id] = start
+
+  def subset(self, file_ids):
+    # Returns the reference of only the file ids given, e.g. to be sent to a
+    # worker process
+    reference = RttmReference()
+    for f in file_ids:
+      if f in self:
+        reference.intervals[f] = self.intervals.get(f, [])
+        reference.num_frames[f] = self.num_frames[f]
+    return reference
+
+  def get_frames(self, file_id):
+    # Returns the list of the classes of the frames of file_id, or None if
+    # the file is not in the reference
+    if file_id not in self:
+      return None
+    frames = ["0"] * self.num_frames[file_id]
+    for start, end, c in self.intervals.get(file_id, []):
+      frames[start:end] = [c] * (end - start)
+    return frames
+
+def reference_subset(reference, file_ids):
+  if reference == None:
+    return None
+  return reference.subset(file_ids)
+
+def get_reference_frames(reference, file_id):
+  if reference == None:
+    return None
+  return reference.get_frames(file_id)
+
+def class_counts(classes, num_classes):
+  # Returns the cumulative counts of the frames of each class in the array
+  # classes (of 0 to num_classes - 1) as an array of num_classes rows of
+  # len(classes) + 1 counts, so that the number of frames of class k in
+  # [start, end) is counts[k][end] - counts[k][start].
+  counts = np.zeros((num_classes, len(classes) + 1), dtype=np.int32)
+  for k in range(0, num_classes):
+    counts[k, 1:] = np.cumsum(classes == k)
+  return counts
+
+def source_hash(files):
+  # Returns a hash of the source of the Python files, which may be given as
+  # their .pyc files
+  h = hashlib.sha1()
+  for f in files:
+    h.update(open(re.sub(r"\.pyc$", ".py", f), 'rb').read())
+  return h.hexdigest()
+
+def read_cache(cache_file):
+  # Returns the cache entry in cache_file, or None if there is none. The
+  # modification time of the entry is updated, so that the entries that are
+  # used are the last to be evicted (see evict_cache()).
+  try:
+    entry = json.load(open(cache_file))
+  except (IOError, OSError, ValueError):
+    return None
+  try:
+    os.utime(cache_file, None)
+  except OSError:
+    pass
+  return entry
+
+def write_cache(cache_file, entry):
+  # Writes the entry to a temporary file that is then renamed, so that other
+  # processes never read a partly written entry
+  temp_file = "%s.%d.tmp" % (cache_file, os.getpid())
+  try:
+    f = open(temp_file, 'w')
+    json.dump(entry, f)
+    f.close()
+    os.rename(temp_file, cache_file)
+  except (IOError, OSError):
+    sys.stderr.write("%s: Warning: Unable to write cache entry %s\n" \
+        % (sys.argv[0], cache_file))
+
+class WarningLog:
+  # Wraps stderr, keeping a copy of the warnings written to it
+  def __init__(self, stream):
+    self.stream = stream
+    self.warnings = []
+
+  def write(self, text):
+    if ": Warning: " in text:
+      self.warnings.append(text)
+    self.stream.write(text)
+
+  def flush(self):
+    self.stream.flush()
+
+def evict_cache(cache_dir, max_size, max_age):
+  # Removes the cache entries that were last used more than max_age days ago
+  # and then the least recently used entries until the cache is at most
+  # max_size MB. A limit of 0 means no limit.
+  entries = []
+  for cache_file in glob.glob(os.path.join(cache_dir, "*.json")):
+    try:
+      st = os.stat(cache_file)
+    except OSError:
+      continue
+    entries.append((st.st_mtime, st.st_size, cache_file))
+  entries.sort(reverse = True)
+  now = time.time()
+  size = 0
+  for mtime, file_size, cache_file in entries:
+    size += file_size
+    if (max_age > 0 and now - mtime > max_age * 86400) \
+        or (max_size > 0 and size > max_size * 1048576):
+      try:
+        os.remove(cache_file)
+      except OSError:
+        pass
+
+def run_bounds(mask):
+  # Returns the start and end frames of the runs of True values in mask.
+  zero = np.zeros(1, dtype=np.int8)
+  edges = np.diff(np.concatenate((zero, mask.view(np.int8), zero)))
+  return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+
+def padding_order_key(steps, k, position):
+  # The silence padding is defined by sweeps over a list of active frames, one
+  # frame per pass at each of them, where an active frame is moved to the end
+  # of the list whenever it crosses a change in the type of silence. The list
+  # order at pass k is therefore given by the passes (before k) in which each
+  # front crossed a change, latest first, and then by the initial position.
+  return tuple([ s for s in reversed(steps) if s < k ]) + (0, position)
+
+def allocate_padding(gap_starts, gap_ends, N, change_points, num_frames):
+  # Decides how many silence frames (non-speech frames in
+  # segmentation_nonoise_with_analysis.py) are added to the segments on
+  # either side of each silence region [gap_starts[i], gap_ends[i]), so that
+  # num_frames frames are added in total. This gives the same allocation as
+  # frame-at-a-time sweeps, where in each pass every segment boundary next
+  # to silence (a "front") takes one more silence frame, until the target is
+  # reached.
+  # Returns (right, left): the number of frames added after the segment
+  # that ends at gap_starts[i] and before the one that starts at gap_ends[i].
+  lengths = gap_ends - gap_starts
+  has_right = gap_starts > 0
+  has_left = gap_ends < N
+  both = has_right & has_left
+  movers = has_right.astype(int) + has_left
+
+  right = np.zeros(len(lengths), dtype=int)
+  left = np.zeros(len(lengths), dtype=int)
+  if num_frames <= 0 or len(lengths) == 0:
+    return right, left
+
+  def frames_after(k):
+    # Number of frames added after k complete passes
+    return int(np.minimum(lengths, movers * k)[movers > 0].sum())
+
+  # Find the number of complete passes by bisection on the "water level" k
+  if num_frames >= frames_after(int(lengths.max())):
+    num_passes = int(lengths.max())
+    remaining = 0
+  else:
+    lo = 0
+    hi = int(lengths.max())
+    while hi - lo > 1:
+      mid = (lo + hi) // 2
+      if frames_after(mid) < num_frames:
+        lo = mid
+      else:
+        hi = mid
+    num_passes = lo
+    remaining = num_frames - frames_after(lo)
+
+  # The passes at which each front crosses a change in the type of silence.
+  # The first frame taken is always a change from non-silence.
+  lo_change = np.searchsorted(change_points, gap_starts, side='right')
+  hi_change = np.searchsorted(change_points, gap_ends, side='left')
+  def steps(i, is_right):
+    changes = change_points[lo_change[i]:hi_change[i]]
+    if is_right:
+      return [1] + (changes - gap_starts[i] + 1).tolist()
+    return [1] + (gap_ends[i] - changes[::-1] + 1).tolist()
+
+  k = num_passes
+  right[has_right & ~has_left] = np.minimum(lengths, k)[has_right & ~has_left]
+  left[has_left & ~has_right] = np.minimum(lengths, k)[has_left & ~has_right]
+  half = np.minimum(lengths // 2, k)
+  right[both] = half[both]
+  left[both] = half[both]
+  # When the two fronts of an odd-length silence region meet, the one that
+  # comes first in the pass takes the last frame.
+  for i in np.flatnonzero(both & (lengths % 2 == 1) & ((lengths + 1) // 2 <= k)):
+    t = (lengths[i] + 1) // 2
+    if padding_order_key(steps(i, True), t, gap_starts[i]) \
+        < padding_order_key(steps(i, False), t, gap_ends[i]):
+      right[i] += 1
+    else:
+      left[i] += 1
+
+  if remaining > 0:
+    # The last, incomplete pass
+    fronts = []
+    for i in np.flatnonzero(movers * k < lengths):
+      if has_right[i]:
+        fronts.append((padding_order_key(steps(i, True), k + 1, gap_starts[i]), i, True))
+      if has_left[i]:
+        fronts.append((padding_order_key(steps(i, False), k + 1, gap_ends[i]), i, False))
+    fronts.sort()
+    for key, i, is_right in fronts:
+      if right[i] + left[i] == lengths[i]:
+        continue
+      if is_right:
+        right[i] += 1
+      else:
+        left[i] += 1
+      remaining -= 1
+      if remaining == 0:
+        break
+  return right, left
+
+def get_pair(options, f):
+  # Returns the names of the channel 1 and channel 2 recordings of the pair
+  # of recording f
+  channel1_file = options.channel1_file
+  channel2_file = options.channel2_file
+  if re.match(".*_"+channel1_file, f) is None:
+    if re.match(".*_"+channel2_file, f) is None:
+      sys.stderr.write("%s does not match pattern .*_%s or .*_%s\n" \
+          % (f,channel1_file, channel2_file))
+      sys.exit(1)
+    else:
+      f1 = f
+      f2 = f
+      f1 = re.sub("(.*_)"+channel2_file, r"\1"+channel1_file, f1)
+  else:
+    f1 = f
+    f2 = f
+    f2 = re.sub("(.*_)"+channel1_file, r"\1"+channel2_file, f2)
+  return f1, f2
+
+def get_shards(options, predictions):
+  # Returns a dict from each recording to its shard (0 to N-1) for --shard
+  # i/N. The recordings are grouped as they are resegmented, i.e. in pairs
+  # unless --isolated-resegmentation, and each group is weighted by its
+  # number of frames, read from --shard-manifest (lines <recording>
+  # <number of frames>, e.g. from feat-to-len) or else estimated by the
+  # sizes of the .pred files. The groups are assigned, the heaviest first,
+  # to the shard with the fewest frames so far, so that the shards take
+  # about the same time even if the recordings differ in length. This only
+  # depends on the recordings, so all the jobs of an array agree on it.
+  frames = {}
+  if options.shard_manifest != None:
+    for line in open(options.shard_manifest):
+      fields = line.split()
+      if len(fields) == 0:
+        continue
+      if len(fields) != 2 or not fields[1].isdigit():
+        sys.stderr.write("%s: Error: Invalid line in %s: %s" \
+            % (sys.argv[0], options.shard_manifest, line))
+        sys.exit(1)
+      frames[fields[0]] = int(fields[1])
+  else:
+    for f in glob.glob(os.path.join(predictions, "*.pred")):
+      frames[f.split('/')[-1][0:-5]] = os.path.getsize(f)
+
+  groups = {}
+  for f in frames:
+    if options.isolated_resegmentation:
+      group = f
+    else:
+      group = get_pair(options, f)[0]
+    groups.setdefault(group, []).append(f)
+  weights = dict([ (group, sum([ frames[f] for f in groups[group] ])) \
+      for group in groups ])
+
+  num_shards = options.shard[1]
+  loads = [ (0, n) for n in range(num_shards) ]
+  shards = {}
+  for group in sorted(groups, key = lambda group: (-weights[group], group)):
+    load, n = heapq.heappop(loads)
+    for f in groups[group]:
+      shards[f] = n
+    heapq.heappush(loads, (load + weights[group], n))
+  return shards
+
+def get_jobs(options, predictions, reference, read_value = None):
+  # Generates the jobs for resegment_recordings(), i.e. the single recordings
+  # and the pairs of channel 1 and channel 2 recordings. predictions is
+  # either a directory of .pred files or an rspecifier, which is read one
+  # entry at a time (with read_value, see read_archive()). An entry is kept
+  # only until the other channel of its pair is read; the recordings without
+  # the other channel are resegmented on their own at the end. The jobs only
+  # get the part of the reference RTTM for their recordings. With --shard
+  # i/N, only the recordings of shard i (see get_shards()) are resegmented.
+  if split_rspecifier(predictions) != None:
+    entries = read_archive(predictions, read_value)
+  else:
+    entries = sorted([ (f.split('/')[-1][0:-5], f) \
+      for f in glob.glob(os.path.join(predictions, "*.pred")) ])
+
+  if options.shard != None:
+    shards = get_shards(options, predictions)
+
+  pending = {}
+  for f, A in entries:
+    if options.shard != None:
+      if f not in shards:
+        sys.stderr.write("%s: Error: Recording %s not found in %s\n" \
+            % (sys.argv[0], f, options.shard_manifest))
+        sys.exit(1)
+      if shards[f] != options.shard[0] - 1:
+        continue
+    f1, f2 = get_pair(options, f)
+
+    if options.isolated_resegmentation:
+      yield (options, reference_subset(reference, [f]), f, A, None, None)
+      continue
+    if f == f1:
+      other = f2
+    else:
+      other = f1
+    if other in pending:
+      predictions = { f: A, other: pending.pop(other) }
+      yield (options, reference_subset(reference, [f1, f2]), \
+          f1, predictions[f1], f2, predictions[f2])
+    else:
+      pending[f] = A
+  for f in sorted(pending):
+    yield (options, reference_subset(reference, [f]), f, pending[f], None, None)
+
+def add_shard_options(parser):
+  # Adds --shard and --shard-manifest to the ArgumentParser parser (see
+  # get_shards() and check_shard_options())
+  parser.add_argument('--shard', type=str, \
+      dest='shard', default=None, \
+      help="Only resegment shard i of N, given as i/N with i from 1 to N, " \
+      + "e.g. --shard JOB/N in a job array. The shards have about the same " \
+      + "number of frames (see --shard-manifest), with the channels of a " \
+      + "recording in the same shard.")
+  parser.add_argument('--shard-manifest', type=str, \
+      dest='shard_manifest', default=None, \
+      help="With --shard, file with lines <recording> <number of frames> " \
+      + "for all the recordings, e.g. from feat-to-len, by which the shards " \
+      + "are balanced. Required for an rspecifier; by default the sizes of " \
+      + "the .pred files are used.")
+
+def check_shard_options(options):
+  # Checks --shard and --shard-manifest, and converts --shard to (i, N)
+  if options.shard != None:
+    m = re.match(r"^(\d+)/(\d+)$", options.shard)
+    if m == None or not 1 <= int(m.group(1)) <= int(m.group(2)):
+      sys.stderr.write("%s: Error: Invalid value for shard %s. Must be i/N with i from 1 to N.\n" \
+          % (sys.argv[0], options.shard))
+      sys.exit(1)
+    options.shard = (int(m.group(1)), int(m.group(2)))
+    if split_rspecifier(options.args[0]) != None and options.shard_manifest == None:
+      sys.stderr.write("%s: Error: --shard with an rspecifier requires --shard-manifest\n" \
+          % sys.argv[0])
+      sys.exit(1)
+  elif options.shard_manifest != None:
+    sys.stderr.write("%s: Error: --shard-manifest requires --shard\n" % sys.argv[0])
+    sys.exit(1)
@@ -1,76 +1,28 @@
 #! /usr/bin/python
 
-import os, glob, argparse, sys, re, time
+import os, argparse, sys, re, time, struct, heapq, json, cProfile, hashlib, copy
 from argparse import ArgumentParser
+try:
+  from StringIO import StringIO
+except ImportError:
+  from io import StringIO
 
-def read_rttm_file(rttm_file, temp_dir, frame_shift):
-  file_id = None
-  this_file = []
-  ref_file_handle = None
-  reference = {}
-  for line in open(rttm_file).readlines():
-    splits = line.strip().split()
-    type1 = splits[0]
-    if type1 == "SPEAKER":
-      continue
-    if splits[1] != file_id:
-      # A different file_id. Need to open a different file to write
-      if this_file != []:
-        # If this_file is empty, no reference RTTM corresponding to the file_id
-        # is read. This will happen at the start of the file_id. Otherwise it means a
-        # contiguous segment of previous file_id is processed. So write it to the file.
-        # corresponding to the previous file_id
-        try:
-          ref_file_handle.write(' '.join(this_file))
-          # Close the previous file if any
-          ref_file_handle.close()
-          this_file = []
-        except AttributeError:
-          1==1
-
-      file_id = splits[1]
-      if (file_id not in reference):
-        # First time seeing this file_id. Open a new file for writing.
-        reference[file_id] = 1
-        try:
-          ref_file_handle = open(temp_dir+"/"+file_id+".ref", 'w')
-        except IOError:
-          sys.stderr.write("Unable to open " + temp_dir+"/"+file_id+".ref for writing\n")
-          sys.exit(1)
-        ref_file_handle.write(file_id + "\t")
-      else:
-        # This file has been seen before but not in the previous iteration.
-        # The file has already been closed. So open it for append.
-        try:
-          this_file = open(temp_dir+"/"+file_id+".ref").readline().strip().split()[1:]
-          ref_file_handle = open(temp_dir+"/"+file_id+".ref", 'a')
-        except IOError:
-          sys.stderr.write("Unable to open " + temp_dir+"/"+file_id+".ref for appending\n")
-          sys.exit(1)
-
-    i = len(this_file)
-    category = splits[6]
-    word = splits[5]
-    start_time = int(float(splits[3])/frame_shift + 0.5)
-    duration = int(float(splits[4])/frame_shift + 0.5)
-    if i < start_time:
-      this_file.extend(["0"]*(start_time - i))
-    if type1 == "NON-LEX":
-      if category == "other":
-        # <no-speech> is taken as Silence
-        this_file.extend(["0"]*duration)
-      else:
-        this_file.extend(["1"]*duration)
-    if type1 == "LEXEME":
-      this_file.extend(["2"]*duration)
-    if type1 == "NON-SPEECH":
-      this_file.extend(["1"]*duration)
+import numpy as np
 
-  ref_file_handle.write(' '.join(this_file))
-  ref_file_handle.close()
+import segmentation_common
+from segmentation_common import create_pool, run_jobs, close_pool, \
+    split_rspecifier, read_archive_online, read_predictions, \
+    class_run_lengths, Metrics, Timer, Timing, fuse_channels, read_rttm_file, \
+    get_reference_frames, class_counts, source_hash, read_cache, write_cache, \
+    WarningLog, evict_cache, run_bounds, allocate_padding, get_jobs, \
+    add_shard_options, check_shard_options
 
 class Stats:
   def __init__(self):
+    # The Metrics for --metrics-file
+    self.metrics = Metrics()
+    # The Timing for --timing-report
+    self.timing = Timing()
     self.inter_utt_silence = 0
     self.merge_silence_segment = 0
     self.merge_segments = 0
@@ -78,6 +30,30 @@ class Stats:
     self.silence_only = 0
     self.noise_only = 0
 
+  def add(self, other):
+    # Adds the counts from other, e.g. the Stats of a worker process
+    self.metrics.add(other.metrics)
+    self.timing.add(other.timing)
+    self.inter_utt_silence += other.inter_utt_silence
+    self.merge_silence_segment += other.merge_silence_segment
+    self.merge_segments += other.merge_segments
+    self.split_segments += other.split_segments
+    self.silence_only += other.silence_only
+    self.noise_only += other.noise_only
+
+  def add_counts(self, counts):
+    # Adds counts as returned by get_counts(), e.g. from the cache
+    for key, value in counts.items():
+      setattr(self, key, getattr(self, key) + value)
+
+  def get_counts(self):
+    return { "inter_utt_silence": self.inter_utt_silence, \
+        "merge_silence_segment": self.merge_silence_segment, \
+        "merge_segments": self.merge_segments, \
+        "split_segments": self.split_segments, \
+        "silence_only": self.silence_only, \
+        "noise_only": self.noise_only }
+
   def print_stats(self):
     sys.stderr.write("Inter-utt silence: %d\n" % self.inter_utt_silence)
     sys.stderr.write("Merge silence segment: %d\n" % self.merge_silence_segment)
@@ -86,15 +62,26 @@ class Stats:
     sys.stderr.write("Noise only: %d\n" % self.noise_only)
     sys.stderr.write("Silence only: %d\n" % self.silence_only)
 
-class Timer:
-  def __enter__(self):
-    self.start = time.clock()
-    return self
-  def __exit__(self, *args):
-    self.end = time.clock()
-    self.interval = self.end - self.start
-
 class JointResegmenter:
+  # The transition types of all pairs of frame labels, indexed by
+  # [left label][right label]. This is computed from transition_class()
+  # once per process, by the first resegmenter.
+  TRANSITION_TYPES = None
+
+  # The stages of resegment() in order. With --checkpoint-dir, the state of
+  # the recording is saved after each of them except the last, and with
+  # --start-stage it is loaded from there to resume at the next stage.
+  STAGES = ("get_initial_segments", "set_silence_proportion", "merge", \
+      "split", "remove")
+
+  # The options that each of the STAGES depends on. A checkpoint saved after
+  # a stage is only loaded with the same options for that stage and the
+  # stages before it (see checkpoint_key()).
+  STAGE_OPTIONS = (("frame_shift",), ("silence_proportion",), \
+      ("max_segment_length", "min_inter_utt_silence_length", "merge_order"), \
+      ("hard_max_segment_length",), \
+      ("remove_noise_only_segments", "min_inter_utt_silence_length"))
+
   def __init__(self, A, f, options, stats = None, reference = None):
     self.B = [ i for i in A ]
     self.A = A
@@ -102,17 +89,17 @@ class JointResegmenter:
     self.N = len(A)
     self.S = [False] * self.N
     self.E = [False] * (self.N+1)
-
-    self.options = options
-
-    self.max_frames = int(options.max_segment_length / options.frame_shift)
-    self.hard_max_frames = int(options.hard_max_segment_length / options.frame_shift)
-    self.frame_shift = options.frame_shift
-    self.min_inter_utt_silence_length = int(options.min_inter_utt_silence_length / options.frame_shift)
-    if ( options.remove_noise_only_segments == "false" ):
-      self.remove_noise_segments = False
-    elif ( options.remove_noise_only_segments == "true" ):
-      self.remove_noise_segments = True
+    # The timing of each stage of resegment(), see run_stage()
+    self.stage_times = []
+    # The silence padding for set_given_padding(), or None to add padding
+    # for the silence proportion with set_silence_proportion()
+    self.padding = None
+    # The frame of the recording at which the frames A start (that of the
+    # chunk with --chunk-length), so that the checks at the start of the
+    # recording are done as when it is resegmented at once
+    self.frame_offset = 0
+
+    self.set_options(options)
 
     self.THIS_SILENCE = ("0","1","2")
     self.THIS_SPEECH = ("6", "7", "8")
@@ -125,12 +112,43 @@ class JointResegmenter:
     self.THIS_SILENCE_CONVERT = ("9","10","11")
     self.THIS_SILENCE_PLUS = self.THIS_SILENCE + self.THIS_SILENCE_CONVERT
 
+    if JointResegmenter.TRANSITION_TYPES == None:
+      labels = [ str(i) for i in range(0, 12) ]
+      JointResegmenter.TRANSITION_TYPES = [ [ self.transition_class(a, b) \
+          for b in labels ] for a in labels ]
+
     if stats != None:
       self.stats = stats
 
     if reference != None:
       self.reference = reference
 
+  def set_options(self, options):
+    self.options = options
+
+    self.max_frames = int(options.max_segment_length / options.frame_shift)
+    self.hard_max_frames = int(options.hard_max_segment_length / options.frame_shift)
+    self.frame_shift = options.frame_shift
+    self.min_inter_utt_silence_length = int(options.min_inter_utt_silence_length / options.frame_shift)
+    if ( options.remove_noise_only_segments == "false" ):
+      self.remove_noise_segments = False
+    elif ( options.remove_noise_only_segments == "true" ):
+      self.remove_noise_segments = True
+
+  def fork(self, options, stats):
+    # Returns a copy of this resegmenter with its own options, stats and
+    # segments, so that the later stages can be run for several
+    # configurations from the state after the earlier ones (see
+    # sweep_channel())
+    r = copy.copy(self)
+    r.set_options(options)
+    r.stats = stats
+    r.stage_times = []
+    r.A = list(self.A)
+    r.S = list(self.S)
+    r.E = list(self.E)
+    return r
+
   def restrict(self, N):
     self.B = self.B[0:N]
     self.A = self.A[0:N]
@@ -140,30 +158,174 @@ class JointResegmenter:
       self.E[N] = True
     self.N = N
 
-  def resegment(self):
-    with Timer() as t:
-      self.get_initial_segments()
-    if self.options.verbose > 0:
-      sys.stderr.write("get_initial_segments took %f sec\n" % t.interval)
+  def run_stage(self, name, stage):
+    # Runs a stage of the resegmentation, e.g. self.merge_segments, and adds
+    # its wall and CPU time, frames per second and number of segments before
+    # and after it to self.stage_times. With --profile-dir, the stage is also
+    # run under cProfile and the profile is dumped to
+    # <profile-dir>/<recording>.<stage>.prof.
+    segments_in = self.num_segments()
     with Timer() as t:
-      self.set_silence_proportion()
-    if self.options.verbose > 0:
-      sys.stderr.write("set_silence_proportion took %f sec\n" % t.interval)
-    with Timer() as t:
-      self.merge_segments()
-    if self.options.verbose > 0:
-      sys.stderr.write("merge took %f sec\n" % t.interval)
-    with Timer() as t:
-      self.split_long_segments()
+      if self.options.profile_dir != None:
+        profile = cProfile.Profile()
+        try:
+          profile.runcall(stage)
+        finally:
+          profile.dump_stats(os.path.join(self.options.profile_dir, \
+              "%s.%s.prof" % (self.file_id, name)))
+      else:
+        stage()
+    self.stage_times.append({ "stage": name, "wall": t.interval, \
+        "cpu": t.cpu_interval, \
+        "frames_per_sec": self.N / max(t.interval, 1e-9), \
+        "segments_in": segments_in, "segments_out": self.num_segments() })
     if self.options.verbose > 0:
-      sys.stderr.write("split took %f sec\n" % t.interval)
+      sys.stderr.write("%s took %f sec\n" % (name, t.interval))
+    if self.options.checkpoint_dir != None and name in self.STAGES[:-1]:
+      self.save_checkpoint(name)
+
+  def checkpoint_file(self, stage):
+    return os.path.join(self.options.checkpoint_dir, \
+        "%s.%s.npz" % (self.file_id, stage))
+
+  def checkpoint_key(self, stage):
+    # The key of the checkpoint after the stage: a hash of the code version,
+    # the recording, its frame labels and the options of the stages up to
+    # this one, so that a checkpoint of other predictions or options is not
+    # loaded
+    options = []
+    for stage_options in self.STAGE_OPTIONS[0:self.STAGES.index(stage)+1]:
+      options += [ getattr(self.options, o) for o in stage_options ]
+    key = hashlib.sha1()
+    key.update(CODE_VERSION.encode())
+    key.update(json.dumps([ self.file_id ] + options).encode())
+    key.update(np.asarray(self.B).astype(np.int8).tobytes())
+    return key.hexdigest()
+
+  def save_checkpoint(self, stage):
+    # Saves the frame labels and segments after the stage, and the counts of
+    # the Stats added by the stages of this recording so far, to
+    # <checkpoint-dir>/<recording>.<stage>.npz together with its key (see
+    # checkpoint_key())
+    A, starts, ends = self.get_state()
+    counts = self.stats.get_counts()
+    try:
+      np.savez_compressed(open(self.checkpoint_file(stage), 'wb'), \
+          key = np.array(self.checkpoint_key(stage)), A = A, \
+          starts = np.array(starts, dtype = np.int32), \
+          ends = np.array(ends, dtype = np.int32), \
+          counts = np.array([ counts[key] - self.initial_counts[key] \
+              for key in sorted(counts) ], dtype = np.int64))
+    except IOError:
+      sys.stderr.write("%s: Error: Unable to write checkpoint %s\n" \
+          % (sys.argv[0], self.checkpoint_file(stage)))
+      sys.exit(1)
+
+  def load_checkpoint(self, stage):
+    # Restores the state saved by save_checkpoint() after the stage. Returns
+    # False, without loading it, if the checkpoint has another key, i.e. it
+    # was saved for other predictions or options or by another version of
+    # the code.
+    try:
+      checkpoint = np.load(open(self.checkpoint_file(stage), 'rb'))
+      A = checkpoint["A"]
+      starts = checkpoint["starts"]
+      ends = checkpoint["ends"]
+      counts = checkpoint["counts"]
+      key = str(checkpoint["key"]) if "key" in checkpoint.files else None
+    except (IOError, ValueError, KeyError):
+      sys.stderr.write("%s: Error: Unable to read checkpoint %s\n" \
+          % (sys.argv[0], self.checkpoint_file(stage)))
+      sys.exit(1)
+    if key != self.checkpoint_key(stage):
+      sys.stderr.write("%s: Warning: Checkpoint %s does not match the predictions, options or code of this run. Resegmenting recording %s from the first stage.\n" \
+          % (sys.argv[0], self.checkpoint_file(stage), self.file_id))
+      return False
+    self.set_state(A, starts.tolist(), ends.tolist())
+    self.stats.add_counts(dict(zip(sorted(self.initial_counts), counts.tolist())))
+    return True
+
+  def get_state(self):
+    # Returns the frame labels as an int8 array and the start and end frames
+    # of the segments
+    values = dict([ (str(i), i) for i in range(0, 12) ])
+    A = np.fromiter(map(values.__getitem__, self.A), np.int8, self.N)
+    S = np.fromiter(self.S, bool, self.N)
+    E = np.fromiter(self.E, bool, self.N + 1)
+    return A, np.flatnonzero(S).tolist(), np.flatnonzero(E).tolist()
+
+  def set_state(self, A, starts, ends):
+    labels = np.array([ str(i) for i in range(0, 12) ])
+    self.A = labels[A].tolist()
+    self.S = [False] * self.N
+    self.E = [False] * (self.N+1)
+    for n in starts:
+      self.S[n] = True
+    for n in ends:
+      self.E[n] = True
+
+  def num_segments(self):
+    return sum(self.S)
+
+  def resegment(self):
+    # With --start-stage, the state before that stage is loaded from
+    # --checkpoint-dir and the stages before it are skipped
+    self.initial_counts = self.stats.get_counts()
+    start = self.STAGES.index(self.options.start_stage)
+    if start > 0 and not self.load_checkpoint(self.STAGES[start - 1]):
+      start = 0
+    if start == 0:
+      self.run_stage("get_initial_segments", self.get_initial_segments)
+    if start <= 1:
+      self.pad_segments()
+    else:
+      self.count_classes()
+    self.merge_and_split_segments(start)
+
+  def pad_segments(self):
+    # The stages that depend on --silence-proportion but not on the options
+    # of the later stages
+    if self.padding != None:
+      self.run_stage("set_silence_proportion", self.set_given_padding)
+    else:
+      self.run_stage("set_silence_proportion", self.set_silence_proportion)
+    # The labels of the frames do not change after this, so the frames of
+    # each class are counted once for the later stages
+    self.run_stage("count_classes", self.count_classes)
+
+  def merge_and_split_segments(self, start = 2):
+    # The stages that depend on the options of the merging and splitting of
+    # the segments, starting at STAGES[start]
+    if start <= 2:
+      self.run_stage("merge", self.merge_segments)
+    if start <= 3:
+      self.run_stage("split", self.split_long_segments)
     if self.remove_noise_segments:
-      with Timer() as t:
-        self.remove_noise_only_segments()
-      if self.options.verbose > 0:
-        sys.stderr.write("remove took %f sec\n" % t.interval)
+      self.run_stage("remove", self.remove_noise_only_segments)
     elif self.min_inter_utt_silence_length > 0.0:
-      self.remove_silence_only_segments()
+      self.run_stage("remove", self.remove_silence_only_segments)
+
+  def hypothesis_classes(self):
+    # Returns the class of every frame in the hypothesis as an array, where
+    # 0 is silence, 1 is noise and 2 is speech
+    A = np.array(self.A)
+    H = np.ones(self.N, dtype=np.int8)
+    H[np.isin(A, self.THIS_SILENCE)] = 0
+    H[np.isin(A, self.THIS_SPEECH)] = 2
+    return H
+
+  def count_classes(self):
+    # Cumulative counts of the silence, noise and speech frames in the
+    # hypothesis (see class_counts())
+    self.hyp_counts = class_counts(self.hypothesis_classes(), 3)
+
+  def get_segment_bounds(self):
+    # Returns the start and end frames of the segments as arrays
+    starts = np.flatnonzero(self.S)
+    ends = np.flatnonzero(self.E)
+    assert (len(starts) == len(ends))
+    assert ((starts < ends).all() and (ends[:-1] <= starts[1:]).all())
+    return starts, ends
 
   def get_initial_segments(self):
     for i in range(0, self.N):
@@ -197,26 +359,9 @@ class JointResegmenter:
     assert(sum(self.S) == sum(self.E))
 
   def set_silence_proportion(self):
-    num_nonsil_frames = 0
-    in_segment = False
-
-    # Active frames are the frames that are either segment starts
-    # or segment ends
-    active_frames = []
-    for n in range(0, self.N + 1):
-      if self.E[n]:
-        assert(in_segment)
-        in_segment = False
-        active_frames.append(n)
-      if n < self.N and self.S[n]:
-        assert(not in_segment)
-        in_segment = True
-        active_frames.append(n)
-      if n < self.N:
-        if in_segment:
-          # Count the number of non silence frames
-          num_nonsil_frames += 1
-    assert (not in_segment)
+    B = np.array(self.B)
+    silence = np.isin(B, self.THIS_SILENCE)
+    num_nonsil_frames = self.N - int(np.count_nonzero(silence))
     if num_nonsil_frames == 0:
       sys.stderr.write("%s: Warning: no segments found for recording %s\n" % (sys.argv[0], self.file_id))
 
@@ -225,62 +370,49 @@ class JointResegmenter:
     # is computed as below:
     target_segment_frames = int(num_nonsil_frames / (1.0 - self.options.silence_proportion))
 
-    # The number of frames currently in the segments
-    num_segment_frames = num_nonsil_frames
-
-    while num_segment_frames < target_segment_frames:
-      changed = False
-      for i in range(0, len(active_frames)):
-        # At each active frame, try include a silence frame into
-        # segment. Thus padding the non-silence segments with some
-        # silence frames. These converted silence frames are
-        # labelled 9, 10 or 11 depending on whether they were originally
-        # 0, 1 or 2 respectively
-        n = active_frames[i]
-        if self.E[n] and n < self.N and not self.S[n]:
-          # This must be the beginning of a silence region.
-          # Include some of this silence in the segments
-          assert (self.A[n] in self.THIS_SILENCE)
-
-          # Convert the silence frame to be included in segment
-          self.A[n] = str(int(self.B[n]) + 9)
-          if self.B[n-1] != self.B[n]:
-            # In this frame there is a transition from
-            # one type of silence (0, 1 or 2) to another
-            # So its the start of a segment. Also add it to the
-            # end of the active frames list
-            self.S[n] = True
-            active_frames.append(n+1)
-          else:
-            # We need to extend the segment end since we have
-            # included a silence frame. Remove the current segment end mark
-            # and one to the next frame
-            self.E[n] = False
-            active_frames[i] = n + 1
-          self.E[n+1] = True
-          # Increment the number of frames in the segments
-          num_segment_frames += 1
-          changed = True
-        if n < self.N and self.S[n] and n > 0 and not self.E[n]:
-          assert (self.A[n-1] in self.THIS_SILENCE)
-          self.A[n-1] = str(int(self.B[n-1]) + 9)
-          if self.B[n-1] != self.B[n]:
-            self.E[n] = True
-            active_frames.append(n-1)
-          else:
-            self.S[n] = False
-            active_frames[i] = n - 1
-          self.S[n-1] = True
-          num_segment_frames += 1
-          changed = True
-        if num_segment_frames >= target_segment_frames:
-          break
-      if not changed:   # avoid an infinite loop. if no changes, then break.
-        break
+    # The silence regions between the segments and the frames inside them
+    # where the type of silence (0, 1 or 2) changes. The padding of each
+    # region is allocated at once by allocate_padding() instead of adding
+    # one frame at each segment boundary per sweep.
+    gap_starts, gap_ends = run_bounds(silence)
+    change_points = np.flatnonzero(silence[1:] & silence[:-1] & (B[1:] != B[:-1])) + 1
+
+    right, left = allocate_padding(gap_starts, gap_ends, self.N, change_points, \
+        target_segment_frames - num_nonsil_frames)
+    num_segment_frames = num_nonsil_frames + int(right.sum() + left.sum())
+    self.add_padding(gap_starts, gap_ends, change_points, right, left)
+
     if num_segment_frames < target_segment_frames:
       proportion = float(num_segment_frames - num_nonsil_frames) / num_segment_frames
       sys.stderr.write("%s: Warning: for recording %s, only got a proportion %f of silence frames, versus target %f\n" % (sys.argv[0], self.file_id, proportion, self.options.silence_proportion))
 
+  def add_padding(self, gap_starts, gap_ends, change_points, right, left):
+    # Adds right[i] silence frames to the end of the segment before the
+    # silence region [gap_starts[i], gap_ends[i]) and left[i] frames to the
+    # start of the one after it, as allocated by allocate_padding(). The
+    # frames are converted to 9, 10 or 11 depending on whether they were
+    # originally 0, 1 or 2, and where the type of silence changes, a new
+    # segment is started.
+    for g, h, r, l in zip(gap_starts.tolist(), gap_ends.tolist(), right.tolist(), left.tolist()):
+      for start, end in ((g, g + r), (h - l, h)):
+        if end == start:
+          continue
+        for n in range(start, end):
+          self.A[n] = str(int(self.B[n]) + 9)
+          if n == start or self.B[n-1] != self.B[n]:
+            self.S[n] = True
+            if n > start:
+              self.E[n] = True
+        self.E[end] = True
+
+  def set_given_padding(self):
+    # Adds the silence padding in self.padding, which is
+    # (gap_starts, gap_ends, change_points, right, left) as for add_padding(),
+    # instead of the padding for the silence proportion of these frames. This
+    # is used for the chunks of --chunk-length, whose padding is allocated
+    # for the whole recording.
+    self.add_padding(*self.padding)
+
   def set_silence_proportion_slow(self):
     n = 0
     while n < self.N:
@@ -408,17 +540,17 @@ class JointResegmenter:
         # This is also used to prioritize the merging of the segment
         boundaries.append((segment_ends[j], segment_score, \
             self.transition_type(segment_ends[j])))
-
-        # Sort the boundaries based on segment score
-        boundaries.sort(key = lambda x: x[1])
-        # Then sort based on the type of transition by keeping it still
-        # sorted within each transition type  based on segment score
-        boundaries.sort(key = lambda x: x[2])
         i += 1
         j += 1
       # End if
     # End while loop
 
+    # Sort the boundaries based on segment score
+    boundaries.sort(key = lambda x: x[1])
+    # Then sort based on the type of transition by keeping it still
+    # sorted within each transition type  based on segment score
+    boundaries.sort(key = lambda x: x[2])
+
     # Begin merging of segments by removing the start and end mark
     # at the boundary to be merged
     count = 0
@@ -506,7 +638,7 @@ class JointResegmenter:
           p += 1
         segment_length = p - n
         if segment_length > self.hard_max_frames:
-          assert (n == 0 or not any([ i in self.THIS_SILENCE for i in self.A[n:p]]))
+          assert (n + self.frame_offset == 0 or not any([ i in self.THIS_SILENCE for i in self.A[n:p]]))
           self.stats.split_segments += 1
           num_pieces = int((float(segment_length) / self.hard_max_frames) + 0.99999)
           sys.stderr.write("%s: Warning: for recording %s, " \
@@ -524,72 +656,60 @@ class JointResegmenter:
           n = p - 1
 
   def remove_silence_only_segments(self):
-    for n in range(0, self.N):
-      if self.S[n]:
-        p = n
-        saw_nonsilence = False
-        while p <= self.N:
-          if self.E[p] and p != n:
-            break
-          if p < self.N and self.A[p] not in self.THIS_SILENCE:
-            saw_nonsilence = True
-          p += 1
-        assert (p > self.N or self.E[p])
-        if not saw_nonsilence:
-          self.stats.silence_only += 1
-          self.S[n] = False
-          self.E[p] = False
-        if p - 1 > n:
-          n = p - 1
+    starts, ends = self.get_segment_bounds()
+    silence = self.hyp_counts[0]
+    silence_only = silence[ends] - silence[starts] == ends - starts
+    for n, p in zip(starts[silence_only].tolist(), ends[silence_only].tolist()):
+      self.stats.silence_only += 1
+      self.S[n] = False
+      self.E[p] = False
 
   def remove_noise_only_segments(self):
-    for n in range(0, self.N):
-      if self.S[n]:
-        p = n
-        saw_speech = False
-        while p <= self.N:
-          if self.E[p] and p != n:
-            break
-          if self.A[p] in self.THIS_SPEECH:
-            saw_speech = True
-          p += 1
-        assert (self.E[p])
-        if not saw_speech:
-          self.stats.noise_only += 1
-          self.S[n] = False
-          self.E[p] = False
-        if p - 1 > n:
-          n = p - 1
-
-  def transition_type(self, j):
-    assert (j > 0)
-    assert (self.A[j-1] != self.A[j] or self.A[j] in self.THIS_SILENCE_CONVERT)
-    if self.A[j-1] in (self.THIS_SPEECH_THAT_NOISE + self.THIS_SPEECH_THAT_SIL) and self.A[j] in (self.THIS_SPEECH_THAT_NOISE + self.THIS_SPEECH_THAT_SIL):
+    starts, ends = self.get_segment_bounds()
+    speech = self.hyp_counts[2]
+    noise_only = speech[ends] == speech[starts]
+    for n, p in zip(starts[noise_only].tolist(), ends[noise_only].tolist()):
+      self.stats.noise_only += 1
+      self.S[n] = False
+      self.E[p] = False
+
+  def transition_class(self, a, b):
+    # Returns the type of transition from a frame labelled a to a frame
+    # labelled b, or None if segments are never split between such frames.
+    # The transition type is used to prioritize the merging of segments.
+    if a in (self.THIS_SPEECH_THAT_NOISE + self.THIS_SPEECH_THAT_SIL) and b in (self.THIS_SPEECH_THAT_NOISE + self.THIS_SPEECH_THAT_SIL):
       return 0
-    if self.A[j-1] in self.THIS_SPEECH and self.A[j] in self.THIS_SPEECH:
+    if a in self.THIS_SPEECH and b in self.THIS_SPEECH:
       return 1
-    if self.A[j-1] in (self.THIS_SPEECH + self.THIS_NOISE_THAT_SIL) and self.A[j] in (self.THIS_SPEECH + self.THIS_NOISE_THAT_SIL):
+    if a in (self.THIS_SPEECH + self.THIS_NOISE_THAT_SIL) and b in (self.THIS_SPEECH + self.THIS_NOISE_THAT_SIL):
       return 2
-    if self.A[j-1] in (self.THIS_SPEECH + self.THIS_NOISE_THAT_SIL + self.THIS_NOISE_THAT_NOISE) and self.A[j] in (self.THIS_SPEECH + self.THIS_NOISE_THAT_SIL + self.THIS_NOISE_THAT_NOISE):
+    if a in (self.THIS_SPEECH + self.THIS_NOISE_THAT_SIL + self.THIS_NOISE_THAT_NOISE) and b in (self.THIS_SPEECH + self.THIS_NOISE_THAT_SIL + self.THIS_NOISE_THAT_NOISE):
       return 3
-    if self.A[j-1] in (self.THIS_SPEECH + self.THIS_NOISE_THAT_SIL + self.THIS_NOISE_THAT_NOISE + self.THIS_SIL_THAT_SIL + self.THIS_SIL_THAT_NOISE) and self.A[j] in (self.THIS_SPEECH + self.THIS_NOISE_THAT_SIL + self.THIS_NOISE_THAT_NOISE + self.THIS_SIL_THAT_SIL + self.THIS_SIL_THAT_NOISE):
+    if a in (self.THIS_SPEECH + self.THIS_NOISE_THAT_SIL + self.THIS_NOISE_THAT_NOISE + self.THIS_SIL_THAT_SIL + self.THIS_SIL_THAT_NOISE) and b in (self.THIS_SPEECH + self.THIS_NOISE_THAT_SIL + self.THIS_NOISE_THAT_NOISE + self.THIS_SIL_THAT_SIL + self.THIS_SIL_THAT_NOISE):
       return 4
-    if self.A[j-1] not in self.THIS_SILENCE and self.A[j] not in self.THIS_SILENCE:
+    if a not in self.THIS_SILENCE and b not in self.THIS_SILENCE:
       return 5
-    if self.A[j-1] not in self.THIS_SILENCE and self.A[j] in self.THIS_SILENCE:
+    if a not in self.THIS_SILENCE and b in self.THIS_SILENCE:
       return 6
-    if self.A[j-1] in self.THIS_SILENCE and self.A[j] not in self.THIS_SILENCE:
+    if a in self.THIS_SILENCE and b not in self.THIS_SILENCE:
       return 7
-    assert (False)
+    return None
+
+  def transition_type(self, j):
+    assert (j > 0)
+    assert (self.A[j-1] != self.A[j] or self.A[j] in self.THIS_SILENCE_CONVERT)
+    t = self.TRANSITION_TYPES[int(self.A[j-1])][int(self.A[j])]
+    assert (t != None)
+    return t
 
-  def print_segments(self, out_file_handle = sys.stdout):
+  def get_segments(self):
+    # Returns the list of segments as (start, end) pairs of frames.
     # We also do some sanity checking here.
     segments = []
 
     assert (self.N == len(self.S))
     assert (self.N + 1 == len(self.E))
 
-    max_end_time = 0
     n = 0
     while n < self.N:
       if self.E[n] and not self.S[n]:
@@ -601,29 +721,43 @@ class JointResegmenter:
           p += 1
         assert (p == self.N or self.E[p])
         segments.append((n,p))
-        max_end_time = p
         if p < self.N and self.S[p]:
           n = p - 1
         else:
           n = p
       n += 1
+    return segments
+
+  def print_segments(self, out_file_handle = sys.stdout, frame_offset = 0, num_digits = None, \
+      segments = None):
+    # Prints the segments, or the given list of (start, end) segments of the
+    # recording, with frame_offset added to their frames (for a part of a
+    # recording that starts at frame_offset) and the times in the utterance
+    # ids zero-padded to num_digits digits, by default just enough for the
+    # end of the last segment
+    if segments == None:
+      segments = self.get_segments()
     if len(segments) == 0:
       sys.stderr.write("%s: Warning: no segments for recording %s\n" % (sys.argv[0], self.file_id))
       sys.exit(1)
+    max_end_time = segments[-1][1] + frame_offset
 
     # we'll be printing the times out in hundredths of a second (regardless of the
     # value of $frame_shift), and first need to know how many digits we need (we'll be
     # printing with "%05d" or similar, for zero-padding.
-    max_end_time_hundredths_second = int(100.0 * self.frame_shift * max_end_time)
-    num_digits = 1
-    i = 1
-    while i < max_end_time_hundredths_second:
-      i *= 10
-      num_digits += 1
+    if num_digits == None:
+      max_end_time_hundredths_second = int(100.0 * self.frame_shift * max_end_time)
+      num_digits = 1
+      i = 1
+      while i < max_end_time_hundredths_second:
+        i *= 10
+        num_digits += 1
     format_str = r"%0" + "%d" % num_digits + "d" # e.g. "%05d"
 
     for start, end in segments:
       assert (end > start)
+      start += frame_offset
+      end += frame_offset
       start_seconds = "%.2f" % (self.frame_shift * start)
       end_seconds = "%.2f" % (self.frame_shift * end)
       start_str = format_str % (start * self.frame_shift * 100.0)
@@ -632,7 +766,1139 @@ class JointResegmenter:
       # Output:
       out_file_handle.write("%s %s %s %s\n" % (utterance_id, self.file_id, start_seconds, end_seconds))
 
-def main():
+def label_table(*labels):
+  # Boolean lookup table over the 12 frame labels (0..11) used by the
+  # resegmenter. table[A] gives the class membership of every frame at once.
+  table = np.zeros(12, dtype=bool)
+  table[list(labels)] = True
+  return table
+
+class SegmentList:
+  # The segments of a recording, as a doubly-linked list of intervals
+  # [start, end) sorted by time. Node i has the frames start[i] and end[i]
+  # and the indices prev[i] and next[i] of its neighbours (-1 at either end
+  # of the list). The nodes can also be looked up by their start or end
+  # frame, so merging, splitting and removing segments take O(1) time per
+  # segment instead of a search through the frames for the segment markers.
+  # This is the segment store of NumpyJointResegmenter, the default engine.
+  def __init__(self, starts, ends):
+    self.start = [ int(n) for n in starts ]
+    self.end = [ int(n) for n in ends ]
+    assert (len(self.start) == len(self.end))
+    num_nodes = len(self.start)
+    self.prev = list(range(-1, num_nodes - 1))
+    self.next = list(range(1, num_nodes)) + [-1] * min(num_nodes, 1)
+    self.head = 0 if num_nodes > 0 else -1
+    self.tail = num_nodes - 1
+    self.by_start = dict(zip(self.start, range(num_nodes)))
+    self.by_end = dict(zip(self.end, range(num_nodes)))
+    self.size = num_nodes
+
+  def copy(self):
+    other = copy.copy(self)
+    other.start = list(self.start)
+    other.end = list(self.end)
+    other.prev = list(self.prev)
+    other.next = list(self.next)
+    other.by_start = dict(self.by_start)
+    other.by_end = dict(self.by_end)
+    return other
+
+  def markers(self, N):
+    # Returns the segment start and end markers S and E as boolean arrays
+    S = np.zeros(N, dtype=bool)
+    E = np.zeros(N+1, dtype=bool)
+    nodes = list(self)
+    S[[ self.start[i] for i in nodes ]] = True
+    E[[ self.end[i] for i in nodes ]] = True
+    return S, E
+
+  def __len__(self):
+    return self.size
+
+  def __iter__(self):
+    # Iterates over the nodes in order of time
+    i = self.head
+    while i != -1:
+      yield i
+      i = self.next[i]
+
+  def intervals(self):
+    return [ (self.start[i], self.end[i]) for i in self ]
+
+  def starting_at(self, n):
+    return self.by_start.get(n, -1)
+
+  def ending_at(self, n):
+    return self.by_end.get(n, -1)
+
+  def unlink(self, i):
+    if self.prev[i] != -1:
+      self.next[self.prev[i]] = self.next[i]
+    else:
+      self.head = self.next[i]
+    if self.next[i] != -1:
+      self.prev[self.next[i]] = self.prev[i]
+    else:
+      self.tail = self.prev[i]
+    self.size -= 1
+
+  def remove(self, i):
+    del self.by_start[self.start[i]]
+    del self.by_end[self.end[i]]
+    self.unlink(i)
+
+  def merge_next(self, i):
+    # Merges node i with the node that follows it. Node i is kept.
+    j = self.next[i]
+    del self.by_end[self.end[i]]
+    del self.by_start[self.start[j]]
+    self.end[i] = self.end[j]
+    self.by_end[self.end[i]] = i
+    self.unlink(j)
+
+  def insert_after(self, i, start, end):
+    j = len(self.start)
+    self.start.append(start)
+    self.end.append(end)
+    self.prev.append(i)
+    self.next.append(self.next[i])
+    if self.next[i] != -1:
+      self.prev[self.next[i]] = j
+    else:
+      self.tail = j
+    self.next[i] = j
+    self.by_start[start] = j
+    self.by_end[end] = j
+    self.size += 1
+    return j
+
+  def split(self, i, points):
+    # Splits node i at the frames in points, which must be inside it and in
+    # increasing order. Returns the nodes of the pieces in order.
+    end = self.end[i]
+    del self.by_end[end]
+    nodes = [i]
+    for n in points:
+      self.end[nodes[-1]] = n
+      self.by_end[n] = nodes[-1]
+      nodes.append(self.insert_after(nodes[-1], n, end))
+    return nodes
+
+  def restrict(self, N):
+    # Removes the segments after frame N and truncates the one across it
+    while self.tail != -1 and self.start[self.tail] >= N:
+      self.remove(self.tail)
+    if self.tail != -1 and self.end[self.tail] > N:
+      del self.by_end[self.end[self.tail]]
+      self.end[self.tail] = N
+      self.by_end[N] = self.tail
+
+def segments_from_markers(S, E):
+  # Builds a SegmentList from boolean arrays of segment start and end markers
+  return SegmentList(np.flatnonzero(S).tolist(), np.flatnonzero(E).tolist())
+
+class NumpyJointResegmenter(JointResegmenter):
+  # Same algorithm as JointResegmenter, but the frame labels A and B are
+  # stored as int8 NumPy arrays and the label classes are boolean lookup
+  # tables instead of tuples of strings, and the segments are kept in a
+  # SegmentList. The output is identical to that of JointResegmenter, which
+  # walks the segment markers S and E frame by frame and is kept only as the
+  # reference of compare_segmentation_engines.py. This is the default engine.
+  SILENCE = label_table(0, 1, 2)
+  SPEECH = label_table(6, 7, 8)
+  SILENCE_CONVERT = label_table(9, 10, 11)
+
+  # JointResegmenter.TRANSITION_TYPES as an int8 array, with -1 for the pairs
+  # of labels that do not have a transition type
+  TRANSITION_TABLE = None
+
+  def __init__(self, A, f, options, stats = None, reference = None):
+    JointResegmenter.__init__(self, [], f, options, stats, reference)
+    self.A = np.array(A).astype(np.int8)
+    self.B = self.A.copy()
+    self.N = len(self.A)
+    # The segments are kept in a SegmentList instead of the segment
+    # start and end markers S and E
+    self.S = None
+    self.E = None
+    self.segments = SegmentList([], [])
+    if NumpyJointResegmenter.TRANSITION_TABLE is None:
+      NumpyJointResegmenter.TRANSITION_TABLE = np.array([ [ -1 if t == None else t \
+          for t in row ] for row in JointResegmenter.TRANSITION_TYPES ], dtype = np.int8)
+
+  def fork(self, options, stats):
+    r = copy.copy(self)
+    r.set_options(options)
+    r.stats = stats
+    r.stage_times = []
+    r.A = self.A.copy()
+    r.segments = self.segments.copy()
+    return r
+
+  def get_state(self):
+    intervals = self.segments.intervals()
+    return self.A, [ start for start, end in intervals ], \
+        [ end for start, end in intervals ]
+
+  def set_state(self, A, starts, ends):
+    self.A = A.astype(np.int8)
+    self.segments = SegmentList(starts, ends)
+
+  def restrict(self, N):
+    self.B = self.B[0:N]
+    self.A = self.A[0:N]
+    self.segments.restrict(N)
+    self.N = N
+
+  def get_initial_segments(self):
+    # Vectorized version of JointResegmenter.get_initial_segments():
+    # a segment starts at every non-silence frame whose label differs from
+    # that of the previous frame, and ends at every label change (or the end
+    # of the recording) that follows a non-silence frame.
+    nonsil = ~self.SILENCE[self.A]
+    change = np.ones(self.N + 1, dtype=bool)
+    np.not_equal(self.A[1:], self.A[:-1], out = change[1:self.N])
+    S = change[:-1] & nonsil
+    E = change[1:] & nonsil
+    self.segments = SegmentList(np.flatnonzero(S).tolist(), (np.flatnonzero(E) + 1).tolist())
+
+  def set_silence_proportion(self):
+    B = self.B
+    silence = self.SILENCE[B]
+    num_nonsil_frames = int(self.N - np.count_nonzero(silence))
+    if num_nonsil_frames == 0:
+      sys.stderr.write("%s: Warning: no segments found for recording %s\n" % (sys.argv[0], self.file_id))
+
+    target_segment_frames = int(num_nonsil_frames / (1.0 - self.options.silence_proportion))
+
+    # The silence regions between the segments and the frames inside them
+    # where the type of silence (0, 1 or 2) changes
+    gap_starts, gap_ends = run_bounds(silence)
+    change_points = np.flatnonzero(silence[1:] & silence[:-1] & (B[1:] != B[:-1])) + 1
+
+    right, left = allocate_padding(gap_starts, gap_ends, self.N, change_points, \
+        target_segment_frames - num_nonsil_frames)
+    num_segment_frames = num_nonsil_frames + int(right.sum() + left.sum())
+    self.add_padding(gap_starts, gap_ends, change_points, right, left)
+
+    if num_segment_frames < target_segment_frames:
+      proportion = float(num_segment_frames - num_nonsil_frames) / num_segment_frames
+      sys.stderr.write("%s: Warning: for recording %s, only got a proportion %f of silence frames, versus target %f\n" % (sys.argv[0], self.file_id, proportion, self.options.silence_proportion))
+
+  def add_padding(self, gap_starts, gap_ends, change_points, right, left):
+    A = self.A
+    B = self.B
+    S, E = self.segments.markers(self.N)
+    # Convert the padding frames to 9, 10 or 11 depending on whether they
+    # were originally 0, 1 or 2. The padding at each side of a silence region
+    # is split into separate segments where the type of silence changes.
+    region_starts = np.concatenate((gap_starts[right > 0], (gap_ends - left)[left > 0]))
+    region_ends = np.concatenate(((gap_starts + right)[right > 0], gap_ends[left > 0]))
+    padding = np.cumsum(np.bincount(region_starts, minlength = self.N + 1) \
+        - np.bincount(region_ends, minlength = self.N + 1))[0:self.N] > 0
+    A[padding] = B[padding] + 9
+    is_region_start = np.zeros(self.N, dtype=bool)
+    is_region_start[region_starts] = True
+    inner_changes = change_points[padding[change_points] & ~is_region_start[change_points]]
+    S[region_starts] = True
+    S[inner_changes] = True
+    E[region_ends] = True
+    E[inner_changes] = True
+    self.segments = segments_from_markers(S, E)
+
+  def merge_segments(self):
+    segments = self.segments
+
+    if self.options.verbose > 0:
+      sys.stderr.write("Length of segment starts before silence adding: %d\n" % len(segments))
+
+    if self.min_inter_utt_silence_length > 0.0:
+      # Every region between two segment boundaries becomes a segment, so
+      # that the silence regions can be merged or removed like any other
+      # segment.
+      points = sorted(set([0] + [ segments.start[i] for i in segments ] \
+          + [ segments.end[i] for i in segments ] + [self.N]))
+      segments = SegmentList(points[:-1], points[1:])
+      self.segments = segments
+      if self.options.verbose > 0:
+        sys.stderr.write("Length of segment starts after silence adding: %d\n" % len(segments))
+
+    # A boundary is a frame where a segment ends and the next one starts.
+    # The segment score is the min of the lengths of the segments on either
+    # side of the boundary.
+    nodes = list(segments)
+    starts = np.array([ segments.start[i] for i in nodes ], dtype = np.int64)
+    ends = np.array([ segments.end[i] for i in nodes ], dtype = np.int64)
+    adjacent = ends[:-1] == starts[1:]
+    lengths = ends - starts
+    frames = ends[:-1][adjacent]
+    scores = np.minimum(lengths[:-1], lengths[1:])[adjacent]
+    types = self.transition_types(frames)
+
+    # Sort by transition type and within each transition type by segment
+    # score. The sort is stable, so ties are in the order of the frames.
+    order = np.lexsort((scores, types))
+    boundaries = list(zip(frames[order].tolist(), scores[order].tolist(), \
+        types[order].tolist()))
+
+    if self.options.merge_order == "dynamic":
+      self.merge_segments_dynamic(boundaries)
+      return
+
+    for b in boundaries:
+      self.merge_boundary(b[0])
+
+  def merge_segments_dynamic(self, boundaries):
+    # Merges the boundaries in order of transition type and segment score
+    # like merge_segments(), but the segment score of a boundary is updated
+    # whenever one of the segments on either side of it grows because of a
+    # merge. The boundaries are kept in a heap with lazy deletion: score[b]
+    # is the current score of boundary b, and heap entries with a different
+    # score are out of date.
+    segments = self.segments
+    heap = [ (t, segment_score, b) for b, segment_score, t in boundaries ]
+    heapq.heapify(heap)
+    score = dict([ (b, segment_score) for b, segment_score, t in boundaries ])
+    while len(heap) > 0:
+      t, segment_score, b = heapq.heappop(heap)
+      if score.get(b) != segment_score:
+        continue
+      del score[b]
+      i = self.merge_boundary(b)
+      if i == -1:
+        continue
+      # Rescore the boundaries at either end of the merged segment
+      for j in (segments.prev[i], i):
+        k = segments.next[j] if j != -1 else -1
+        if k == -1 or segments.end[j] != segments.start[k]:
+          continue
+        n = segments.end[j]
+        segment_score = min(n - segments.start[j], segments.end[k] - n)
+        if score.get(n) != segment_score:
+          score[n] = segment_score
+          heapq.heappush(heap, (self.transition_type(n), segment_score, n))
+
+  def merge_boundary(self, b):
+    # Merges the segments on either side of the boundary b, if the merged
+    # segment is shorter than max_frames, or removes the segment starting at
+    # b if it is inter-utterance silence. Returns the merged segment or -1.
+    A = self.A
+    segments = self.segments
+    i = segments.ending_at(b)
+    j = segments.starting_at(b)
+    if i == -1 or j == -1:
+      # This will happen only if the boundary is at the end of
+      # a silence region that has already been merged or removed
+      assert (self.min_inter_utt_silence_length > 0.0 \
+          or self.options.merge_order == "dynamic")
+      return -1
+    assert (segments.next[i] == j)
+
+    segment_length = b - segments.start[i]
+    p = segments.end[j]
+
+    if self.min_inter_utt_silence_length > 0 and self.SILENCE[A[b]]:
+      if (p - b) > self.min_inter_utt_silence_length:
+        # Inter-utterance silence
+        segments.remove(j)
+        self.stats.inter_utt_silence += 1
+        return -1
+
+      # Merge the silence segment with the segments on either side if
+      # the merged segment is short enough
+      k = segments.next[j]
+      if k != -1 and segments.start[k] != p:
+        k = -1
+      segment_length += (segments.end[k] if k != -1 else p + 1) - b
+      if segment_length < self.max_frames:
+        self.stats.merge_silence_segment += 1
+        if k != -1:
+          segments.merge_next(j)
+        segments.merge_next(i)
+        return i
+      return -1
+
+    segment_length += p - b
+    if segment_length < self.max_frames:
+      self.stats.merge_segments += 1
+      segments.merge_next(i)
+      return i
+    return -1
+
+  def split_long_segments(self):
+    for i in list(self.segments):
+      self.split_segment(i)
+
+  def split_segment(self, i):
+    n = self.segments.start[i]
+    p = self.segments.end[i]
+    segment_length = p - n
+    if segment_length <= self.hard_max_frames:
+      return
+    assert (n + self.frame_offset == 0 or not self.SILENCE[self.A[n:p]].any())
+    self.stats.split_segments += 1
+    num_pieces = int((float(segment_length) / self.hard_max_frames) + 0.99999)
+    sys.stderr.write("%s: Warning: for recording %s, " \
+        % (sys.argv[0], self.file_id) \
+        + "splitting segment of length %f seconds into %d pieces " \
+        % (segment_length * self.frame_shift, num_pieces) \
+        + "(--hard-max-segment-length %f)\n" \
+        % self.options.hard_max_segment_length)
+    frames_per_piece = int(segment_length / num_pieces)
+    pieces = self.segments.split(i, \
+        [ n + k * frames_per_piece for k in range(1, num_pieces) ])
+    # The last piece can still be longer than the hard maximum, in which
+    # case it is split again, in the same way as in JointResegmenter.
+    for j in pieces:
+      self.split_segment(j)
+
+  def hypothesis_classes(self):
+    H = np.ones(self.N, dtype=np.int8)
+    H[self.SILENCE[self.A]] = 0
+    H[self.SPEECH[self.A]] = 2
+    return H
+
+  def remove_silence_only_segments(self):
+    segments = self.segments
+    silence = self.hyp_counts[0]
+    for i in list(segments):
+      if silence[segments.end[i]] - silence[segments.start[i]] \
+          == segments.end[i] - segments.start[i]:
+        self.stats.silence_only += 1
+        segments.remove(i)
+
+  def remove_noise_only_segments(self):
+    segments = self.segments
+    speech = self.hyp_counts[2]
+    for i in list(segments):
+      if speech[segments.end[i]] == speech[segments.start[i]]:
+        self.stats.noise_only += 1
+        segments.remove(i)
+
+  def transition_type(self, j):
+    assert (j > 0)
+    a = self.A[j-1]
+    b = self.A[j]
+    assert (a != b or self.SILENCE_CONVERT[b])
+    t = self.TRANSITION_TABLE[a, b]
+    assert (t >= 0)
+    return int(t)
+
+  def transition_types(self, frames):
+    # Vectorized transition_type() for an array of boundary frames
+    assert ((frames > 0).all())
+    a = self.A[frames - 1]
+    b = self.A[frames]
+    assert (((a != b) | self.SILENCE_CONVERT[b]).all())
+    types = self.TRANSITION_TABLE[a, b]
+    assert ((types >= 0).all())
+    return types
+
+  def num_segments(self):
+    return len(self.segments)
+
+  def get_segments(self):
+    return self.segments.intervals()
+
+def read_matrix(f):
+  # Reads a Kaldi float or double matrix in binary form (starting with
+  # "\0B") or in text form (rows of numbers between "[" and "]"), which is
+  # returned as a 2-dimensional array
+  c = f.read(1)
+  while c == b" ":
+    c = f.read(1)
+  if c == b"\0":
+    if f.read(1) != b"B":
+      sys.stderr.write("%s: Error: Invalid binary header in archive\n" % sys.argv[0])
+      sys.exit(1)
+    # The type ("FM " or "DM "), then the numbers of rows and columns, each
+    # written as one byte giving the size of the type followed by the value
+    header = f.read(13)
+    if len(header) != 13 or header[0:3] not in (b"FM ", b"DM ") \
+        or header[3:4] != b"\x04" or header[8:9] != b"\x04":
+      sys.stderr.write("%s: Error: Expected a float or double matrix in archive\n" % sys.argv[0])
+      sys.exit(1)
+    rows, cols = struct.unpack("<xxxxixi", header)
+    dtype = np.dtype("<f4") if header[0:3] == b"FM " else np.dtype("<f8")
+    data = f.read(rows * cols * dtype.itemsize)
+    if len(data) != rows * cols * dtype.itemsize:
+      sys.stderr.write("%s: Error: Unexpected end of archive\n" % sys.argv[0])
+      sys.exit(1)
+    return np.frombuffer(data, dtype = dtype).reshape(rows, cols)
+  if c != b"[":
+    sys.stderr.write("%s: Error: Expected a matrix in archive\n" % sys.argv[0])
+    sys.exit(1)
+  rows = []
+  while True:
+    line = f.readline()
+    if line == b"":
+      sys.stderr.write("%s: Error: Unexpected end of archive\n" % sys.argv[0])
+      sys.exit(1)
+    fields = line.split()
+    end = b"]" in fields
+    if end:
+      fields = fields[0:fields.index(b"]")]
+    if len(fields) > 0:
+      rows.append(np.array(fields, dtype = np.float64))
+    if end:
+      break
+  if len(rows) == 0:
+    return np.zeros((0, 0))
+  return np.vstack(rows)
+
+def read_recording(predictions, f, options):
+  # Returns the predictions of recording f (see read_predictions()). With
+  # --posteriors, predictions are the posteriors read from an archive, which
+  # are smoothed into predictions with smooth_posteriors().
+  if options.posteriors:
+    return smooth_posteriors(predictions, f, options)
+  return read_predictions(predictions, f)
+
+def smooth_posteriors(P, f, options):
+  # Returns the predictions of recording f (see read_predictions()) given the
+  # matrix P of the posteriors of silence, noise and speech (the columns) of
+  # each frame (the rows), or their logs with --log-posteriors. This is the
+  # Viterbi path through runs of the three classes where each run is at least
+  # --smoothing-min-silence-length, --smoothing-min-noise-length or
+  # --smoothing-min-speech-length long, except that the last run of the
+  # recording may be shorter, and each change of class costs
+  # --smoothing-transition-penalty.
+  # With C the cumulative log-posteriors of the classes, the best score of a
+  # path that is in a run of class c at frame t, which started at frame s,
+  # is C[t+1, c] + J[s, c], where J[s, c] = M[s-1, c] - penalty - C[s, c]
+  # and M[s-1, c] is the best score of a path that is at the end of a run of
+  # another class at frame s-1 (J[0, c] = 0). The best score of a path at
+  # the end of a run of class c at frame t is then C[t+1, c] plus the
+  # maximum of J[s, c] over s <= t - d[c] + 1, where d[c] is the minimum
+  # length of class c. J is kept in Q, shifted so that Q[c, t] is J[s, c] for
+  # s = t - d[c] + 1. With D the shortest minimum length, the maxima of D
+  # frames at a time only depend on M of earlier frames, so the frames are
+  # processed in blocks of D frames, with the maxima as cumulative maxima
+  # and all classes at once.
+  if P.ndim != 2 or P.shape[1] != 3:
+    sys.stderr.write("%s: Error: Invalid posteriors for recording %s. Must have 3 columns.\n" \
+        % (sys.argv[0], f))
+    sys.exit(1)
+  N = P.shape[0]
+  if N == 0:
+    return np.zeros(0, dtype = np.int32)
+  if options.log_posteriors:
+    C = np.array(P, dtype = np.float64)
+  else:
+    C = np.log(np.maximum(P, 1e-10))
+  C = np.concatenate((np.zeros((1, 3)), np.cumsum(C, axis = 0)))
+  d = np.array([ max(1, int(length / options.frame_shift + 0.5)) \
+      for length in (options.smoothing_min_silence_length, \
+      options.smoothing_min_noise_length, \
+      options.smoothing_min_speech_length) ])
+  penalty = options.smoothing_transition_penalty
+  D = int(d.min())
+  others = np.array([ [1, 2], [0, 2], [0, 1] ])
+
+  Q = np.full((3, N + d.max()), -np.inf)
+  Q[[0, 1, 2], d - 1] = 0.0
+  M = np.empty((N, 3))
+  H = np.full(3, -np.inf)
+  rows = np.arange(3)[:, np.newaxis]
+  shifts = d[:, np.newaxis] + np.arange(D)
+  for T in range(0, N, D):
+    n = min(D, N - T)
+    H_block = np.maximum(np.maximum.accumulate(Q[:, T:T+n], axis = 1), H[:, np.newaxis])
+    H = H_block[:, -1]
+    L = C[T+1:T+n+1] + H_block.T
+    M[T:T+n] = np.maximum(L[:, others[:, 0]], L[:, others[:, 1]])
+    Q[rows, T + shifts[:, 0:n]] = (M[T:T+n] - penalty - C[T+1:T+n+1]).T
+
+  # The frame of Q that gives the maximum for each frame, from which the
+  # start of the run is found in the trace back
+  record = np.empty((3, N), dtype = np.int64)
+  for c in range(3):
+    Q_max = np.maximum.accumulate(Q[c, 0:N])
+    is_record = np.concatenate(([True], Q[c, 1:N] > Q_max[0:N-1]))
+    record[c] = np.maximum.accumulate(np.where(is_record, np.arange(N), 0))
+
+  # The last run may be shorter than its minimum length, so it may start at
+  # any frame, which is any frame of Q up to N - 1 + d[c] - 1
+  scores = [ C[N, c] + Q[c, 0:N+d[c]-1].max() for c in range(3) ]
+  c = int(np.argmax(scores))
+  run_start = int(np.argmax(Q[c, 0:N+d[c]-1])) - d[c] + 1
+
+  # Trace back the runs from the end. The run before a run that starts at
+  # frame t is of the class that gives M[t-1].
+  def score(t, c):
+    return C[t+1, c] + Q[c, record[c, t]]
+
+  A = np.empty(N, dtype = np.int32)
+  end = N
+  while True:
+    A[run_start:end] = c
+    if run_start == 0:
+      break
+    end = run_start
+    c = max(others[c], key = lambda o: score(end - 1, o))
+    run_start = int(record[c, end - 1]) - d[c] + 1
+  return A
+
+def resegment_in_chunks(Resegmenter, B, f, options, stats, reference):
+  # Resegments the frame labels B of recording f (an array, see
+  # fuse_channels()) in chunks of at least --chunk-length, and returns the
+  # segments as a list of (start, end) frames, the classes of the frames of
+  # the hypothesis (see JointResegmenter.hypothesis_classes()) and the
+  # resegmenter of the last chunk. This gives the same segments as
+  # resegmenting the whole recording at once, with only a chunk of the frames
+  # in the lists of the resegmenter at a time.
+  # The silence padding is the only stage that depends on the whole
+  # recording. It is allocated first from the silence regions of the whole
+  # recording, as in NumpyJointResegmenter.set_silence_proportion(), and each
+  # chunk gets its part of it (see JointResegmenter.set_given_padding()). The
+  # recording is then cut at the silence left between two segments after the
+  # padding, which is not in any chunk. Segments are only merged where they
+  # meet, so any length of silence separates the chunks, except that with
+  # --min-inter-utt-silence-length the silence becomes a segment of its own
+  # and has to be longer than that, so that it is removed as inter-utterance
+  # silence before the segments on either side could be merged with it.
+  N = len(B)
+  silence = B < 3
+  num_nonsil_frames = int(N - np.count_nonzero(silence))
+  if num_nonsil_frames == 0:
+    sys.stderr.write("%s: Warning: no segments found for recording %s\n" % (sys.argv[0], f))
+  target_segment_frames = int(num_nonsil_frames / (1.0 - options.silence_proportion))
+  gap_starts, gap_ends = run_bounds(silence)
+  change_points = np.flatnonzero(silence[1:] & silence[:-1] & (B[1:] != B[:-1])) + 1
+  del silence
+  right, left = allocate_padding(gap_starts, gap_ends, N, change_points, \
+      target_segment_frames - num_nonsil_frames)
+  num_segment_frames = num_nonsil_frames + int(right.sum() + left.sum())
+  if num_segment_frames < target_segment_frames:
+    proportion = float(num_segment_frames - num_nonsil_frames) / num_segment_frames
+    sys.stderr.write("%s: Warning: for recording %s, only got a proportion %f of silence frames, versus target %f\n" % (sys.argv[0], f, proportion, options.silence_proportion))
+
+  min_inter_utt_silence_length = int(options.min_inter_utt_silence_length / options.frame_shift)
+  if min_inter_utt_silence_length > 0:
+    min_cut_length = min_inter_utt_silence_length + 1
+  else:
+    min_cut_length = 1
+  cut_starts = gap_starts + right
+  cut_ends = gap_ends - left
+  cuts = np.flatnonzero((gap_starts > 0) & (gap_ends < N) \
+      & (cut_ends - cut_starts >= min_cut_length))
+  chunk_frames = int(options.chunk_length / options.frame_shift)
+  chunks = []
+  start = 0
+  for i in cuts.tolist():
+    if cut_starts[i] - start >= chunk_frames:
+      chunks.append((start, int(cut_starts[i])))
+      start = int(cut_ends[i])
+  chunks.append((start, N))
+  if min_inter_utt_silence_length > 0:
+    stats.inter_utt_silence += len(chunks) - 1
+
+  reference_frames = get_reference_frames(reference, f)
+  segments = []
+  # The frames between the chunks are silence
+  classes = np.zeros(N, dtype=np.int8)
+  for start, end in chunks:
+    # The silence regions that overlap the chunk, and their padding that is
+    # in the chunk
+    lo = np.searchsorted(gap_ends, start, side='right')
+    hi = np.searchsorted(gap_starts, end, side='left')
+    chunk_right = np.where(gap_starts[lo:hi] >= start, right[lo:hi], 0)
+    chunk_left = np.where(gap_ends[lo:hi] <= end, left[lo:hi], 0)
+    chunk_changes = change_points[(change_points > start) & (change_points < end)]
+
+    A = B[start:end]
+    if options.engine == "python":
+      A = A.astype(str).tolist()
+    if reference_frames != None:
+      r = Resegmenter(A, f, options, stats, reference_frames[start:end])
+    else:
+      r = Resegmenter(A, f, options, stats)
+    r.padding = (np.maximum(gap_starts[lo:hi], start) - start, \
+        np.minimum(gap_ends[lo:hi], end) - start, chunk_changes - start, \
+        chunk_right, chunk_left)
+    r.frame_offset = start
+    r.resegment()
+    segments.extend([ (s + start, e + start) for s, e in r.get_segments() ])
+    classes[start:end] = r.hypothesis_classes()
+    if options.timing_report != None:
+      stats.timing.add_recording(f, r.N, r.stage_times)
+  return segments, classes, r
+
+def resegment_channel(B, f, options, stats, reference, num_frames = None):
+  # Resegments the frame labels B of recording f (an array, see
+  # fuse_channels()) and returns the lines of its segments file, its number
+  # of frames, its segments as (start, end) frames and the lengths of the
+  # runs of each class of its hypothesis (see class_run_lengths()). With
+  # num_frames, the segments are restricted to the first num_frames frames,
+  # for the shorter channel of a pair.
+  if options.engine == "numpy":
+    Resegmenter = NumpyJointResegmenter
+  else:
+    Resegmenter = JointResegmenter
+
+  out = StringIO()
+  if options.chunk_length > 0:
+    segments, classes, r = resegment_in_chunks(Resegmenter, B, f, options, \
+        stats, reference)
+    if num_frames != None:
+      segments = [ (start, min(end, num_frames)) for start, end in segments \
+          if start < num_frames ]
+      classes = classes[0:num_frames]
+    else:
+      num_frames = len(B)
+    r.print_segments(out, segments = segments)
+  else:
+    if options.engine == "python":
+      B = B.astype(str).tolist()
+    r = Resegmenter(B, f, options, stats, get_reference_frames(reference, f))
+    r.resegment()
+    if num_frames != None:
+      r.restrict(num_frames)
+    r.print_segments(out)
+    if options.timing_report != None:
+      stats.timing.add_recording(f, r.N, r.stage_times)
+    segments = r.get_segments()
+    classes = r.hypothesis_classes()
+    num_frames = r.N
+  return out.getvalue(), num_frames, segments, class_run_lengths(classes)
+
+# The options that change the segments, which are part of the key of the
+# cache. The engine and --chunk-length give the same segments (and the same
+# failures), so they are not.
+CACHE_OPTIONS = ("silence_proportion", "frame_shift", "max_segment_length", \
+    "hard_max_segment_length", "first_separator", "second_separator", \
+    "remove_noise_only_segments", "min_inter_utt_silence_length", \
+    "max_length_diff", "merge_order")
+
+# A hash of this script and of segmentation_common.py, so that the cache
+# entries and checkpoints of another version of them are not used
+CODE_VERSION = source_hash([ __file__, segmentation_common.__file__ ])
+
+def cache_key(options, f1, A1, f2, A2):
+  # The key of the cache entry of a job: a hash of the code version, the
+  # options in CACHE_OPTIONS, the recordings and their predictions
+  key = hashlib.sha1()
+  key.update(CODE_VERSION.encode())
+  key.update(json.dumps([ getattr(options, o) for o in CACHE_OPTIONS ] \
+      + [ f1, f2 ]).encode())
+  key.update(A1.astype(np.int32).tobytes())
+  if A2 is not None:
+    key.update(b"|")
+    key.update(A2.astype(np.int32).tobytes())
+  return key.hexdigest()
+
+def get_channels(options, f1, A1, f2, A2):
+  # Returns the channels of a job (see resegment_recordings()) as a list of
+  # (recording, frame labels, number of frames) where the frame labels are
+  # those of fuse_channels(). The number of frames is None, except for the
+  # shorter channel of a pair, whose segments are restricted to its frames.
+  if f2 == None:
+    return [ (f1, fuse_channels(A1), None) ]
+
+  if len(A1) < len(A2):
+    A3 = A1
+    A1 = A2
+    A2 = A3
+
+    f3 = f1
+    f1 = f2
+    f2 = f3
+
+  if (len(A1) - len(A2)) > options.max_length_diff / options.frame_shift:
+    sys.stderr.write( \
+        "%s: Warning: Lengths of %s and %s differ by more than %f. " \
+        % (sys.argv[0], f1,f2, options.max_length_diff) \
+        + "So using isolated resegmentation\n")
+    B1 = fuse_channels(A1)
+    B2 = fuse_channels(A2)
+  else:
+    B1, B2 = fuse_channels(A1, A2)
+  return [ (f1, B1, None), (f2, B2, len(A2)) ]
+
+def resegment_recordings(job):
+  # Resegments a single recording, or a pair of channel 1 and channel 2
+  # recordings, given by job = (options, reference, f1, A1, f2, A2) where
+  # A1 and A2 are the predictions (see read_predictions()), f2 and A2 are
+  # None for a single recording and reference is an RttmReference or None.
+  # With --num-jobs > 1 this is run in a worker process, so the lines of the
+  # segments file are returned as a dict from the recording to its lines,
+  # together with the Stats of these recordings and the exit status, which
+  # is non-zero if there was an error. With --cache-dir, the results are
+  # taken from the cache if the job was done before.
+  options, reference, f1, A1, f2, A2 = job
+
+  stats = Stats()
+  # The (recording, lines, number of frames, segments, class run lengths) of
+  # the recordings
+  recordings = []
+  status = 0
+  try:
+    A1 = read_recording(A1, f1, options)
+    if f2 != None:
+      A2 = read_recording(A2, f2, options)
+
+    cache_file = None
+    if options.cache_dir != None and not options.no_cache:
+      cache_file = os.path.join(options.cache_dir, \
+          cache_key(options, f1, A1, f2, A2) + ".json")
+      entry = read_cache(cache_file)
+      if entry != None:
+        stats.add_counts(entry["counts"])
+        recordings = entry["recordings"]
+        sys.stderr.write("".join(entry["warnings"]))
+        if options.verbose > 0:
+          sys.stderr.write("Segments of %s taken from the cache\n" \
+              % " and ".join([ f for f in (f1, f2) if f != None ]))
+    if cache_file == None or entry == None:
+      if cache_file != None:
+        # The warnings are kept with the segments, so that they are also
+        # written when the segments are taken from the cache. The rest of
+        # the --verbose trace (the stage times and counts) is not, as it
+        # describes a resegmentation that a cache hit skips.
+        sys.stderr = WarningLog(sys.stderr)
+      for f, B, num_frames in get_channels(options, f1, A1, f2, A2):
+        lines, num_frames, recording_segments, class_lengths = \
+            resegment_channel(B, f, options, stats, reference, num_frames)
+        recordings.append((f, lines, num_frames, recording_segments, class_lengths))
+      if cache_file != None:
+        write_cache(cache_file, { "counts": stats.get_counts(), \
+            "recordings": recordings, "warnings": sys.stderr.warnings })
+  except SystemExit as e:
+    status = e.code
+  finally:
+    if isinstance(sys.stderr, WarningLog):
+      sys.stderr = sys.stderr.stream
+
+  segments = {}
+  for f, lines, num_frames, recording_segments, class_lengths in recordings:
+    segments[f] = lines
+    if options.metrics_file != None:
+      stats.metrics.add_recording(f, num_frames, recording_segments, class_lengths)
+  return segments, stats, status
+
+def sweep_configurations(options):
+  # Returns the options of each configuration of the grid given by
+  # --sweep-silence-proportion, --sweep-max-segment-length and
+  # --sweep-min-inter-utt-silence-length (lists of values, see main()). The
+  # configurations with the same silence proportion are consecutive, so that
+  # the silence padding is shared by them.
+  configurations = []
+  for silence_proportion in options.sweep_silence_proportion:
+    for max_segment_length in options.sweep_max_segment_length:
+      for min_inter_utt_silence_length in options.sweep_min_inter_utt_silence_length:
+        configuration = copy.copy(options)
+        configuration.silence_proportion = silence_proportion
+        configuration.max_segment_length = max_segment_length
+        configuration.min_inter_utt_silence_length = min_inter_utt_silence_length
+        configurations.append(configuration)
+  return configurations
+
+def sweep_channel(B, f, configurations, stats, timing, reference, num_frames = None):
+  # Resegments the frame labels B of recording f (see resegment_channel())
+  # with each of the configurations, and returns a list of the lines of its
+  # segments file, its number of frames, its segments and the lengths of the
+  # runs of each class of its hypothesis for each of them.
+  # The initial segments are found once, the silence padding once for each
+  # silence proportion, and only the merge and later stages are run for each
+  # configuration, with the Stats in stats. The times of all of the stages
+  # are added to timing.
+  if configurations[0].engine == "numpy":
+    Resegmenter = NumpyJointResegmenter
+  else:
+    Resegmenter = JointResegmenter
+    B = B.astype(str).tolist()
+
+  initial = Resegmenter(B, f, configurations[0], Stats(), get_reference_frames(reference, f))
+  initial.run_stage("get_initial_segments", initial.get_initial_segments)
+  stage_times = initial.stage_times
+  padded = None
+  results = []
+  for configuration, configuration_stats in zip(configurations, stats):
+    if padded == None \
+        or padded.options.silence_proportion != configuration.silence_proportion:
+      padded = initial.fork(configuration, Stats())
+      padded.pad_segments()
+      stage_times = stage_times + padded.stage_times
+    r = padded.fork(configuration, configuration_stats)
+    r.merge_and_split_segments()
+    stage_times = stage_times + r.stage_times
+    if num_frames != None:
+      r.restrict(num_frames)
+    out = StringIO()
+    r.print_segments(out)
+    results.append((out.getvalue(), r.N, r.get_segments(), \
+        class_run_lengths(r.hypothesis_classes())))
+  if configurations[0].timing_report != None:
+    timing.add_recording(f, initial.N, stage_times)
+  return results
+
+def sweep_recordings(job):
+  # Resegments the recordings of a job (see resegment_recordings()) with
+  # each configuration of the grid of --sweep-dir. Returns a list of the
+  # segments of the configurations, each a dict from the recording to the
+  # lines of its segments file, a list of their Stats, with the metrics of
+  # the recordings, the Stats with the timing of the stages and the exit
+  # status.
+  options, reference, f1, A1, f2, A2 = job
+  configurations = sweep_configurations(options)
+
+  segments = [ {} for c in configurations ]
+  stats = [ Stats() for c in configurations ]
+  timing_stats = Stats()
+  status = 0
+  try:
+    A1 = read_recording(A1, f1, options)
+    if f2 != None:
+      A2 = read_recording(A2, f2, options)
+    for f, B, num_frames in get_channels(options, f1, A1, f2, A2):
+      results = sweep_channel(B, f, configurations, stats, \
+          timing_stats.timing, reference, num_frames)
+      for i, (lines, N, recording_segments, class_lengths) in enumerate(results):
+        segments[i][f] = lines
+        stats[i].metrics.add_recording(f, N, recording_segments, class_lengths)
+  except SystemExit as e:
+    status = e.code
+  return segments, stats, timing_stats, status
+
+def sweep(options, predictions, reference, stats, timing_handle):
+  # Resegments the predictions with each configuration of the grid of
+  # --sweep-dir, reading and fusing the channels of each recording once.
+  # For configuration n, the segments file is written to
+  # <sweep-dir>/segments.<n> and the metrics (as with --metrics-file) to
+  # <sweep-dir>/metrics.<n>, and its options to line n of
+  # <sweep-dir>/configurations. The timing of the stages is added to stats,
+  # and with --timing-report its records are written to timing_handle.
+  # Returns the exit status.
+  configurations = sweep_configurations(options)
+  segments = [ {} for c in configurations ]
+  sweep_stats = [ Stats() for c in configurations ]
+  try:
+    handles = [ open(os.path.join(options.sweep_dir, "metrics.%d" % n), 'w') \
+        for n in range(len(configurations)) ]
+    configurations_handle = open(os.path.join(options.sweep_dir, "configurations"), 'w')
+  except IOError:
+    sys.stderr.write("%s: Error: Unable to write to directory %s\n" \
+        % (sys.argv[0], options.sweep_dir))
+    sys.exit(1)
+
+  pool = create_pool(options.num_jobs)
+  results = run_jobs(get_jobs(options, predictions, reference, \
+      read_matrix if options.posteriors else None), pool, \
+      options.num_jobs, sweep_recordings)
+
+  status = 0
+  for job_segments, job_stats, timing_stats, status in results:
+    stats.add(timing_stats)
+    for n in range(len(configurations)):
+      sweep_stats[n].add(job_stats[n])
+      job_stats[n].metrics.write_records(handles[n])
+      segments[n].update(job_segments[n])
+    if options.timing_report != None:
+      timing_stats.timing.write_records(timing_handle)
+    if status != 0:
+      break
+
+  close_pool(pool, status)
+
+  for n, configuration in enumerate(configurations):
+    configurations_handle.write("%d --silence-proportion %s --max-segment-length %s --min-inter-utt-silence-length %s\n" \
+        % (n, configuration.silence_proportion, configuration.max_segment_length, \
+        configuration.min_inter_utt_silence_length))
+    segments_handle = open(os.path.join(options.sweep_dir, "segments.%d" % n), 'w')
+    for f in sorted(segments[n]):
+      segments_handle.write(segments[n][f])
+    segments_handle.close()
+    if status == 0:
+      sweep_stats[n].metrics.write_summary(handles[n], sweep_stats[n], options.frame_shift)
+    handles[n].close()
+    if status == 0 and options.verbose > 0:
+      sys.stderr.write("Configuration %d:\n" % n)
+      sweep_stats[n].print_stats()
+  configurations_handle.close()
+  return status
+
+# The size of the buffers of the files of --data-dir
+DATA_DIR_BUFFER_SIZE = 1 << 20
+
+def subset_table(source_file, target_file, recordings):
+  # Writes the lines of the table source_file (e.g. wav.scp) of the
+  # recordings to target_file, sorted, and returns the recordings that are
+  # not in source_file
+  found = set()
+  lines = []
+  for line in open(source_file):
+    fields = line.split(None, 1)
+    if len(fields) > 0 and fields[0] in recordings:
+      found.add(fields[0])
+      lines.append(line)
+  lines.sort()
+  out = open(target_file, 'w', DATA_DIR_BUFFER_SIZE)
+  out.writelines(lines)
+  out.close()
+  return recordings - found
+
+def write_data_dir(options, segments):
+  # Writes the segments (a dict from each recording to the lines of its
+  # segments file) as the Kaldi data directory --data-dir, with the
+  # segments, utt2spk and spk2utt files, where the speakers are the
+  # recordings as in steps/resegment_data.sh, and with --source-data-dir,
+  # the lines of its wav.scp and reco2file_and_channel of the recordings.
+  # The files are sorted as by "LC_ALL=C sort", in one pass: the lines of
+  # each recording are already sorted, since the times in its utterance ids
+  # have the same number of digits, so the recordings are sorted runs that
+  # are merged. Most often the runs do not overlap, and are written as they
+  # are, but e.g. the runs of recordings a and a_1 with the separator "_"
+  # are merged line by line.
+  runs = [ (lines, f) for f, lines in segments.items() if len(lines) > 0 ]
+  runs.sort()
+  overlap = False
+  for n in range(1, len(runs)):
+    previous = runs[n-1][0]
+    if previous[previous.rfind("\n", 0, len(previous) - 1) + 1:] > runs[n][0]:
+      overlap = True
+      break
+
+  segments_handle = open(os.path.join(options.data_dir, "segments"), 'w', DATA_DIR_BUFFER_SIZE)
+  utt2spk_handle = open(os.path.join(options.data_dir, "utt2spk"), 'w', DATA_DIR_BUFFER_SIZE)
+  if not overlap:
+    for lines, f in runs:
+      segments_handle.write(lines)
+      utt2spk_handle.write(re.sub(r"(?m)^(\S+) (\S+) .*$", r"\1 \2", lines))
+  else:
+    for line in heapq.merge(*[ lines.splitlines(True) for lines, f in runs ]):
+      segments_handle.write(line)
+      utt2spk_handle.write(" ".join(line.split(" ", 2)[0:2]) + "\n")
+  segments_handle.close()
+  utt2spk_handle.close()
+
+  spk2utt_handle = open(os.path.join(options.data_dir, "spk2utt"), 'w', DATA_DIR_BUFFER_SIZE)
+  for f in sorted([ f for lines, f in runs ]):
+    spk2utt_handle.write("%s %s\n" % (f, " ".join(re.findall(r"(?m)^\S+", segments[f]))))
+  spk2utt_handle.close()
+
+  if options.source_data_dir != None:
+    recordings = set([ f for lines, f in runs ])
+    missing = subset_table(os.path.join(options.source_data_dir, "wav.scp"), \
+        os.path.join(options.data_dir, "wav.scp"), recordings)
+    if len(missing) > 0:
+      sys.stderr.write("%s: Error: Recordings %s not found in %s\n" \
+          % (sys.argv[0], " ".join(sorted(missing)), \
+          os.path.join(options.source_data_dir, "wav.scp")))
+      sys.exit(1)
+    reco2file_and_channel = os.path.join(options.source_data_dir, "reco2file_and_channel")
+    if os.path.exists(reco2file_and_channel):
+      subset_table(reco2file_and_channel, \
+          os.path.join(options.data_dir, "reco2file_and_channel"), recordings)
+
+# The number of digits of the times in the utterance ids in --online mode,
+# where the length of the recording is not known in advance. This is enough
+# for recordings of up to 27 hours.
+ONLINE_NUM_DIGITS = 7
+
+class OnlineResegmenter:
+  # Resegments a recording in --online mode, as its predictions arrive. The
+  # predictions are buffered until a silence of --online-cut-silence-length
+  # is seen. The buffered frames up to the middle of this silence are then
+  # resegmented as a part of the recording on its own, and its segments are
+  # written out. The silence proportion is therefore applied to each part
+  # rather than to the whole recording. If the buffer reaches
+  # --online-lookahead without such a silence, it is cut at the middle of its
+  # longest silence, so that the segments of a frame are written at most
+  # --online-lookahead after it is read. Each channel is resegmented on its
+  # own.
+  def __init__(self, f, options, stats, out_file_handle = sys.stdout):
+    self.file_id = f
+    self.options = options
+    self.stats = stats
+    self.out_file_handle = out_file_handle
+    if options.engine == "numpy":
+      self.Resegmenter = NumpyJointResegmenter
+    else:
+      self.Resegmenter = JointResegmenter
+    self.cut_frames = max(2, int(options.online_cut_silence_length / options.frame_shift))
+    self.lookahead_frames = max(1, int(options.online_lookahead / options.frame_shift))
+    # The predictions that are not resegmented yet, which start at frame
+    # self.offset of the recording
+    self.buffer = np.zeros(0, dtype=np.int32)
+    self.offset = 0
+    # All the segments of the recording and the classes of the frames of the
+    # hypothesis of each part, for --metrics-file
+    self.segments = []
+    self.classes = []
+
+  def add(self, A):
+    # The parts are found only from the first --online-lookahead of the
+    # buffer, as if the frames were added one at a time, so that they do not
+    # depend on how the predictions arrive
+    self.buffer = np.concatenate((self.buffer, A))
+    while True:
+      starts, ends = run_bounds(self.buffer[0:self.lookahead_frames] == 0)
+      long_silences = np.flatnonzero(ends - starts >= self.cut_frames)
+      if len(long_silences) > 0:
+        self.resegment_part(int(starts[long_silences[0]]) + self.cut_frames // 2)
+      elif len(self.buffer) >= self.lookahead_frames:
+        if len(starts) > 0:
+          i = np.argmax(ends - starts)
+          self.resegment_part(max(1, int(starts[i] + ends[i] + 1) // 2))
+        else:
+          self.resegment_part(self.lookahead_frames)
+      else:
+        break
+
+  def finish(self):
+    # Resegments the rest of the recording and returns the exit status
+    if len(self.buffer) > 0:
+      self.resegment_part(len(self.buffer))
+    if len(self.segments) == 0:
+      sys.stderr.write("%s: Warning: no segments for recording %s\n" % (sys.argv[0], self.file_id))
+      return 1
+    if self.options.metrics_file != None:
+      self.stats.metrics.add_recording(self.file_id, self.offset, self.segments, \
+          class_run_lengths(np.concatenate(self.classes)))
+    return 0
+
+  def resegment_part(self, n):
+    # Resegments the first n frames of the buffer and writes out their
+    # segments. Parts with only silence have no segments.
+    A = self.buffer[0:n]
+    if np.any(A != 0):
+      B = fuse_channels(A)
+      if self.options.engine == "python":
+        B = B.astype(str).tolist()
+      r = self.Resegmenter(B, self.file_id, self.options, self.stats)
+      r.resegment()
+      segments = r.get_segments()
+      if len(segments) > 0:
+        r.print_segments(self.out_file_handle, self.offset, ONLINE_NUM_DIGITS)
+        self.out_file_handle.flush()
+      self.segments.extend([ (start + self.offset, end + self.offset) \
+          for start, end in segments ])
+      self.classes.append(r.hypothesis_classes())
+      if self.options.timing_report != None:
+        self.stats.timing.add_recording(self.file_id, r.N, r.stage_times)
+    else:
+      self.classes.append(np.zeros(n, dtype=np.int8))
+    self.buffer = self.buffer[n:]
+    self.offset += n
+
+def resegment_online(options, rspecifier, stats):
+  # Resegments the recordings of the archive for --online, writing out the
+  # segments as they are found. Returns the exit status.
+  r = None
+  for f, A in read_archive_online(rspecifier):
+    if r == None:
+      r = OnlineResegmenter(f, options, stats)
+    if A is None:
+      status = r.finish()
+      if status != 0:
+        return status
+      r = None
+    else:
+      r.add(read_predictions(A, f))
+  return 0
+
+def get_parser():
   parser = ArgumentParser(description='Get segmentation arguments')
   parser.add_argument('--verbose', type=int, \
       dest='verbose', default=0, \
@@ -678,8 +1944,141 @@ def main():
       + "segmentation to be done")
   parser.add_argument('--reference-rttm', dest='reference_rttm', \
       help="RTTM file to compare and get statistics\n")
-  parser.add_argument('args', nargs=1, help='<prediction_dir>')
-  options = parser.parse_args()
+  parser.add_argument('--engine', type=str, \
+      dest='engine', default="numpy", \
+      help="Implementation of the resegmenter to use: numpy (frame labels " \
+      + "as int8 NumPy arrays, segments as a linked list of intervals) or " \
+      + "python (frame labels as lists of strings, segments as start and end " \
+      + "markers of the frames). " \
+      + "Both give the same output; the python engine is the frame-at-a-time " \
+      + "implementation, kept only as the reference for " \
+      + "compare_segmentation_engines.py.")
+  parser.add_argument('--merge-order', type=str, \
+      dest='merge_order', default="static", \
+      help="Order in which the segments are merged: static (the boundaries " \
+      + "are sorted once by transition type and segment score before " \
+      + "merging) or dynamic (the segment scores are updated as the " \
+      + "segments are merged). dynamic requires --engine numpy.")
+  parser.add_argument('--num-jobs', type=int, \
+      dest='num_jobs', default=1, \
+      help="Number of processes to resegment the recordings in parallel")
+  parser.add_argument('--metrics-file', type=str, \
+      dest='metrics_file', default=None, \
+      help="Write segmentation metrics to this file as JSON lines: one line per recording and a summary of the corpus at the end")
+  parser.add_argument('--timing-report', type=str, \
+      dest='timing_report', default=None, \
+      help="Write the wall and CPU time, frames per second and segments in and out of each stage to this file as JSON lines: one line per recording and a summary with histograms at the end")
+  parser.add_argument('--profile-dir', type=str, \
+      dest='profile_dir', default=None, \
+      help="Profile each stage of each recording with cProfile into <profile-dir>/<recording>.<stage>.prof")
+  parser.add_argument('--chunk-length', type=float, \
+      dest='chunk_length', default=0.0, \
+      help="Resegment each recording in chunks of at least this length, cut " \
+      + "at long silences, which gives the same segments with less memory. " \
+      + "0 resegments the whole recording at once.")
+  parser.add_argument('--posteriors', dest='posteriors', \
+      action='store_true', help="Read a table of matrices of the posteriors " \
+      + "of silence, noise and speech (the columns) of each frame, e.g. " \
+      + "ark:exp/post.ark, and smooth them into predictions with a Viterbi " \
+      + "search with minimum lengths for the runs of each class")
+  parser.add_argument('--log-posteriors', dest='log_posteriors', \
+      action='store_true', help="With --posteriors, the matrices have the " \
+      + "logs of the posteriors")
+  parser.add_argument('--smoothing-min-silence-length', type=float, \
+      dest='smoothing_min_silence_length', default=0.3, \
+      help="With --posteriors, minimum length of a run of silence")
+  parser.add_argument('--smoothing-min-noise-length', type=float, \
+      dest='smoothing_min_noise_length', default=0.3, \
+      help="With --posteriors, minimum length of a run of noise")
+  parser.add_argument('--smoothing-min-speech-length', type=float, \
+      dest='smoothing_min_speech_length', default=0.3, \
+      help="With --posteriors, minimum length of a run of speech")
+  parser.add_argument('--smoothing-transition-penalty', type=float, \
+      dest='smoothing_transition_penalty', default=0.0, \
+      help="With --posteriors, cost of a change of class in the log " \
+      + "posteriors of the path")
+  add_shard_options(parser)
+  parser.add_argument('--data-dir', type=str, \
+      dest='data_dir', default=None, \
+      help="Write the segments as a Kaldi data directory, with sorted " \
+      + "segments, utt2spk and spk2utt files where the speakers are the " \
+      + "recordings, instead of writing the segments to the standard output")
+  parser.add_argument('--source-data-dir', type=str, \
+      dest='source_data_dir', default=None, \
+      help="With --data-dir, data directory whose wav.scp and " \
+      + "reco2file_and_channel are copied to --data-dir for the recordings " \
+      + "with segments")
+  parser.add_argument('--cache-dir', type=str, \
+      dest='cache_dir', default=None, \
+      help="Cache the segments of each recording in this directory, keyed " \
+      + "by its predictions, the options and the version of this script, and " \
+      + "reuse them when these have not changed. A recording taken from the " \
+      + "cache is not resegmented: its warnings are written again, but not " \
+      + "the --verbose trace of its stages (use --no-cache for that).")
+  parser.add_argument('--no-cache', dest='no_cache', \
+      action='store_true', help="Do not use or update the --cache-dir")
+  parser.add_argument('--cache-max-size', type=float, \
+      dest='cache_max_size', default=1000.0, \
+      help="Maximum size of the cache in MB, above which the least recently " \
+      + "used entries are removed (0 for no limit)")
+  parser.add_argument('--cache-max-age', type=float, \
+      dest='cache_max_age', default=30.0, \
+      help="Remove cache entries that were not used for this many days " \
+      + "(0 for no limit)")
+  parser.add_argument('--checkpoint-dir', type=str, \
+      dest='checkpoint_dir', default=None, \
+      help="Save the frame labels and segments of each recording after each " \
+      + "stage to <checkpoint-dir>/<recording>.<stage>.npz")
+  parser.add_argument('--start-stage', type=str, \
+      dest='start_stage', default="get_initial_segments", \
+      help="Stage to start at: get_initial_segments, set_silence_proportion, " \
+      + "merge, split or remove. The state after the previous stage is " \
+      + "loaded from --checkpoint-dir, e.g. merge to re-tune " \
+      + "--max-segment-length from the silence padding of an earlier run. " \
+      + "A checkpoint saved for other predictions or other options of the " \
+      + "stages up to it is not used, and the recording is resegmented from " \
+      + "the first stage.")
+  parser.add_argument('--sweep-dir', type=str, \
+      dest='sweep_dir', default=None, \
+      help="Resegment with each configuration of the grid of " \
+      + "--sweep-silence-proportion, --sweep-max-segment-length and " \
+      + "--sweep-min-inter-utt-silence-length, reading the predictions once " \
+      + "and sharing the stages that do not depend on the swept options, and " \
+      + "write the segments and metrics of configuration n to " \
+      + "<sweep-dir>/segments.<n> and <sweep-dir>/metrics.<n>, and its " \
+      + "options to line n of <sweep-dir>/configurations")
+  parser.add_argument('--sweep-silence-proportion', type=str, \
+      dest='sweep_silence_proportion', default=None, \
+      help="With --sweep-dir, comma-separated values of --silence-proportion " \
+      + "(by default, only the value of --silence-proportion)")
+  parser.add_argument('--sweep-max-segment-length', type=str, \
+      dest='sweep_max_segment_length', default=None, \
+      help="With --sweep-dir, comma-separated values of --max-segment-length " \
+      + "(by default, only the value of --max-segment-length)")
+  parser.add_argument('--sweep-min-inter-utt-silence-length', type=str, \
+      dest='sweep_min_inter_utt_silence_length', default=None, \
+      help="With --sweep-dir, comma-separated values of " \
+      + "--min-inter-utt-silence-length (by default, only the value of " \
+      + "--min-inter-utt-silence-length)")
+  parser.add_argument('--online', dest='online', \
+      action='store_true', help="Read the predictions as they arrive from " \
+      + "an archive, e.g. ark,t:- for the standard input, and write out the " \
+      + "segments of each part of a recording as soon as they are final. " \
+      + "The silence proportion is applied to each part, and the channels " \
+      + "are resegmented on their own.")
+  parser.add_argument('--online-cut-silence-length', type=float, \
+      dest='online_cut_silence_length', default=2.0, \
+      help="With --online, resegment the predictions up to the middle of " \
+      + "each silence of at least this length")
+  parser.add_argument('--online-lookahead', type=float, \
+      dest='online_lookahead', default=30.0, \
+      help="With --online, the maximum length of predictions that are kept " \
+      + "before they are resegmented, which bounds the latency")
+  parser.add_argument('args', nargs=1, help='<prediction_dir>|<pred_rspecifier>, e.g. exp/pred, ark:exp/pred.ark or scp:exp/pred.scp')
+  return parser
+
+def main():
+  options = get_parser().parse_args()
 
   sys.stderr.write(' '.join(sys.argv) + "\n")
   if not ( options.silence_proportion \
@@ -693,174 +2092,229 @@ def main():
         % options.remove_noise_only_segments)
     sys.exit(1)
 
-  prediction_dir = options.args[0]
-  channel1_file = options.channel1_file
-  channel2_file = options.channel2_file
+  if not ( options.engine == "python" or options.engine == "numpy" ):
+    sys.stderr.write("%s: Error: Invalid value for engine %s. Must be python or numpy.\n" \
+        % (sys.argv[0], options.engine))
+    sys.exit(1)
 
-  temp_dir = prediction_dir + "/../rttm_classes"
-  if options.reference_rttm != None:
-    read_rttm_file(options.reference_rttm, temp_dir, options.frame_shift)
-  else:
-    temp_dir = None
+  if not ( options.merge_order == "static" or options.merge_order == "dynamic" ):
+    sys.stderr.write("%s: Error: Invalid value for merge-order %s. Must be static or dynamic.\n" \
+        % (sys.argv[0], options.merge_order))
+    sys.exit(1)
 
-  stats = Stats()
+  if options.merge_order == "dynamic" and options.engine != "numpy":
+    sys.stderr.write("%s: Error: --merge-order dynamic requires --engine numpy\n" \
+        % sys.argv[0])
+    sys.exit(1)
 
-  pred_files = dict([ (f.split('/')[-1][0:-5], False) \
-    for f in glob.glob(os.path.join(prediction_dir, "*.pred")) ])
-  for f in pred_files:
-    if pred_files[f]:
-      continue
-    if re.match(".*_"+channel1_file, f) is None:
-      if re.match(".*_"+channel2_file, f) is None:
-        sys.stderr.write("%s does not match pattern .*_%s or .*_%s\n" \
-            % (f,channel1_file, channel2_file))
-        sys.exit(1)
-      else:
-        f1 = f
-        f2 = f
-        f1 = re.sub("(.*_)"+channel2_file, r"\1"+channel1_file, f1)
-    else:
-      f1 = f
-      f2 = f
-      f2 = re.sub("(.*_)"+channel1_file, r"\1"+channel2_file, f2)
+  if options.num_jobs < 1:
+    sys.stderr.write("%s: Error: Invalid value for num-jobs %d. Must be at least 1.\n" \
+        % (sys.argv[0], options.num_jobs))
+    sys.exit(1)
+
+  if options.chunk_length < 0:
+    sys.stderr.write("%s: Error: Invalid value for chunk-length %f. Must be at least 0.\n" \
+        % (sys.argv[0], options.chunk_length))
+    sys.exit(1)
+
+  if options.online:
+    rspecifier = split_rspecifier(options.args[0])
+    if rspecifier == None or rspecifier[0] != "ark":
+      sys.stderr.write("%s: Error: --online requires the predictions in an archive, e.g. ark,t:-\n" \
+          % sys.argv[0])
+      sys.exit(1)
+    if not ( options.online_cut_silence_length > 0 and options.online_lookahead > 0 ):
+      sys.stderr.write("%s: Error: Invalid values for online-cut-silence-length %f and online-lookahead %f. Must be positive.\n" \
+          % (sys.argv[0], options.online_cut_silence_length, options.online_lookahead))
+      sys.exit(1)
 
-    if options.isolated_resegmentation or f2 not in pred_files or f1 not in pred_files:
-      pred_files[f] = True
+  if options.posteriors and (options.online \
+      or split_rspecifier(options.args[0]) == None):
+    sys.stderr.write("%s: Error: --posteriors requires the posteriors in an archive, e.g. ark:exp/post.ark, and cannot be used with --online\n" \
+        % sys.argv[0])
+    sys.exit(1)
+
+  if options.start_stage not in JointResegmenter.STAGES:
+    sys.stderr.write("%s: Error: Invalid value for start-stage %s. Must be one of %s.\n" \
+        % (sys.argv[0], options.start_stage, ", ".join(JointResegmenter.STAGES)))
+    sys.exit(1)
+
+  if options.checkpoint_dir != None \
+      or options.start_stage != JointResegmenter.STAGES[0]:
+    if options.checkpoint_dir == None:
+      sys.stderr.write("%s: Error: --start-stage %s requires --checkpoint-dir\n" \
+          % (sys.argv[0], options.start_stage))
+      sys.exit(1)
+    if options.online or options.chunk_length > 0 \
+        or options.sweep_dir != None \
+        or (options.cache_dir != None and not options.no_cache):
+      sys.stderr.write("%s: Error: --checkpoint-dir and --start-stage cannot be used with --online, --chunk-length, --sweep-dir or --cache-dir\n" \
+          % sys.argv[0])
+      sys.exit(1)
+    if not os.path.isdir(options.checkpoint_dir):
       try:
-        A = open(os.path.join(prediction_dir, f+".pred")).readline().strip().split()[1:]
-      except IndexError:
-        sys.stderr.write("Incorrect format of file %s/%s.pred\n" % (prediction_dir, f))
+        os.makedirs(options.checkpoint_dir)
+      except OSError:
+        sys.stderr.write("%s: Error: Unable to create directory %s\n" \
+            % (sys.argv[0], options.checkpoint_dir))
         sys.exit(1)
-      B = []
-      for i in A:
-        if i == "0":
-          B.append("0")
-        elif i == "1":
-          B.append("4")
-        elif i == "2":
-          B.append("8")
 
-
-      if temp_dir != None:
-        try:
-          reference = open(os.path.join(temp_dir, f+".ref")).readline().strip().split()[1:]
-        except IOError:
-          reference = None
+  if options.sweep_dir != None:
+    if options.online or options.chunk_length > 0 \
+        or options.metrics_file != None \
+        or (options.cache_dir != None and not options.no_cache):
+      sys.stderr.write("%s: Error: --sweep-dir cannot be used with --online, --chunk-length, --metrics-file or --cache-dir\n" \
+          % sys.argv[0])
+      sys.exit(1)
+    for name in ("silence_proportion", "max_segment_length", \
+        "min_inter_utt_silence_length"):
+      values = getattr(options, "sweep_" + name)
+      if values == None:
+        values = [ getattr(options, name) ]
       else:
-        reference = None
-      r = JointResegmenter(B, f, options, stats, reference)
-      r.resegment()
-      r.print_segments()
-    else:
-      if pred_files[f1] and pred_files[f2]:
-        continue
-      pred_files[f1] = True
-      pred_files[f2] = True
+        try:
+          values = [ float(v) for v in values.split(",") ]
+        except ValueError:
+          sys.stderr.write("%s: Error: Invalid value for sweep-%s %s. Must be comma-separated numbers.\n" \
+              % (sys.argv[0], name.replace("_", "-"), values))
+          sys.exit(1)
+      setattr(options, "sweep_" + name, values)
+    for silence_proportion in options.sweep_silence_proportion:
+      if not ( silence_proportion > 0.01 and silence_proportion < 0.99 ):
+        sys.stderr.write("%s: Error: Invalid silence-proportion value %f\n" \
+            % (sys.argv[0], silence_proportion))
+        sys.exit(1)
+    if not os.path.isdir(options.sweep_dir):
       try:
-        A1 = open(os.path.join(prediction_dir, f1+".pred")).readline().strip().split()[1:]
-      except IndexError:
-        sys.stderr.write("Incorrect format of file %s/%s.pred\n" % (prediction_dir, f1))
+        os.makedirs(options.sweep_dir)
+      except OSError:
+        sys.stderr.write("%s: Error: Unable to create directory %s\n" \
+            % (sys.argv[0], options.sweep_dir))
         sys.exit(1)
+
+  check_shard_options(options)
+  if options.shard != None and options.online:
+    sys.stderr.write("%s: Error: --shard cannot be used with --online\n" % sys.argv[0])
+    sys.exit(1)
+
+  if options.data_dir != None:
+    if options.online or options.sweep_dir != None:
+      sys.stderr.write("%s: Error: --data-dir cannot be used with --online or --sweep-dir\n" \
+          % sys.argv[0])
+      sys.exit(1)
+    if options.source_data_dir != None \
+        and not os.path.exists(os.path.join(options.source_data_dir, "wav.scp")):
+      sys.stderr.write("%s: Error: Expected file %s to exist\n" \
+          % (sys.argv[0], os.path.join(options.source_data_dir, "wav.scp")))
+      sys.exit(1)
+    if not os.path.isdir(options.data_dir):
       try:
-        A2 = open(os.path.join(prediction_dir, f2+".pred")).readline().strip().split()[1:]
-      except IndexError:
-        sys.stderr.write("Incorrect format of file %s/%s.pred\n" % (prediction_dir, f2))
+        os.makedirs(options.data_dir)
+      except OSError:
+        sys.stderr.write("%s: Error: Unable to create directory %s\n" \
+            % (sys.argv[0], options.data_dir))
         sys.exit(1)
+  elif options.source_data_dir != None:
+    sys.stderr.write("%s: Error: --source-data-dir requires --data-dir\n" % sys.argv[0])
+    sys.exit(1)
 
-      if len(A1) < len(A2):
-        A3 = A1
-        A1 = A2
-        A2 = A3
-
-        f3 = f1
-        f1 = f2
-        f2 = f3
-
-      B1 = []
-      B2 = []
-      if (len(A1) - len(A2)) > options.max_length_diff / options.frame_shift:
-        sys.stderr.write( \
-            "%s: Warning: Lengths of %s and %s differ by more than %f. " \
-            % (sys.argv[0], f1,f2, options.max_length_diff) \
-            + "So using isolated resegmentation\n")
-        for i in A1:
-          if i == "0":
-            B1.append("0")
-          elif i == "1":
-            B1.append("4")
-          elif i == "2":
-            B1.append("8")
-        for i in A2:
-          if i == "0":
-            B2.append("0")
-          elif i == "1":
-            B2.append("4")
-          elif i == "2":
-            B2.append("8")
-      else:
-        for i in range(0, len(A2)):
-          if A1[i] == "0" and A2[i] == "0":
-            B1.append("0")
-            B2.append("0")
-          if A1[i] == "0" and A2[i] == "1":
-            B1.append("1")
-            B2.append("3")
-          if A1[i] == "0" and A2[i] == "2":
-            B1.append("2")
-            B2.append("6")
-          if A1[i] == "1" and A2[i] == "0":
-            B1.append("3")
-            B2.append("1")
-          if A1[i] == "1" and A2[i] == "1":
-            B1.append("4")
-            B2.append("4")
-          if A1[i] == "1" and A2[i] == "2":
-            B1.append("5")
-            B2.append("7")
-          if A1[i] == "2" and A2[i] == "0":
-            B1.append("6")
-            B2.append("2")
-          if A1[i] == "2" and A2[i] == "1":
-            B1.append("7")
-            B2.append("5")
-          if A1[i] == "2" and A2[i] == "2":
-            B1.append("8")
-            B2.append("8")
-        for i in range(len(A2), len(A1)):
-          if A1[i] == "0":
-            B1.append("0")
-            B2.append("0")
-          if A1[i] == "1":
-            B1.append("3")
-            B2.append("1")
-          if A1[i] == "2":
-            B1.append("6")
-            B2.append("2")
-
-      if temp_dir != None:
-        try:
-          reference1 = open(os.path.join(temp_dir, f1+".ref")).readline().strip().split()[1:]
-        except IOError:
-          reference1 = None
-      else:
-        reference1 = None
-      r1 = JointResegmenter(B1, f1, options, stats, reference1)
-      r1.resegment()
-      r1.print_segments()
+  start_time = time.time()
+  prediction_dir = options.args[0]
+  if options.reference_rttm != None:
+    reference = read_rttm_file(options.reference_rttm, options.frame_shift)
+  else:
+    reference = None
+
+  timing_handle = None
+  if options.timing_report != None:
+    try:
+      timing_handle = open(options.timing_report, 'w')
+    except IOError:
+      sys.stderr.write("%s: Error: Unable to open %s for writing\n" \
+          % (sys.argv[0], options.timing_report))
+      sys.exit(1)
 
-      if temp_dir != None:
-        try:
-          reference2 = open(os.path.join(temp_dir, f2+".ref")).readline().strip().split()[1:]
-        except IOError:
-          reference2= None
-      else:
-        reference2 = None
-      r2 = JointResegmenter(B2, f2, options, stats, reference2)
-      r2.resegment()
-      r2.restrict(len(A2))
-      r2.print_segments()
+  if options.profile_dir != None and not os.path.isdir(options.profile_dir):
+    try:
+      os.makedirs(options.profile_dir)
+    except OSError:
+      sys.stderr.write("%s: Error: Unable to create directory %s\n" \
+          % (sys.argv[0], options.profile_dir))
+      sys.exit(1)
+
+  if options.cache_dir != None and not options.no_cache \
+      and not os.path.isdir(options.cache_dir):
+    try:
+      os.makedirs(options.cache_dir)
+    except OSError:
+      sys.stderr.write("%s: Error: Unable to create directory %s\n" \
+          % (sys.argv[0], options.cache_dir))
+      sys.exit(1)
+
+  if options.metrics_file != None:
+    try:
+      metrics_handle = open(options.metrics_file, 'w')
+    except IOError:
+      sys.stderr.write("%s: Error: Unable to open %s for writing\n" \
+          % (sys.argv[0], options.metrics_file))
+      sys.exit(1)
+
+  stats = Stats()
+  if options.online:
+    status = resegment_online(options, prediction_dir, stats)
+    if options.metrics_file != None:
+      stats.metrics.write_records(metrics_handle)
+    if options.timing_report != None:
+      stats.timing.write_records(timing_handle)
+    if status != 0:
+      sys.exit(status)
+  elif options.sweep_dir != None:
+    status = sweep(options, prediction_dir, reference, stats, timing_handle)
+    if status != 0:
+      sys.exit(status)
+  else:
+    pool = create_pool(options.num_jobs)
+    results = run_jobs(get_jobs(options, prediction_dir, reference, \
+        read_matrix if options.posteriors else None), pool, \
+        options.num_jobs, resegment_recordings)
+
+    segments = {}
+    status = 0
+    for job_segments, job_stats, status in results:
+      stats.add(job_stats)
+      if options.metrics_file != None:
+        job_stats.metrics.write_records(metrics_handle)
+      if options.timing_report != None:
+        job_stats.timing.write_records(timing_handle)
+      segments.update(job_segments)
+      if status != 0:
+        break
+
+    close_pool(pool, status)
+
+    # The segments are written sorted by the recording, so that the output
+    # does not depend on the number of jobs
+    if options.data_dir != None:
+      if status == 0:
+        write_data_dir(options, segments)
+    else:
+      for f in sorted(segments):
+        sys.stdout.write(segments[f])
+    if status != 0:
+      sys.exit(status)
+
+  if options.cache_dir != None and not options.no_cache:
+    evict_cache(options.cache_dir, options.cache_max_size, options.cache_max_age)
+
+  if options.timing_report != None:
+    stats.timing.write_summary(timing_handle, time.time() - start_time)
+    timing_handle.close()
+
+  if options.metrics_file != None:
+    stats.metrics.write_summary(metrics_handle, stats, options.frame_shift)
+    metrics_handle.close()
 
-  if options.verbose > 0:
+  if options.verbose > 0 and options.sweep_dir == None:
     stats.print_stats()
 
 if __name__ == '__main__':
@@ -1,15 +1,30 @@
 #! /usr/bin/python
 
-import os, glob, argparse, sys, re, time
+import os, argparse, sys, time, cProfile
 from argparse import ArgumentParser
+try:
+  from StringIO import StringIO
+except ImportError:
+  from io import StringIO
 
 import numpy as np
 
+from segmentation_common import create_pool, run_jobs, close_pool, \
+    read_predictions, class_run_lengths, Metrics, Timer, Timing, \
+    fuse_channels, read_rttm_file, get_reference_frames, class_counts, \
+    run_bounds, allocate_padding, get_jobs, add_shard_options, \
+    check_shard_options
+
 def mean(l):
   if len(l) > 0:
     return float(sum(l)) / len(l)
   return 0
 
+def percentile(l, q):
+  if len(l) > 0:
+    return np.percentile(l, q)
+  return 0
+
 class Analysis:
   def __init__(self, file_id, frame_shift, prefix):
     self.confusion_matrix = [0] * 9
@@ -26,6 +41,26 @@ class Analysis:
     self.frame_shift = frame_shift
     self.prefix = prefix
 
+  def set_confusions(self, C):
+    # Sets the confusion counts from the confusion type (0 to 8) of every
+    # frame in the array C, and adds the lengths and start frames of the runs
+    # of each type to state_count and markers. The last run is not included,
+    # and the first run is counted from frame -1.
+    counts = np.bincount(C, minlength = 9)
+    self.confusion_matrix = [ int(counts[j]) for j in range(0,9) ]
+    ends = np.flatnonzero(C[1:] != C[:-1]) + 1
+    starts = np.concatenate(([-1], ends[:-1])).astype(int)
+    types = C[ends - 1]
+    for j in range(0,9):
+      self.state_count[j].extend((ends - starts)[types == j].tolist())
+      self.markers[j].extend(starts[types == j].tolist())
+
+  def get_lengths(self, i):
+    # Returns the lengths in state_count of the runs of frames, or of the
+    # segments, of confusion type i. For the segments, state_count has
+    # (length, reference class counts...) tuples.
+    return [ c[0] if type(c) == tuple else c for c in self.state_count[i] ]
+
   def write_confusion_matrix(self, file_handle = sys.stderr):
     sys.stderr.write("Total counts: \n")
     for j in range(0,9):
@@ -40,18 +75,9 @@ class Analysis:
         max_length    = max([0]+self.type_counts[j][i])
         min_length    = min([10000]+self.type_counts[j][i])
         mean_length   = mean(self.type_counts[j][i])
-        try:
-          percentile25  = np.percentile(self.type_counts[j][i], 25)
-        except ValueError:
-          percentile25 = 0
-        try:
-          percentile50  = np.percentile(self.type_counts[j][i], 50)
-        except ValueError:
-          percentile50 = 0
-        try:
-          percentile75  = np.percentile(self.type_counts[j][i], 75)
-        except ValueError:
-          percentile75 = 0
+        percentile25  = percentile(self.type_counts[j][i], 25)
+        percentile50  = percentile(self.type_counts[j][i], 50)
+        percentile75  = percentile(self.type_counts[j][i], 75)
 
         file_handle.write("File %s: %s : TypeStats: Type %d %d: Min: %4d Max: %4d Mean: %4d percentile25: %4d percentile50: %4d percentile75: %4d\n" % (self.file_id, self.prefix, j, i,  min_length, max_length, mean_length, percentile25, percentile50, percentile75))
 
@@ -60,18 +86,9 @@ class Analysis:
       self.max_length[i]    = max([0]+self.state_count[i])
       self.min_length[i]    = min([10000]+self.state_count[i])
       self.mean_length[i]   = mean(self.state_count[i])
-      try:
-        self.percentile25[i]  = np.percentile(self.state_count[i], 25)
-      except ValueError:
-        self.percentile25[i] = 0
-      try:
-        self.percentile50[i]  = np.percentile(self.state_count[i], 50)
-      except ValueError:
-        self.percentile50[i] = 0
-      try:
-        self.percentile75[i]  = np.percentile(self.state_count[i], 75)
-      except ValueError:
-        self.percentile75[i] = 0
+      self.percentile25[i]  = percentile(self.state_count[i], 25)
+      self.percentile50[i]  = percentile(self.state_count[i], 50)
+      self.percentile75[i]  = percentile(self.state_count[i], 75)
 
       file_handle.write("File %s: %s : Length: Type %d: Min: %4d Max: %4d Mean: %4d percentile25: %4d percentile50: %4d percentile75: %4d\n" % (self.file_id, self.prefix, i,  self.min_length[i], self.max_length[i], self.mean_length[i], self.percentile25[i], self.percentile50[i], self.percentile75[i]))
     #file_handle.write("Length: File %s: %40s: Min: %4d Max: %4d Mean: %4d percentile25: %4d percentile50: %4d percentile75: %4d\n" % (self.file_id, "Silence classified as Silence",  self.min_length[0], self.max_length[0], self.mean_length[0], self.percentile25[0], self.percentile50[0], self.percentile75[0]))
@@ -99,74 +116,12 @@ class Analysis:
     #file_handle.write("%40s:\n %s\n" % ("Speech classified as Speech",    str([str(self.markers[8][i])+' ('+ str(self.state_count[8][i])+')' for i in range(0, len(self.state_count[8]))])))
 
 
-def read_rttm_file(rttm_file, temp_dir, frame_shift):
-  file_id = None
-  this_file = []
-  ref_file_handle = None
-  reference = {}
-  for line in open(rttm_file).readlines():
-    splits = line.strip().split()
-    type1 = splits[0]
-    if type1 == "SPEAKER":
-      continue
-    if splits[1] != file_id:
-      # A different file_id. Need to open a different file to write
-      if this_file != []:
-        # If this_file is empty, no reference RTTM corresponding to the file_id
-        # is read. This will happen at the start of the file_id. Otherwise it means a
-        # contiguous segment of previous file_id is processed. So write it to the file.
-        # corresponding to the previous file_id
-        try:
-          ref_file_handle.write(' '.join(this_file))
-          # Close the previous file if any
-          ref_file_handle.close()
-          this_file = []
-        except AttributeError:
-          1==1
-
-      file_id = splits[1]
-      if (file_id not in reference):
-        # First time seeing this file_id. Open a new file for writing.
-        reference[file_id] = 1
-        try:
-          ref_file_handle = open(temp_dir+"/"+file_id+".ref", 'w')
-        except IOError:
-          sys.stderr.write("Unable to open " + temp_dir+"/"+file_id+".ref for writing\n")
-          sys.exit(1)
-        ref_file_handle.write(file_id + "\t")
-      else:
-        # This file has been seen before but not in the previous iteration.
-        # The file has already been closed. So open it for append.
-        try:
-          this_file = open(temp_dir+"/"+file_id+".ref").readline().strip().split()[1:]
-          ref_file_handle = open(temp_dir+"/"+file_id+".ref", 'a')
-        except IOError:
-          sys.stderr.write("Unable to open " + temp_dir+"/"+file_id+".ref for appending\n")
-          sys.exit(1)
-
-    i = len(this_file)
-    category = splits[6]
-    word = splits[5]
-    start_time = int(float(splits[3])/frame_shift + 0.5)
-    duration = int(float(splits[4])/frame_shift + 0.5)
-    if i < start_time:
-      this_file.extend(["0"]*(start_time - i))
-    if type1 == "NON-LEX":
-      if category == "other":
-        # <no-speech> is taken as Silence
-        this_file.extend(["0"]*duration)
-      else:
-        this_file.extend(["1"]*duration)
-    if type1 == "LEXEME":
-      this_file.extend(["2"]*duration)
-    if type1 == "NON-SPEECH":
-      this_file.extend(["1"]*duration)
-
-  ref_file_handle.write(' '.join(this_file))
-  ref_file_handle.close()
-
 class Stats:
   def __init__(self):
+    # The Metrics for --metrics-file
+    self.metrics = Metrics()
+    # The Timing for --timing-report
+    self.timing = Timing()
     self.inter_utt_silence = 0
     self.merge_silence_segment = 0
     self.merge_segments = 0
@@ -174,6 +129,25 @@ class Stats:
     self.silence_only = 0
     self.noise_only = 0
 
+  def add(self, other):
+    # Adds the counts from other, e.g. the Stats of a worker process
+    self.metrics.add(other.metrics)
+    self.timing.add(other.timing)
+    self.inter_utt_silence += other.inter_utt_silence
+    self.merge_silence_segment += other.merge_silence_segment
+    self.merge_segments += other.merge_segments
+    self.split_segments += other.split_segments
+    self.silence_only += other.silence_only
+    self.noise_only += other.noise_only
+
+  def get_counts(self):
+    return { "inter_utt_silence": self.inter_utt_silence, \
+        "merge_silence_segment": self.merge_silence_segment, \
+        "merge_segments": self.merge_segments, \
+        "split_segments": self.split_segments, \
+        "silence_only": self.silence_only, \
+        "noise_only": self.noise_only }
+
   def print_stats(self):
     sys.stderr.write("Inter-utt silence: %d\n" % self.inter_utt_silence)
     sys.stderr.write("Merge silence segment: %d\n" % self.merge_silence_segment)
@@ -182,15 +156,12 @@ class Stats:
     sys.stderr.write("Noise only: %d\n" % self.noise_only)
     sys.stderr.write("Silence only: %d\n" % self.silence_only)
 
-class Timer:
-  def __enter__(self):
-    self.start = time.clock()
-    return self
-  def __exit__(self, *args):
-    self.end = time.clock()
-    self.interval = self.end - self.start
-
 class JointResegmenter:
+  # The transition types of all pairs of frame labels, indexed by
+  # [left label][right label]. This is computed from transition_class()
+  # once per process, by the first resegmenter.
+  TRANSITION_TYPES = None
+
   def __init__(self, A, f, options, stats = None, reference = None):
     self.B = [ i for i in A ]
     self.A = A
@@ -198,6 +169,8 @@ class JointResegmenter:
     self.N = len(A)
     self.S = [False] * self.N
     self.E = [False] * (self.N+1)
+    # The timing of each stage of resegment(), see run_stage()
+    self.stage_times = []
 
     self.options = options
 
@@ -223,6 +196,11 @@ class JointResegmenter:
     self.THIS_NOISE_OR_SILENCE_CONVERT = self.THIS_NOISE + self.THIS_SILENCE_CONVERT
     self.THIS_SILENCE_PLUS = self.THIS_SILENCE + self.THIS_SILENCE_CONVERT
 
+    if JointResegmenter.TRANSITION_TYPES == None:
+      labels = [ str(i) for i in range(0, 12) ]
+      JointResegmenter.TRANSITION_TYPES = [ [ self.transition_class(a, b) \
+          for b in labels ] for a in labels ]
+
     if stats != None:
       self.stats = stats
 
@@ -233,6 +211,11 @@ class JointResegmenter:
         assert (len(self.reference) == self.N)
       else:
         self.reference = reference
+    # The analysis against the reference is done for verbose runs, and for
+    # the metrics file
+    self.analyze = self.reference != None \
+        and (self.options.verbose > 0 or self.options.metrics_file != None)
+    self.analyses = []
 
   def restrict(self, N):
     self.B = self.B[0:N]
@@ -243,122 +226,123 @@ class JointResegmenter:
       self.E[N] = True
     self.N = N
 
-  def resegment(self):
-    with Timer() as t:
-      self.get_initial_segments()
-    if self.options.verbose > 0:
-      sys.stderr.write("get_initial_segments took %f sec\n" % t.interval)
-    with Timer() as t:
-      self.set_silence_proportion()
-    if self.options.verbose > 0:
-      sys.stderr.write("set_silence_proportion took %f sec\n" % t.interval)
-    with Timer() as t:
-      self.merge_segments()
-    if self.options.verbose > 0:
-      sys.stderr.write("merge took %f sec\n" % t.interval)
+  def run_stage(self, name, stage):
+    # Runs a stage of the resegmentation, e.g. self.merge_segments, and adds
+    # its wall and CPU time, frames per second and number of segments before
+    # and after it to self.stage_times. With --profile-dir, the stage is also
+    # run under cProfile and the profile is dumped to
+    # <profile-dir>/<recording>.<stage>.prof.
+    segments_in = self.num_segments()
     with Timer() as t:
-      self.split_long_segments()
+      if self.options.profile_dir != None:
+        profile = cProfile.Profile()
+        try:
+          profile.runcall(stage)
+        finally:
+          profile.dump_stats(os.path.join(self.options.profile_dir, \
+              "%s.%s.prof" % (self.file_id, name)))
+      else:
+        stage()
+    self.stage_times.append({ "stage": name, "wall": t.interval, \
+        "cpu": t.cpu_interval, \
+        "frames_per_sec": self.N / max(t.interval, 1e-9), \
+        "segments_in": segments_in, "segments_out": self.num_segments() })
     if self.options.verbose > 0:
-      sys.stderr.write("split took %f sec\n" % t.interval)
+      sys.stderr.write("%s took %f sec\n" % (name, t.interval))
+
+  def num_segments(self):
+    return sum(self.S)
+
+  def resegment(self):
+    self.run_stage("get_initial_segments", self.get_initial_segments)
+    self.run_stage("set_silence_proportion", self.set_silence_proportion)
+    # The labels of the frames do not change after this, so the frames of
+    # each class are counted once for the later stages
+    self.run_stage("count_classes", self.count_classes)
+    self.run_stage("merge", self.merge_segments)
+    self.run_stage("split", self.split_long_segments)
     if self.remove_noise_segments:
-      with Timer() as t:
-        self.remove_noise_only_segments()
-      if self.options.verbose > 0:
-        sys.stderr.write("remove took %f sec\n" % t.interval)
+      self.run_stage("remove", self.remove_noise_only_segments)
     elif self.min_inter_utt_silence_length > 0.0:
-      self.remove_silence_only_segments()
+      self.run_stage("remove", self.remove_silence_only_segments)
+
+  def hypothesis_classes(self):
+    # Returns the class of every frame in the hypothesis as an array, where
+    # 0 is silence, 1 is noise and 2 is speech
+    A = np.array(self.A)
+    H = np.ones(self.N, dtype=np.int8)
+    H[np.isin(A, self.THIS_SILENCE)] = 0
+    H[np.isin(A, self.THIS_SPEECH)] = 2
+    return H
+
+  def count_classes(self):
+    # Cumulative counts of the silence, noise and speech frames in the
+    # hypothesis and, for the analysis, in the reference (see class_counts())
+    self.hyp_counts = class_counts(self.hypothesis_classes(), 3)
+    if self.analyze:
+      self.ref_counts = class_counts(np.array(self.reference[0:self.N]).astype(int), 3)
+
+  def get_segment_bounds(self):
+    # Returns the start and end frames of the segments as arrays
+    starts = np.flatnonzero(self.S)
+    ends = np.flatnonzero(self.E)
+    assert (len(starts) == len(ends))
+    assert ((starts < ends).all() and (ends[:-1] <= starts[1:]).all())
+    return starts, ends
+
+  def confusion_types(self, classes):
+    # Returns the confusion type 3 * r + h of every frame as an array, where
+    # r is the class of the frame in the reference and h is the class of its
+    # label in the hypothesis, given by the tuples of the labels of the
+    # silence, noise and speech classes. Frames whose label is in none of
+    # these classes are of type 0.
+    A = np.array(self.A)
+    R = np.array(self.reference[0:self.N]).astype(int)
+    C = np.zeros(self.N, dtype=int)
+    for h, labels in enumerate(classes):
+      in_class = np.isin(A, labels)
+      C[in_class] = 3 * R[in_class] + h
+    return C
 
   def get_initial_segments(self):
-    for i in range(0, self.N):
-      if (i > 0) and self.A[i-1] != self.A[i]:
-        # This frame is different from the previous frame.
-        if self.A[i] not in self.THIS_SILENCE:
-          # This frame is non-silence.
-          if self.A[i-1] not in self.THIS_SILENCE:
-            # Both this and the previous frames are not silence.
-            # But they are different. e.g. "4 5"
-            # So this is the end of the previous region and
-            # the beginning of the next region
-            self.S[i] = True
-            self.E[i] = True
-          else:
-            # The previous frame is silence, but not this one.
-            # So this frame is the beginning of a new segment
-            self.S[i] = True
-        else:
-          # This frame is silence
-          if self.A[i-1] not in self.THIS_SILENCE:
-            # Previous frame is not silence, but this one is.
-            # So this frame is the end of the previous segment
-            self.E[i] = True
-      elif i == 0 and self.A[i] not in self.THIS_SILENCE:
-        # The frame is non-silence. So this is the start of a new segment.
-        self.S[i] = True
-    if self.A[self.N-1] not in self.THIS_SILENCE:
-      # Handle the special case where the last frame of file is not silence
-      self.E[self.N] = True
+    # A segment starts at every non-silence frame whose label differs from
+    # that of the previous frame, and ends at every label change (or the end
+    # of the recording) that follows a non-silence frame. e.g. "0 4 4 5 0"
+    # has the segments [1,3) and [3,4).
+    A = np.array(self.A)
+    nonsil = ~np.isin(A, self.THIS_SILENCE)
+    change = np.ones(self.N + 1, dtype=bool)
+    change[1:self.N] = A[1:] != A[:-1]
+    self.S = (change[:-1] & nonsil).tolist()
+    self.E = [False] + (change[1:] & nonsil).tolist()
     assert(sum(self.S) == sum(self.E))
 
-    if self.reference != None and self.options.verbose > 0:
-      self.C = ["0"] * self.N
-      C = self.C
+    if self.analyze:
       a = Analysis(self.file_id, self.frame_shift,"Initial")
-
-      count = 1
-      for i in range(0,self.N):
-        if   self.reference[i] == "0" and self.A[i] in self.THIS_SILENCE:
-          C[i] = "0"
-        elif self.reference[i] == "0" and self.A[i] in self.THIS_NOISE:
-          C[i] = "1"
-        elif self.reference[i] == "0" and self.A[i] in self.THIS_SPEECH:
-          C[i] = "2"
-        elif self.reference[i] == "1" and self.A[i] in self.THIS_SILENCE:
-          C[i] = "3"
-        elif self.reference[i] == "1" and self.A[i] in self.THIS_NOISE:
-          C[i] = "4"
-        elif self.reference[i] == "1" and self.A[i] in self.THIS_SPEECH:
-          C[i] = "5"
-        elif self.reference[i] == "2" and self.A[i] in self.THIS_SILENCE:
-          C[i] = "6"
-        elif self.reference[i] == "2" and self.A[i] in self.THIS_NOISE:
-          C[i] = "7"
-        elif self.reference[i] == "2" and self.A[i] in self.THIS_SPEECH:
-          C[i] = "8"
-        if i > 0 and C[i-1] != C[i]:
-          a.state_count[int(C[i-1])].append(count)
-          a.markers[int(C[i-1])].append(i - count)
-          count = 1
-        else:
-          count += 1
-
-      for j in range(0,9):
-        a.confusion_matrix[j] = sum([C[i] == str(j) for i in range(0,self.N)])
-      a.write_confusion_matrix()
-      a.write_length_stats()
+      a.set_confusions(self.confusion_types((self.THIS_SILENCE, self.THIS_NOISE, self.THIS_SPEECH)))
+      self.analyses.append(a)
+      if self.options.verbose > 0:
+        a.write_confusion_matrix()
+        a.write_length_stats()
     if self.reference != None and self.options.verbose > 2:
       a.write_markers()
 
+  def add_padding(self, start, end):
+    # Converts the silence frames in [start, end) to 9, 10 or 11 depending
+    # on whether they were originally 0, 1 or 2 and includes them in the
+    # segments. Where the type of silence changes, a new segment is started.
+    for n in range(start, end):
+      self.A[n] = str(int(self.B[n]) + 9)
+      if n == start or self.B[n-1] != self.B[n]:
+        self.S[n] = True
+        if n > start:
+          self.E[n] = True
+    self.E[end] = True
+
   def set_silence_proportion(self):
-    num_nonsil_frames = 0
-    in_segment = False
-
-    # Active frames are the frames that are either segment starts
-    # or segment ends
-    active_frames = []
-    for n in range(0, self.N + 1):
-      if self.E[n]:
-        assert(in_segment)
-        in_segment = False
-        active_frames.append(n)
-      if n < self.N and self.S[n]:
-        assert(not in_segment)
-        in_segment = True
-        active_frames.append(n)
-      if n < self.N:
-        if in_segment:
-          # Count the number of non silence frames
-          num_nonsil_frames += 1
-    assert (not in_segment)
+    B = np.array(self.B)
+    silence = np.isin(B, self.THIS_SILENCE)
+    num_nonsil_frames = self.N - int(np.count_nonzero(silence))
     if num_nonsil_frames == 0:
       sys.stderr.write("%s: Warning: no segments found for recording %s\n" % (sys.argv[0], self.file_id))
 
@@ -367,97 +351,32 @@ class JointResegmenter:
     # is computed as below:
     target_segment_frames = int(num_nonsil_frames / (1.0 - self.options.silence_proportion))
 
-    # The number of frames currently in the segments
-    num_segment_frames = num_nonsil_frames
-
-    while num_segment_frames < target_segment_frames:
-      changed = False
-      for i in range(0, len(active_frames)):
-        # At each active frame, try include a silence frame into
-        # segment. Thus padding the non-silence segments with some
-        # silence frames. These converted silence frames are
-        # labelled 9, 10 or 11 depending on whether they were originally
-        # 0, 1 or 2 respectively
-        n = active_frames[i]
-        if self.E[n] and n < self.N and not self.S[n]:
-          # This must be the beginning of a silence region.
-          # Include some of this silence in the segments
-          assert (self.A[n] in self.THIS_SILENCE)
-
-          # Convert the silence frame to be included in segment
-          self.A[n] = str(int(self.B[n]) + 9)
-          if self.B[n-1] != self.B[n]:
-            # In this frame there is a transition from
-            # one type of silence (0, 1 or 2) to another
-            # So its the start of a segment. Also add it to the
-            # end of the active frames list
-            self.S[n] = True
-            active_frames.append(n+1)
-          else:
-            # We need to extend the segment end since we have
-            # included a silence frame. Remove the current segment end mark
-            # and one to the next frame
-            self.E[n] = False
-            active_frames[i] = n + 1
-          self.E[n+1] = True
-          # Increment the number of frames in the segments
-          num_segment_frames += 1
-          changed = True
-        if n < self.N and self.S[n] and n > 0 and not self.E[n]:
-          assert (self.A[n-1] in self.THIS_SILENCE)
-          self.A[n-1] = str(int(self.B[n-1]) + 9)
-          if self.B[n-1] != self.B[n]:
-            self.E[n] = True
-            active_frames.append(n-1)
-          else:
-            self.S[n] = False
-            active_frames[i] = n - 1
-          self.S[n-1] = True
-          num_segment_frames += 1
-          changed = True
-        if num_segment_frames >= target_segment_frames:
-          break
-      if not changed:   # avoid an infinite loop. if no changes, then break.
-        break
+    # The silence regions between the segments and the frames inside them
+    # where the type of silence (0, 1 or 2) changes
+    gap_starts, gap_ends = run_bounds(silence)
+    change_points = np.flatnonzero(silence[1:] & silence[:-1] & (B[1:] != B[:-1])) + 1
+
+    right, left = allocate_padding(gap_starts, gap_ends, self.N, change_points, \
+        target_segment_frames - num_nonsil_frames)
+    num_segment_frames = num_nonsil_frames + int(right.sum() + left.sum())
+
+    for g, h, r, l in zip(gap_starts.tolist(), gap_ends.tolist(), right.tolist(), left.tolist()):
+      if r > 0:
+        self.add_padding(g, g + r)
+      if l > 0:
+        self.add_padding(h - l, h)
+
     if num_segment_frames < target_segment_frames:
       proportion = float(num_segment_frames - num_nonsil_frames) / num_segment_frames
       sys.stderr.write("%s: Warning: for recording %s, only got a proportion %f of silence frames, versus target %f\n" % (sys.argv[0], self.file_id, proportion, self.options.silence_proportion))
 
-    if self.reference != None and self.options.verbose > 0:
-      C = ["0"] * self.N
+    if self.analyze:
       a = Analysis(self.file_id, self.frame_shift,"Silence Proportion")
-
-      count = 1
-      for i in range(0,self.N):
-        if   self.reference[i] == "0" and self.A[i] in self.THIS_SILENCE:
-          C[i] = "0"
-        elif self.reference[i] == "0" and self.A[i] in self.THIS_NOISE_OR_SILENCE_CONVERT:
-          C[i] = "1"
-        elif self.reference[i] == "0" and self.A[i] in self.THIS_SPEECH:
-          C[i] = "2"
-        elif self.reference[i] == "1" and self.A[i] in self.THIS_SILENCE:
-          C[i] = "3"
-        elif self.reference[i] == "1" and self.A[i] in self.THIS_NOISE_OR_SILENCE_CONVERT:
-          C[i] = "4"
-        elif self.reference[i] == "1" and self.A[i] in self.THIS_SPEECH:
-          C[i] = "5"
-        elif self.reference[i] == "2" and self.A[i] in self.THIS_SILENCE:
-          C[i] = "6"
-        elif self.reference[i] == "2" and self.A[i] in self.THIS_NOISE_OR_SILENCE_CONVERT:
-          C[i] = "7"
-        elif self.reference[i] == "2" and self.A[i] in self.THIS_SPEECH:
-          C[i] = "8"
-        if i > 0 and C[i-1] != C[i]:
-          a.state_count[int(C[i-1])].append(count)
-          a.markers[int(C[i-1])].append(i - count)
-          count = 1
-        else:
-          count += 1
-
-      for j in range(0,9):
-        a.confusion_matrix[j] = sum([C[i] == str(j) for i in range(0,self.N)])
-      a.write_confusion_matrix()
-      a.write_length_stats()
+      a.set_confusions(self.confusion_types((self.THIS_SILENCE, self.THIS_NOISE_OR_SILENCE_CONVERT, self.THIS_SPEECH)))
+      self.analyses.append(a)
+      if self.options.verbose > 0:
+        a.write_confusion_matrix()
+        a.write_length_stats()
     if self.reference != None and self.options.verbose > 0:
       a.write_markers()
 
@@ -588,17 +507,17 @@ class JointResegmenter:
         # This is also used to prioritize the merging of the segment
         boundaries.append((segment_ends[j], segment_score, \
             self.transition_type(segment_ends[j])))
-
-        # Sort the boundaries based on segment score
-        boundaries.sort(key = lambda x: x[1])
-        # Then sort based on the type of transition by keeping it still
-        # sorted within each transition type  based on segment score
-        boundaries.sort(key = lambda x: x[2])
         i += 1
         j += 1
       # End if
     # End while loop
 
+    # Sort the boundaries based on segment score
+    boundaries.sort(key = lambda x: x[1])
+    # Then sort based on the type of transition by keeping it still
+    # sorted within each transition type  based on segment score
+    boundaries.sort(key = lambda x: x[2])
+
     # Begin merging of segments by removing the start and end mark
     # at the boundary to be merged
     count = 0
@@ -676,17 +595,13 @@ class JointResegmenter:
         self.S[b[0]] = False
         self.E[b[0]] = False
       # End if
-    if self.reference != None and self.options.verbose > 0:
-      segment_starts = [i for i in range(0,self.N) if self.S[i]]
-      segment_ends = [i for i in range(0,self.N+1) if self.E[i]]
-
+    if self.analyze:
+      # The number of frames of each class in the reference, per segment
+      starts, ends = self.get_segment_bounds()
+      types = self.ref_counts[:, ends] - self.ref_counts[:, starts]
       D = {}
-      for i,st in enumerate(segment_starts):
-        en = segment_ends[i]
-        types = {}
-        for val in self.reference[st:en]:
-          types[val] = types.get(val,0) + 1
-        D[st] = (en, types.get("0",0), types.get("1", 0), types.get("2", 0))
+      for st, en, t0, t1, t2 in zip(starts.tolist(), ends.tolist(), *types.tolist()):
+        D[st] = (en, t0, t1, t2)
       a = Analysis(self.file_id, None, "Merge")
       for st, info in D.items():
         en = info[0]
@@ -742,9 +657,11 @@ class JointResegmenter:
           a.markers[6].append(st)
         else:
           assert (False)
-      a.write_confusion_matrix()
-      a.write_type_stats()
-      a.write_markers()
+      self.analyses.append(a)
+      if self.options.verbose > 0:
+        a.write_confusion_matrix()
+        a.write_type_stats()
+        a.write_markers()
 
   def split_long_segments(self):
     for n in range(0, self.N):
@@ -774,54 +691,30 @@ class JointResegmenter:
           n = p - 1
 
   def remove_silence_only_segments(self):
-    for n in range(0, self.N):
-      if self.S[n]:
-        p = n
-        saw_nonsilence = False
-        while p <= self.N:
-          if self.E[p] and p != n:
-            break
-          if p < self.N and self.A[p] not in self.THIS_SILENCE:
-            saw_nonsilence = True
-          p += 1
-        assert (p > self.N or self.E[p])
-        if not saw_nonsilence:
-          self.stats.silence_only += 1
-          self.S[n] = False
-          self.E[p] = False
-        if p - 1 > n:
-          n = p - 1
+    starts, ends = self.get_segment_bounds()
+    silence = self.hyp_counts[0]
+    silence_only = silence[ends] - silence[starts] == ends - starts
+    for n, p in zip(starts[silence_only].tolist(), ends[silence_only].tolist()):
+      self.stats.silence_only += 1
+      self.S[n] = False
+      self.E[p] = False
 
   def remove_noise_only_segments(self):
-    for n in range(0, self.N):
-      if self.S[n]:
-        p = n
-        saw_speech = False
-        while p <= self.N:
-          if self.E[p] and p != n:
-            break
-          if self.A[p] in self.THIS_SPEECH:
-            saw_speech = True
-          p += 1
-        assert (self.E[p])
-        if not saw_speech:
-          self.stats.noise_only += 1
-          self.S[n] = False
-          self.E[p] = False
-        if p - 1 > n:
-          n = p - 1
-
-    if self.reference != None and self.options.verbose > 0:
-      segment_starts = [i for i in range(0,self.N) if self.S[i]]
-      segment_ends = [i for i in range(0,self.N+1) if self.E[i]]
-
+    starts, ends = self.get_segment_bounds()
+    speech = self.hyp_counts[2]
+    noise_only = speech[ends] == speech[starts]
+    for n, p in zip(starts[noise_only].tolist(), ends[noise_only].tolist()):
+      self.stats.noise_only += 1
+      self.S[n] = False
+      self.E[p] = False
+
+    if self.analyze:
+      # The number of frames of each class in the reference, per segment
+      starts, ends = self.get_segment_bounds()
+      types = self.ref_counts[:, ends] - self.ref_counts[:, starts]
       D = {}
-      for i,st in enumerate(segment_starts):
-        en = segment_ends[i]
-        types = {}
-        for val in self.reference[st:en]:
-          types[val] = types.get(val,0) + 1
-        D[st] = (en, types.get("0",0), types.get("1", 0), types.get("2", 0))
+      for st, en, t0, t1, t2 in zip(starts.tolist(), ends.tolist(), *types.tolist()):
+        D[st] = (en, t0, t1, t2)
       a = Analysis(self.file_id, None, "Remove Noise")
       for st, info in D.items():
         en = info[0]
@@ -877,39 +770,49 @@ class JointResegmenter:
           a.markers[6].append(st)
         else:
           assert (False)
-      a.write_confusion_matrix()
-      a.write_type_stats()
-      a.write_markers()
-
-  def transition_type(self, j):
-    assert (j > 0)
-    assert (self.A[j-1] != self.A[j] or self.A[j] in self.THIS_SILENCE_CONVERT)
-    if self.A[j-1] in (self.THIS_SPEECH_THAT_NOISE + self.THIS_SPEECH_THAT_SIL) and self.A[j] in (self.THIS_SPEECH_THAT_NOISE + self.THIS_SPEECH_THAT_SIL):
+      self.analyses.append(a)
+      if self.options.verbose > 0:
+        a.write_confusion_matrix()
+        a.write_type_stats()
+        a.write_markers()
+
+  def transition_class(self, a, b):
+    # Returns the type of transition from a frame labelled a to a frame
+    # labelled b, or None if segments are never split between such frames.
+    # The transition type is used to prioritize the merging of segments.
+    if a in (self.THIS_SPEECH_THAT_NOISE + self.THIS_SPEECH_THAT_SIL) and b in (self.THIS_SPEECH_THAT_NOISE + self.THIS_SPEECH_THAT_SIL):
       return 0
-    if self.A[j-1] in self.THIS_SPEECH and self.A[j] in self.THIS_SPEECH:
+    if a in self.THIS_SPEECH and b in self.THIS_SPEECH:
       return 1
-    if self.A[j-1] in (self.THIS_SPEECH + self.THIS_NOISE_THAT_SIL) and self.A[j] in (self.THIS_SPEECH + self.THIS_NOISE_THAT_SIL):
+    if a in (self.THIS_SPEECH + self.THIS_NOISE_THAT_SIL) and b in (self.THIS_SPEECH + self.THIS_NOISE_THAT_SIL):
       return 2
-    if self.A[j-1] in (self.THIS_SPEECH + self.THIS_NOISE_THAT_SIL + self.THIS_NOISE_THAT_NOISE) and self.A[j] in (self.THIS_SPEECH + self.THIS_NOISE_THAT_SIL + self.THIS_NOISE_THAT_NOISE):
+    if a in (self.THIS_SPEECH + self.THIS_NOISE_THAT_SIL + self.THIS_NOISE_THAT_NOISE) and b in (self.THIS_SPEECH + self.THIS_NOISE_THAT_SIL + self.THIS_NOISE_THAT_NOISE):
       return 3
-    if self.A[j-1] in (self.THIS_SPEECH + self.THIS_NOISE_THAT_SIL + self.THIS_NOISE_THAT_NOISE + self.THIS_SIL_THAT_SIL + self.THIS_SIL_THAT_NOISE) and self.A[j] in (self.THIS_SPEECH + self.THIS_NOISE_THAT_SIL + self.THIS_NOISE_THAT_NOISE + self.THIS_SIL_THAT_SIL + self.THIS_SIL_THAT_NOISE):
+    if a in (self.THIS_SPEECH + self.THIS_NOISE_THAT_SIL + self.THIS_NOISE_THAT_NOISE + self.THIS_SIL_THAT_SIL + self.THIS_SIL_THAT_NOISE) and b in (self.THIS_SPEECH + self.THIS_NOISE_THAT_SIL + self.THIS_NOISE_THAT_NOISE + self.THIS_SIL_THAT_SIL + self.THIS_SIL_THAT_NOISE):
       return 4
-    if self.A[j-1] not in self.THIS_SILENCE and self.A[j] not in self.THIS_SILENCE:
+    if a not in self.THIS_SILENCE and b not in self.THIS_SILENCE:
       return 5
-    if self.A[j-1] not in self.THIS_SILENCE and self.A[j] in self.THIS_SILENCE:
+    if a not in self.THIS_SILENCE and b in self.THIS_SILENCE:
       return 6
-    if self.A[j-1] in self.THIS_SILENCE and self.A[j] not in self.THIS_SILENCE:
+    if a in self.THIS_SILENCE and b not in self.THIS_SILENCE:
       return 7
-    assert (False)
+    return None
 
-  def print_segments(self, out_file_handle = sys.stdout):
+  def transition_type(self, j):
+    assert (j > 0)
+    assert (self.A[j-1] != self.A[j] or self.A[j] in self.THIS_SILENCE_CONVERT)
+    t = self.TRANSITION_TYPES[int(self.A[j-1])][int(self.A[j])]
+    assert (t != None)
+    return t
+
+  def get_segments(self):
+    # Returns the list of segments as (start, end) pairs of frames.
     # We also do some sanity checking here.
     segments = []
 
     assert (self.N == len(self.S))
     assert (self.N + 1 == len(self.E))
 
-    max_end_time = 0
     n = 0
     while n < self.N:
       if self.E[n] and not self.S[n]:
@@ -921,15 +824,19 @@ class JointResegmenter:
           p += 1
         assert (p == self.N or self.E[p])
         segments.append((n,p))
-        max_end_time = p
         if p < self.N and self.S[p]:
           n = p - 1
         else:
           n = p
       n += 1
+    return segments
+
+  def print_segments(self, out_file_handle = sys.stdout):
+    segments = self.get_segments()
     if len(segments) == 0:
       sys.stderr.write("%s: Warning: no segments for recording %s\n" % (sys.argv[0], self.file_id))
       sys.exit(1)
+    max_end_time = segments[-1][1]
 
     # we'll be printing the times out in hundredths of a second (regardless of the
     # value of $frame_shift), and first need to know how many digits we need (we'll be
@@ -952,6 +859,86 @@ class JointResegmenter:
       # Output:
       out_file_handle.write("%s %s %s %s\n" % (utterance_id, self.file_id, start_seconds, end_seconds))
 
+def resegment_recordings(job):
+  # Resegments a single recording, or a pair of channel 1 and channel 2
+  # recordings, given by job = (options, reference, f1, A1, f2, A2) where
+  # A1 and A2 are the predictions (see read_predictions()), f2 and A2 are
+  # None for a single recording and reference is an RttmReference or None.
+  # With --num-jobs > 1 this is run in a worker process, so the lines of the
+  # segments file are returned as a dict from the recording to its lines,
+  # together with the Stats of these recordings and the exit status, which
+  # is non-zero if there was an error.
+  options, reference, f1, A1, f2, A2 = job
+  stats = Stats()
+  segments = {}
+  try:
+    if f2 == None:
+      f = f1
+      A = read_predictions(A1, f)
+      B = fuse_channels(A)
+      B = B.astype(str).tolist()
+
+      r = JointResegmenter(B, f, options, stats, get_reference_frames(reference, f))
+      r.resegment()
+      out = StringIO()
+      r.print_segments(out)
+      segments[f] = out.getvalue()
+      if options.timing_report != None:
+        stats.timing.add_recording(f, r.N, r.stage_times)
+      if options.metrics_file != None:
+        stats.metrics.add_recording(f, r.N, r.get_segments(), \
+            class_run_lengths(r.hypothesis_classes()), r.analyses)
+    else:
+      A1 = read_predictions(A1, f1)
+      A2 = read_predictions(A2, f2)
+
+      if len(A1) < len(A2):
+        A3 = A1
+        A1 = A2
+        A2 = A3
+
+        f3 = f1
+        f1 = f2
+        f2 = f3
+
+      if (len(A1) - len(A2)) > options.max_length_diff / options.frame_shift:
+        sys.stderr.write( \
+            "%s: Warning: Lengths of %s and %s differ by more than %f. " \
+            % (sys.argv[0], f1,f2, options.max_length_diff) \
+            + "So using isolated resegmentation\n")
+        B1 = fuse_channels(A1)
+        B2 = fuse_channels(A2)
+      else:
+        B1, B2 = fuse_channels(A1, A2)
+      B1 = B1.astype(str).tolist()
+      B2 = B2.astype(str).tolist()
+
+      r1 = JointResegmenter(B1, f1, options, stats, get_reference_frames(reference, f1))
+      r1.resegment()
+      out = StringIO()
+      r1.print_segments(out)
+      segments[f1] = out.getvalue()
+      if options.timing_report != None:
+        stats.timing.add_recording(f1, r1.N, r1.stage_times)
+      if options.metrics_file != None:
+        stats.metrics.add_recording(f1, r1.N, r1.get_segments(), \
+            class_run_lengths(r1.hypothesis_classes()), r1.analyses)
+
+      r2 = JointResegmenter(B2, f2, options, stats, get_reference_frames(reference, f2))
+      r2.resegment()
+      r2.restrict(len(A2))
+      out = StringIO()
+      r2.print_segments(out)
+      segments[f2] = out.getvalue()
+      if options.timing_report != None:
+        stats.timing.add_recording(f2, r2.N, r2.stage_times)
+      if options.metrics_file != None:
+        stats.metrics.add_recording(f2, r2.N, r2.get_segments(), \
+            class_run_lengths(r2.hypothesis_classes()), r2.analyses)
+  except SystemExit as e:
+    return segments, stats, e.code
+  return segments, stats, 0
+
 def main():
   parser = ArgumentParser(description='Get segmentation arguments')
   parser.add_argument('--verbose', type=int, \
@@ -998,7 +985,20 @@ def main():
       + "segmentation to be done")
   parser.add_argument('--reference-rttm', dest='reference_rttm', \
       help="RTTM file to compare and get statistics\n")
-  parser.add_argument('args', nargs=1, help='<prediction_dir>')
+  parser.add_argument('--num-jobs', type=int, \
+      dest='num_jobs', default=1, \
+      help="Number of processes to resegment the recordings in parallel")
+  parser.add_argument('--metrics-file', type=str, \
+      dest='metrics_file', default=None, \
+      help="Write segmentation metrics to this file as JSON lines: one line per recording and a summary of the corpus at the end")
+  parser.add_argument('--timing-report', type=str, \
+      dest='timing_report', default=None, \
+      help="Write the wall and CPU time, frames per second and segments in and out of each stage to this file as JSON lines: one line per recording and a summary with histograms at the end")
+  parser.add_argument('--profile-dir', type=str, \
+      dest='profile_dir', default=None, \
+      help="Profile each stage of each recording with cProfile into <profile-dir>/<recording>.<stage>.prof")
+  add_shard_options(parser)
+  parser.add_argument('args', nargs=1, help='<prediction_dir>|<pred_rspecifier>, e.g. exp/pred, ark:exp/pred.ark or scp:exp/pred.scp')
   options = parser.parse_args()
 
   sys.stderr.write(' '.join(sys.argv) + "\n")
@@ -1013,173 +1013,77 @@ def main():
         % options.remove_noise_only_segments)
     sys.exit(1)
 
-  prediction_dir = options.args[0]
-  channel1_file = options.channel1_file
-  channel2_file = options.channel2_file
+  if options.num_jobs < 1:
+    sys.stderr.write("%s: Error: Invalid value for num-jobs %d. Must be at least 1.\n" \
+        % (sys.argv[0], options.num_jobs))
+    sys.exit(1)
 
-  temp_dir = prediction_dir + "/../rttm_classes"
-  os.system("mkdir -p %s" % temp_dir)
+  check_shard_options(options)
+
+  start_time = time.time()
+  prediction_dir = options.args[0]
   if options.reference_rttm != None:
-    read_rttm_file(options.reference_rttm, temp_dir, options.frame_shift)
+    reference = read_rttm_file(options.reference_rttm, options.frame_shift)
   else:
-    temp_dir = None
-
-  stats = Stats()
-
-  pred_files = dict([ (f.split('/')[-1][0:-5], False) \
-    for f in glob.glob(os.path.join(prediction_dir, "*.pred")) ])
-  for f in pred_files:
-    if pred_files[f]:
-      continue
-    if re.match(".*_"+channel1_file, f) is None:
-      if re.match(".*_"+channel2_file, f) is None:
-        sys.stderr.write("%s does not match pattern .*_%s or .*_%s\n" \
-            % (f,channel1_file, channel2_file))
-        sys.exit(1)
-      else:
-        f1 = f
-        f2 = f
-        f1 = re.sub("(.*_)"+channel2_file, r"\1"+channel1_file, f1)
-    else:
-      f1 = f
-      f2 = f
-      f2 = re.sub("(.*_)"+channel1_file, r"\1"+channel2_file, f2)
-
-    if options.isolated_resegmentation or f2 not in pred_files or f1 not in pred_files:
-      pred_files[f] = True
-      try:
-        A = open(os.path.join(prediction_dir, f+".pred")).readline().strip().split()[1:]
-      except IndexError:
-        sys.stderr.write("Incorrect format of file %s/%s.pred\n" % (prediction_dir, f))
-        sys.exit(1)
-      B = []
-      for i in A:
-        if i == "0":
-          B.append("0")
-        elif i == "1":
-          B.append("4")
-        elif i == "2":
-          B.append("8")
-
-
-      if temp_dir != None:
-        try:
-          reference = open(os.path.join(temp_dir, f+".ref")).readline().strip().split()[1:]
-        except IOError:
-          reference = None
-      else:
-        reference = None
-      r = JointResegmenter(B, f, options, stats, reference)
-      r.resegment()
-      r.print_segments()
-    else:
-      if pred_files[f1] and pred_files[f2]:
-        continue
-      pred_files[f1] = True
-      pred_files[f2] = True
-      try:
-        A1 = open(os.path.join(prediction_dir, f1+".pred")).readline().strip().split()[1:]
-      except IndexError:
-        sys.stderr.write("Incorrect format of file %s/%s.pred\n" % (prediction_dir, f1))
-        sys.exit(1)
-      try:
-        A2 = open(os.path.join(prediction_dir, f2+".pred")).readline().strip().split()[1:]
-      except IndexError:
-        sys.stderr.write("Incorrect format of file %s/%s.pred\n" % (prediction_dir, f2))
-        sys.exit(1)
+    reference = None
+
+  if options.timing_report != None:
+    try:
+      timing_handle = open(options.timing_report, 'w')
+    except IOError:
+      sys.stderr.write("%s: Error: Unable to open %s for writing\n" \
+          % (sys.argv[0], options.timing_report))
+      sys.exit(1)
 
-      if len(A1) < len(A2):
-        A3 = A1
-        A1 = A2
-        A2 = A3
+  if options.profile_dir != None and not os.path.isdir(options.profile_dir):
+    try:
+      os.makedirs(options.profile_dir)
+    except OSError:
+      sys.stderr.write("%s: Error: Unable to create directory %s\n" \
+          % (sys.argv[0], options.profile_dir))
+      sys.exit(1)
 
-        f3 = f1
-        f1 = f2
-        f2 = f3
+  if options.metrics_file != None:
+    try:
+      metrics_handle = open(options.metrics_file, 'w')
+    except IOError:
+      sys.stderr.write("%s: Error: Unable to open %s for writing\n" \
+          % (sys.argv[0], options.metrics_file))
+      sys.exit(1)
 
-      B1 = []
-      B2 = []
-      if (len(A1) - len(A2)) > options.max_length_diff / options.frame_shift:
-        sys.stderr.write( \
-            "%s: Warning: Lengths of %s and %s differ by more than %f. " \
-            % (sys.argv[0], f1,f2, options.max_length_diff) \
-            + "So using isolated resegmentation\n")
-        for i in A1:
-          if i == "0":
-            B1.append("0")
-          elif i == "1":
-            B1.append("4")
-          elif i == "2":
-            B1.append("8")
-        for i in A2:
-          if i == "0":
-            B2.append("0")
-          elif i == "1":
-            B2.append("4")
-          elif i == "2":
-            B2.append("8")
-      else:
-        for i in range(0, len(A2)):
-          if A1[i] == "0" and A2[i] == "0":
-            B1.append("0")
-            B2.append("0")
-          if A1[i] == "0" and A2[i] == "1":
-            B1.append("1")
-            B2.append("3")
-          if A1[i] == "0" and A2[i] == "2":
-            B1.append("2")
-            B2.append("6")
-          if A1[i] == "1" and A2[i] == "0":
-            B1.append("3")
-            B2.append("1")
-          if A1[i] == "1" and A2[i] == "1":
-            B1.append("4")
-            B2.append("4")
-          if A1[i] == "1" and A2[i] == "2":
-            B1.append("5")
-            B2.append("7")
-          if A1[i] == "2" and A2[i] == "0":
-            B1.append("6")
-            B2.append("2")
-          if A1[i] == "2" and A2[i] == "1":
-            B1.append("7")
-            B2.append("5")
-          if A1[i] == "2" and A2[i] == "2":
-            B1.append("8")
-            B2.append("8")
-        for i in range(len(A2), len(A1)):
-          if A1[i] == "0":
-            B1.append("0")
-            B2.append("0")
-          if A1[i] == "1":
-            B1.append("3")
-            B2.append("1")
-          if A1[i] == "2":
-            B1.append("6")
-            B2.append("2")
-
-      if temp_dir != None:
-        try:
-          reference1 = open(os.path.join(temp_dir, f1+".ref")).readline().strip().split()[1:]
-        except IOError:
-          reference1 = None
-      else:
-        reference1 = None
-      r1 = JointResegmenter(B1, f1, options, stats, reference1)
-      r1.resegment()
-      r1.print_segments()
+  pool = create_pool(options.num_jobs)
+  results = run_jobs(get_jobs(options, prediction_dir, reference), pool, \
+      options.num_jobs, resegment_recordings)
 
-      if temp_dir != None:
-        try:
-          reference2 = open(os.path.join(temp_dir, f2+".ref")).readline().strip().split()[1:]
-        except IOError:
-          reference2= None
-      else:
-        reference2 = None
-      r2 = JointResegmenter(B2, f2, options, stats, reference2)
-      r2.resegment()
-      r2.restrict(len(A2))
-      r2.print_segments()
+  stats = Stats()
+  segments = {}
+  status = 0
+  for job_segments, job_stats, status in results:
+    stats.add(job_stats)
+    if options.metrics_file != None:
+      job_stats.metrics.write_records(metrics_handle)
+    if options.timing_report != None:
+      job_stats.timing.write_records(timing_handle)
+    segments.update(job_segments)
+    if status != 0:
+      break
+
+  close_pool(pool, status)
+
+  # The segments are written sorted by the recording, so that the output
+  # does not depend on the number of jobs
+  for f in sorted(segments):
+    sys.stdout.write(segments[f])
+  if status != 0:
+    sys.exit(status)
+
+  if options.timing_report != None:
+    stats.timing.write_summary(timing_handle, time.time() - start_time)
+    timing_handle.close()
+
+  if options.metrics_file != None:
+    stats.metrics.write_summary(metrics_handle, stats, options.frame_shift)
+    metrics_handle.close()
 
   if options.verbose > 0:
     stats.print_stats()